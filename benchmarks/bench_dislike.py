@@ -0,0 +1,92 @@
+"""
+Dislike throughput under concurrent clicks
+
+Starts --threads workers that each send --clicks PUT /recommendations/{id}/dislike
+requests spread over --hot Recommendations, once per mode:
+
+    legacy     load the row, add one in Python and commit (the old handler,
+               called directly so it skips the HTTP layer)
+    atomic     UPDATE ... SET dislike = dislike + 1 (the default handler)
+    coalesced  DISLIKE_COALESCE, buffered and written in batches
+
+and reports throughput, latency percentiles and how many dislikes were lost.
+
+    python -m benchmarks.bench_dislike --threads 8 --clicks 500
+"""
+import argparse
+import json
+import threading
+import time
+
+from benchmarks.common import app, Recommendations, db, reset_table, seed, summarize
+from service.dislikes import dislike_buffer
+
+
+def legacy_dislike(by_id):
+    """ The read-modify-write dislike the handler used to do """
+    with app.app_context():
+        recommendation = Recommendations.find_by_id(by_id)
+        recommendation.dislike += 1
+        recommendation.save()
+        db.session.remove()
+
+
+def run_mode(mode, threads, clicks, hot):
+    """ Runs one mode and returns its results """
+    reset_table()
+    seed(hot)
+    dislike_buffer.enabled = mode == "coalesced"
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(number):
+        client = app.test_client()
+        mine = []
+        for click in range(clicks):
+            by_id = (number + click) % hot + 1
+            start = time.perf_counter()
+            try:
+                if mode == "legacy":
+                    legacy_dislike(by_id)
+                else:
+                    client.put("/recommendations/{}/dislike".format(by_id))
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(str(error))
+            mine.append((time.perf_counter() - start) * 1000.0)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if mode == "coalesced":
+        dislike_buffer.stop()
+    elapsed = time.perf_counter() - start
+    dislike_buffer.enabled = False
+
+    db.session.remove()
+    stored = sum(recommendation.dislike for recommendation in Recommendations.all())
+    result = {"mode": mode, "threads": threads, "requests": threads * clicks,
+              "throughput_rps": round(threads * clicks / elapsed, 1),
+              "lost_dislikes": threads * clicks - stored, "errors": len(errors)}
+    result.update(summarize(latencies))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--clicks", type=int, default=500, help="dislikes sent by each client")
+    parser.add_argument("--hot", type=int, default=5, help="number of Recommendations being disliked")
+    parser.add_argument("--modes", default="legacy,atomic,coalesced", help="comma separated modes to run")
+    args = parser.parse_args()
+    for mode in args.modes.split(","):
+        print(json.dumps(run_mode(mode, args.threads, args.clicks, args.hot)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+In-memory graph against the database
+
+Seeds the table at each scale, loads it into a RecommendationGraph and
+times the list lookup of random products from the graph and from the
+database. Reports the load time and the memory the graph holds per edge.
+
+    python -m benchmarks.bench_graph --scales 100000,1000000
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import app, Recommendations, reset_table, seed, random_origins, measure, summarize
+from service.graph import RecommendationGraph
+
+
+def run(scales, samples):
+    """ Loads the graph at every scale and returns the results """
+    results = []
+    for rows in scales:
+        reset_table()
+        origins = seed(rows)
+        products = random_origins(origins, samples)
+        start = time.perf_counter()
+        graph = RecommendationGraph.from_rows(Recommendations.iter_all(app.config["EXPORT_BATCH_SIZE"]))
+        load_seconds = time.perf_counter() - start
+        database = measure(lambda origin: Recommendations.find_live_by_attributes(origin, None, 1), products)
+        memory = measure(lambda origin: graph.neighbours(origin, 1), products)
+        results.append({
+            "rows": rows,
+            "load_seconds": round(load_seconds, 3),
+            "bytes_per_edge": round(graph.nbytes / len(graph), 2),
+            "database": summarize(database),
+            "graph": summarize(memory),
+        })
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default="10000,100000,1000000", help="comma separated row counts to seed")
+    parser.add_argument("--samples", type=int, default=2000, help="lookups per scale")
+    args = parser.parse_args()
+    run([int(scale) for scale in args.scales.split(",")], args.samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Lookup latency versus table size
+
+Seeds the table at each scale and times the two queries every list and
+create request runs: the product-id/relation list lookup and the
+(origin, target, relation) duplicate check. With the composite indexes in
+place p99 should stay flat as the table grows.
+
+    python -m benchmarks.bench_lookup --scales 10000,100000,1000000,10000000
+"""
+import argparse
+import json
+
+from benchmarks.common import Recommendations, reset_table, seed, random_origins, measure, summarize
+
+
+def run(scales, samples):
+    """ Runs the lookups at every scale and returns the results """
+    results = []
+    for rows in scales:
+        reset_table()
+        origins = seed(rows)
+        products = random_origins(origins, samples)
+        list_lookup = measure(lambda origin: Recommendations.find_by_attributes(origin, 0, 1), products)
+        duplicate_check = measure(lambda origin: Recommendations.find_by_attributes(origin, origin + 1, 1),
+                                  products)
+        results.append({"rows": rows, "list": summarize(list_lookup), "duplicate_check": summarize(duplicate_check)})
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default="10000,100000,1000000",
+                        help="comma separated row counts to seed")
+    parser.add_argument("--samples", type=int, default=2000, help="lookups per scale")
+    args = parser.parse_args()
+    run([int(scale) for scale in args.scales.split(",")], args.samples)
+
+
+if __name__ == "__main__":
+    main()
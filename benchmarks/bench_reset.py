@@ -0,0 +1,81 @@
+"""
+Lock time of the reset with concurrent writers
+
+Seeds --rows Recommendations, then resets the table while a writer thread
+keeps inserting new ones, and reports how long the reset took and the
+longest time a write waited on it. The single statement DELETE the reset
+used to run is compared with Recommendations.remove_all(), which uses
+TRUNCATE on Postgres and batched deletes elsewhere.
+
+    python -m benchmarks.bench_reset --rows 1000000 --batch-size 10000
+"""
+import json
+import time
+import argparse
+import threading
+
+from benchmarks.common import db, Recommendations, reset_table, seed, summarize
+
+
+def single_delete(_args):
+    """ The reset as it used to be: one DELETE of the whole table """
+    db.session.execute(Recommendations.__table__.delete())
+    db.session.commit()
+
+
+def batched(args):
+    """ The reset as it is now """
+    Recommendations.remove_all(args.batch_size, args.pause)
+
+
+def run(name, reset, args):
+    """ Seeds the table and times reset() against a concurrent writer """
+    reset_table()
+    origins = seed(args.rows)
+    engine = db.engine
+    table = Recommendations.__table__
+    latencies = []
+    errors = []
+    done = threading.Event()
+
+    def writer():
+        origin = origins + 1000
+        while not done.is_set():
+            origin += 1
+            start = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    connection.execute(table.insert(), {"product_origin": origin, "product_target": 1,
+                                                        "relation": 1, "dislike": 0, "is_deleted": 0})
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(str(error))
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    time.sleep(0.2)
+    start = time.perf_counter()
+    reset(args)
+    duration = (time.perf_counter() - start) * 1000.0
+    done.set()
+    thread.join()
+    result = {"reset": name, "rows": args.rows, "database": engine.dialect.name,
+              "reset_ms": round(duration, 1), "longest_write_wait_ms": round(max(latencies), 1),
+              "write_errors": len(errors)}
+    result.update(summarize(latencies))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200000, help="rows to seed before each reset")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows deleted per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds between batches")
+    args = parser.parse_args()
+    for name, reset in (("single_delete", single_delete), ("remove_all", batched)):
+        print(json.dumps(run(name, reset, args)))
+
+
+if __name__ == "__main__":
+    main()
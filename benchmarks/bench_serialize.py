@@ -0,0 +1,75 @@
+"""
+Serialization cost of large list responses
+
+Seeds one product with --rows Recommendations and times how the list
+response is encoded: flask-restx marshal followed by json.dumps, as the
+list endpoint used to, against the rows encoded straight to JSON by
+service.encoding. The whole GET /recommendations request is timed as well
+with the list cache bypassed. Reports the cost per row in microseconds.
+
+    python -m benchmarks.bench_serialize --rows 10000 --repeat 20
+"""
+import json
+import argparse
+
+from flask_restx import marshal
+from benchmarks.common import app, db, Recommendations, list_cache, reset_table, measure, summarize
+from service import encoding
+from service.routes import recommendation_model
+
+PRODUCT = 1
+
+
+def seed_product(rows):
+    """ Gives one product `rows` live recommendations """
+    table = Recommendations.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"product_origin": PRODUCT, "product_target": target, "relation": 1, "dislike": 0, "is_deleted": 0}
+            for target in range(2, rows + 2)
+        ])
+
+
+def per_row(latencies, rows):
+    """ Returns the summary with the p50 cost of one row in microseconds """
+    result = summarize(latencies)
+    result["p50_us_per_row"] = round(result["p50_ms"] * 1000.0 / rows, 3)
+    return result
+
+
+def run(rows, repeat):
+    """ Times both encoders and the endpoint and returns the results """
+    reset_table()
+    seed_product(rows)
+    found = Recommendations.find_live_by_attributes(PRODUCT, 0, 0)
+    runs = range(repeat)
+    marshalled = measure(lambda _: json.dumps(marshal([row._asdict() for row in found], recommendation_model)),
+                         runs)
+    fast = measure(lambda _: encoding.dumps(encoding.rows_to_dicts(found)), runs)
+    client = app.test_client()
+    url = "/recommendations?product-id={}".format(PRODUCT)
+
+    def get_uncached(_):
+        list_cache.clear()
+        return client.get(url)
+
+    endpoint = measure(get_uncached, runs)
+    return {
+        "rows": len(found),
+        "encoder": "orjson" if encoding.orjson is not None else "json",
+        "marshal": per_row(marshalled, len(found)),
+        "fast": per_row(fast, len(found)),
+        "endpoint": per_row(endpoint, len(found)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000, help="recommendations in the response")
+    parser.add_argument("--repeat", type=int, default=20, help="encodings to time")
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Worker boot time and memory of the graph: database against snapshot
+
+Seeds --rows Recommendations and writes a graph snapshot, then starts
+--workers fresh interpreters per mode at the same time, each loading the
+graph as a worker would: built from the table through SQLAlchemy, or mapped
+from the snapshot file. Every worker reads all of its arrays once and
+reports its load time and how its resident memory grew, split into private
+(RssAnon) and file backed pages (RssFile), which the workers mapping the
+same snapshot share. Memory is read from /proc, so the split needs Linux.
+
+    python -m benchmarks.bench_snapshot --rows 1000000 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.common import app, Recommendations, reset_table, seed, summarize
+from service.graph import RecommendationGraph
+
+
+def resident_kb():
+    """ Returns the private and file backed resident memory of this process in kB """
+    fields = {}
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                name, _, value = line.partition(":")
+                if name.startswith("Rss"):
+                    fields[name] = int(value.split()[0])
+    except FileNotFoundError:
+        return None, None
+    return fields.get("RssAnon"), fields.get("RssFile")
+
+
+def load_once(mode, path):
+    """ Loads the graph like a booting worker and prints its cost as JSON """
+    anon_before, file_before = resident_kb()
+    start = time.perf_counter()
+    if mode == "snapshot":
+        graph = RecommendationGraph.load(path)
+    else:
+        graph = RecommendationGraph.from_rows(Recommendations.iter_all(app.config["EXPORT_BATCH_SIZE"]))
+    # touch every page, as serving lookups over time would
+    for column in (graph.origins, graph.offsets, graph.ids, graph.targets, graph.relations, graph.dislikes,
+                   graph.versions):
+        column.sum()
+    load_ms = (time.perf_counter() - start) * 1000.0
+    anon_after, file_after = resident_kb()
+    print(json.dumps({
+        "load_ms": load_ms,
+        "private_kb": anon_after - anon_before if anon_before is not None else None,
+        "shared_kb": file_after - file_before if file_before is not None else None,
+    }))
+
+
+def boot_workers(mode, path, workers):
+    """ Starts the workers of one mode together and returns their reports """
+    command = [sys.executable, "-m", "benchmarks.bench_snapshot", "--load", mode, "--snapshot", path]
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                 for _ in range(workers)]
+    return [json.loads(process.communicate()[0].decode().splitlines()[-1]) for process in processes]
+
+
+def run(rows, workers, path):
+    """ Boots the workers in both modes and returns the results """
+    reset_table()
+    seed(rows)
+    graph = RecommendationGraph.from_rows(Recommendations.iter_all(app.config["EXPORT_BATCH_SIZE"]))
+    graph.save(path)
+    results = {"rows": len(graph), "snapshot_bytes": os.path.getsize(path), "workers": workers}
+    for mode in ("database", "snapshot"):
+        reports = boot_workers(mode, path, workers)
+        private = [report["private_kb"] for report in reports if report["private_kb"] is not None]
+        shared = [report["shared_kb"] for report in reports if report["shared_kb"] is not None]
+        results[mode] = {
+            "boot": summarize([report["load_ms"] for report in reports]),
+            "private_kb_per_worker": round(sum(private) / len(private)) if private else None,
+            "shared_kb_per_worker": round(sum(shared) / len(shared)) if shared else None,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000, help="recommendations to seed")
+    parser.add_argument("--workers", type=int, default=4, help="workers booted per mode")
+    parser.add_argument("--snapshot", default=os.path.join(tempfile.gettempdir(), "recommendations-bench.snapshot"),
+                        help="snapshot file to write")
+    parser.add_argument("--load", choices=("database", "snapshot"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.load:
+        load_once(args.load, args.snapshot)
+        return
+    print(json.dumps(run(args.rows, args.workers, args.snapshot), indent=2))
+
+
+if __name__ == "__main__":
+    main()
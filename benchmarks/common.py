@@ -0,0 +1,102 @@
+"""
+Shared helpers for the benchmark scripts
+
+The benchmarks run against their own database so they never touch the
+development one. Set DATABASE_URI to point them at a local Postgres,
+otherwise a SQLite file in the temp directory is used.
+"""
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.gettempdir(), "recommendations-bench.db")
+)
+
+from service import app  # noqa: E402  pylint: disable=wrong-import-position
+from service.models import Recommendations, db  # noqa: E402  pylint: disable=wrong-import-position
+from service.cache import list_cache  # noqa: E402  pylint: disable=wrong-import-position
+
+# Every origin product gets this many targets per relation
+TARGETS_PER_ORIGIN = 10
+RELATIONS = (1, 2, 3)
+
+
+def reset_table():
+    """ Drops and recreates the recommendations table """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    list_cache.clear()
+
+
+def seed(rows, chunk_size=10000):
+    """
+    Seeds the table with `rows` live recommendations
+
+    Rows are spread over rows / (TARGETS_PER_ORIGIN * len(RELATIONS)) origin
+    products so every origin has the same fan-out whatever the scale.
+    Returns the number of origin products.
+    """
+    per_origin = TARGETS_PER_ORIGIN * len(RELATIONS)
+    origins = max(1, rows // per_origin)
+    table = Recommendations.__table__
+    with db.engine.begin() as connection:
+        batch = []
+        for row in _generate_rows(origins, rows):
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                connection.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(table.insert(), batch)
+    return origins
+
+
+def _generate_rows(origins, rows):
+    """ Yields up to `rows` unique recommendations spread over the origins """
+    count = 0
+    for origin in range(1, origins + 1):
+        for relation in RELATIONS:
+            for offset in range(1, TARGETS_PER_ORIGIN + 1):
+                if count >= rows:
+                    return
+                count += 1
+                yield {"product_origin": origin, "product_target": origin + offset,
+                       "relation": relation, "dislike": 0, "is_deleted": 0}
+
+
+def random_origins(origins, samples, seed_value=42):
+    """ Returns a reproducible list of origin product ids to look up """
+    generator = random.Random(seed_value)
+    return [generator.randint(1, origins) for _ in range(samples)]
+
+
+def measure(function, arguments):
+    """ Calls function once per argument and returns the latencies in milliseconds """
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    return latencies
+
+
+def percentile(values, fraction):
+    """ Returns the nearest-rank percentile of a list of numbers """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies):
+    """ Returns p50/p95/p99 of a list of latencies in milliseconds """
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50), 4),
+        "p95_ms": round(percentile(latencies, 0.95), 4),
+        "p99_ms": round(percentile(latencies, 0.99), 4),
+    }
@@ -0,0 +1,53 @@
+"""
+Compares two benchmark result files written by benchmarks/run.py
+
+Prints the change of every route's throughput and p99 latency and exits
+with status 1 when a route got slower than --threshold percent.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+"""
+import sys
+import json
+import argparse
+
+
+def change(before, after):
+    """ Returns the relative change from before to after, in percent """
+    if not before:
+        return 0.0
+    return (after - before) * 100.0 / before
+
+
+def compare(before, after, threshold):
+    """ Returns one line per route and whether any route regressed """
+    old = {result["route"]: result for result in before["results"]}
+    lines = []
+    regressed = False
+    for result in after["results"]:
+        previous = old.get(result["route"])
+        if previous is None:
+            lines.append("{:<8} new".format(result["route"]))
+            continue
+        throughput = change(previous["throughput_rps"], result["throughput_rps"])
+        p99 = change(previous["p99_ms"], result["p99_ms"])
+        slower = throughput < -threshold or p99 > threshold
+        regressed = regressed or slower
+        lines.append("{:<8} throughput {:>+7.1f}%  p99 {:>+7.1f}%{}".format(
+            result["route"], throughput, p99, "  REGRESSION" if slower else ""))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args()
+    with open(args.before) as before, open(args.after) as after:
+        lines, regressed = compare(json.load(before), json.load(after), args.threshold)
+    print("\n".join(lines))
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Benchmark suite for every endpoint
+
+Seeds --rows Recommendations, then drives each route in-process through the
+Flask test client from --concurrency threads and reports throughput,
+p50/p95/p99 latency and the peak memory allocated per request. Results are
+written as JSON so two commits can be compared with benchmarks/compare.py.
+
+    python -m benchmarks.run --rows 100000 --concurrency 4 --output before.json
+    CACHE_BACKEND=none DATABASE_URI=postgres://... python -m benchmarks.run --output after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import itertools
+import threading
+import subprocess
+import tracemalloc
+
+from benchmarks.common import app, db, reset_table, seed, summarize, TARGETS_PER_ORIGIN, RELATIONS
+
+ROUTES = ("list", "batch", "get", "top", "expand", "post", "put", "delete", "dislike", "reset")
+
+
+class Scenario:
+    """ The requests of one route, spread over the seeded data """
+
+    def __init__(self, rows, origins):
+        # seed() only writes whole origins
+        self.rows = min(rows, origins * TARGETS_PER_ORIGIN * len(RELATIONS))
+        self.origins = origins
+        self.ids = itertools.count(1)
+        self.new_origins = itertools.count(origins + 1000)
+        self.random = random.Random(7)
+
+    def list(self, client):
+        origin = self.random.randint(1, self.origins)
+        return client.get("/recommendations?product-id={}".format(origin))
+
+    def batch(self, client):
+        origins = (self.random.randint(1, self.origins) for _ in range(20))
+        return client.get("/recommendations/batch?" + "&".join("product-id={}".format(origin) for origin in origins))
+
+    def get(self, client):
+        return client.get("/recommendations/{}".format(self.random.randint(1, self.rows)))
+
+    def top(self, client):
+        origin = self.random.randint(1, self.origins)
+        return client.get("/products/{}/recommendations?top=5".format(origin))
+
+    def expand(self, client):
+        origin = self.random.randint(1, self.origins)
+        return client.get("/products/{}/expansion?depth=2&fan-out=5".format(origin))
+
+    def post(self, client):
+        data = {"product_origin": next(self.new_origins), "product_target": 1, "relation": 1, "dislike": 0}
+        return client.post("/recommendations", json=data)
+
+    def put(self, client):
+        by_id = next(self.ids)
+        response = client.get("/recommendations/{}".format(by_id)).get_json()
+        data = {key: response[key] for key in ("product_origin", "product_target", "relation", "is_deleted")}
+        data["dislike"] = response["dislike"] + 1
+        return client.put("/recommendations/{}".format(by_id), json=data)
+
+    def delete(self, client):
+        return client.delete("/recommendations/{}".format(next(self.ids)))
+
+    def dislike(self, client):
+        return client.put("/recommendations/{}/dislike".format(self.random.randint(1, self.rows)))
+
+    @staticmethod
+    def reset(client):
+        return client.delete("/recommendations/reset")
+
+
+def run_route(route, args):
+    """ Seeds the table and measures one route """
+    reset_table()
+    origins = seed(args.rows)
+    scenario = Scenario(args.rows, origins)
+    # reset empties the table, so it gets one request per fresh seed
+    requests_per_thread = 1 if route == "reset" else args.requests
+    concurrency = 1 if route == "reset" else args.concurrency
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        mine = []
+        for _ in range(requests_per_thread):
+            start = time.perf_counter()
+            response = getattr(scenario, route)(client)
+            mine.append((time.perf_counter() - start) * 1000.0)
+            if response.status_code >= 400:
+                failures.append(response.status_code)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {"route": route, "requests": len(latencies), "errors": len(failures),
+              "throughput_rps": round(len(latencies) / elapsed, 1)}
+    result.update(summarize(latencies))
+    result["alloc_peak_kb"] = measure_allocations(route, scenario, args)
+    return result
+
+
+def measure_allocations(route, scenario, args):
+    """ Returns the average peak memory allocated by one request, in KiB """
+    if route == "reset":
+        reset_table()
+        seed(args.rows)
+    client = app.test_client()
+    samples = 1 if route == "reset" else min(args.requests, 50)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            getattr(scenario, route)(client)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+    return round(sum(peaks) / len(peaks) / 1024.0, 2)
+
+
+def git_commit():
+    """ Returns the current commit, or None outside a git checkout """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000, help="rows to seed before each route")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--requests", type=int, default=200, help="requests sent by each thread")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma separated routes to run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": db.engine.dialect.name,
+        "cache": app.config["CACHE_BACKEND"],
+        "rows": args.rows,
+        "concurrency": args.concurrency,
+        "results": [],
+    }
+    for route in args.routes.split(","):
+        result = run_route(route, args)
+        report["results"].append(result)
+        print(json.dumps(result))
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import json
+from sqlalchemy.pool import NullPool
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -17,5 +18,111 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool of each worker. A deployment opens up to
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections to the database.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds before a connection is replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))  # milliseconds, 0 for no limit
+# Set when an external pooler such as PgBouncer sits in front of the database,
+# the workers then open a connection per checkout and keep none
+DB_EXTERNAL_POOLER = os.getenv("DB_EXTERNAL_POOLER", "false").lower() in ("true", "1", "yes")
+
+# What a worker does on startup when the database schema is older than the
+# models: "migrate" creates the missing tables, columns and indexes, "verify"
+# refuses to start. Both only read the recorded schema version when it is current
+DB_SCHEMA_MODE = os.getenv("DB_SCHEMA_MODE", "migrate")
+
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": DB_POOL_PRE_PING}
+if DB_EXTERNAL_POOLER:
+    SQLALCHEMY_ENGINE_OPTIONS["poolclass"] = NullPool
+elif not DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update({
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    })
+if DB_STATEMENT_TIMEOUT and DATABASE_URI.startswith("postgres"):
+    SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {"options": "-c statement_timeout={}".format(DB_STATEMENT_TIMEOUT)}
+
+# Largest page the list endpoint returns when a limit is given
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Deleted Recommendations are kept as tombstones for TOMBSTONE_RETENTION_DAYS,
+# then the purge removes them PURGE_BATCH_SIZE rows per transaction with
+# PURGE_PAUSE seconds between transactions. POST /recommendations/purge runs it
+# when PURGE_ENDPOINT_ENABLED is set, for schedulers that can only call URLs
+TOMBSTONE_RETENTION_DAYS = float(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", "0.05"))
+PURGE_ENDPOINT_ENABLED = os.getenv("PURGE_ENDPOINT_ENABLED", "false").lower() in ("true", "1", "yes")
+
+# The change log keeps CHANGE_LOG_RETENTION_DAYS of entries, the purge removes
+# older ones. GET /recommendations/changes?wait= checks for new entries every
+# CHANGES_POLL_INTERVAL seconds for at most CHANGES_MAX_WAIT seconds. A waiting
+# request holds its worker, so wait is only accepted by the gevent workers and
+# ends well before gunicorn kills the worker after GUNICORN_TIMEOUT seconds
+CHANGE_LOG_RETENTION_DAYS = float(os.getenv("CHANGE_LOG_RETENTION_DAYS", "7"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "0.5"))
+CHANGES_MAX_WAIT = max(min(int(os.getenv("CHANGES_MAX_WAIT", "20")), int(os.getenv("GUNICORN_TIMEOUT", "30")) - 5), 0)
+CHANGES_WAIT_ENABLED = os.getenv("GUNICORN_WORKER_CLASS", "sync") == "gevent"
+
+# Rows deleted per transaction by DELETE /recommendations/reset on databases
+# without TRUNCATE, with RESET_PAUSE seconds between transactions
+RESET_BATCH_SIZE = int(os.getenv("RESET_BATCH_SIZE", "10000"))
+RESET_PAUSE = float(os.getenv("RESET_PAUSE", "0"))
+
+# Most products the batch read accepts in one request
+BATCH_MAX_PRODUCTS = int(os.getenv("BATCH_MAX_PRODUCTS", "100"))
+
+# Weight of each relation in the ranked read, as relation:weight pairs. A
+# Recommendation scores weight / (1 + dislike), only these relations are ranked
+# unless the request asks for one
+RELATION_WEIGHTS = {
+    int(relation): float(weight)
+    for relation, weight in (pair.split(":") for pair in os.getenv("RELATION_WEIGHTS", "1:1,2:1,3:1").split(","))
+}
+
+# Deepest and widest walk the expansion read does, whatever the request asks
+EXPAND_MAX_DEPTH = int(os.getenv("EXPAND_MAX_DEPTH", "3"))
+EXPAND_MAX_FANOUT = int(os.getenv("EXPAND_MAX_FANOUT", "20"))
+
+# Rows fetched per round trip by the streaming export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+# Serve whole product lists from an in-memory graph of each worker (needs
+# numpy), brought up to date from the change log every GRAPH_REFRESH_INTERVAL seconds
+GRAPH_ENGINE = os.getenv("GRAPH_ENGINE", "false").lower() in ("true", "1", "yes")
+GRAPH_REFRESH_INTERVAL = float(os.getenv("GRAPH_REFRESH_INTERVAL", "10"))
+# Snapshot file written by flask graph-snapshot, mapped by the workers instead of
+# reading the table when it exists
+GRAPH_SNAPSHOT_PATH = os.getenv("GRAPH_SNAPSHOT_PATH", "")
+
+# Rows written per INSERT statement by the bulk create endpoint
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# Buffer dislikes in memory and write them in batches every DISLIKE_FLUSH_INTERVAL seconds
+DISLIKE_COALESCE = os.getenv("DISLIKE_COALESCE", "false").lower() in ("true", "1", "yes")
+DISLIKE_FLUSH_INTERVAL = float(os.getenv("DISLIKE_FLUSH_INTERVAL", "1.0"))
+
+# Cache of per-product Recommendation lists: memory, redis or none
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Responses to creates sent with an Idempotency-Key header are kept this many
+# seconds in the cache backend, so a retry gets the same answer
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAXSIZE = int(os.getenv("IDEMPOTENCY_MAXSIZE", "10000"))
+
+# Fraction of the requests logged as one record each, server errors and
+# requests slower than LOG_SLOW_REQUEST_MS milliseconds are always logged
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+LOG_SLOW_REQUEST_MS = float(os.getenv("LOG_SLOW_REQUEST_MS", "500"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
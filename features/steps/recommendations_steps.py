@@ -21,19 +21,22 @@ def step_impl(context):
     context.resp = requests.delete(context.base_url + '/recommendations/reset', headers=headers)
     expect(context.resp.status_code).to_equal(204)
 
-    # load the database with new recommendations
-    create_url = context.base_url + '/recommendations'
+    # load the database with new recommendations in one request
+    create_url = context.base_url + '/recommendations/bulk'
+    data = []
     for row in context.table:
-        data = {
+        data.append({
             "product_origin": int(row['product_origin']),
             "product_target": int(row['product_target']),
             "relation": int(row['relation']),
             "dislike": int(row['dislike']),
             "is_deleted": int(row['is_deleted']),
-        }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+        })
+    payload = json.dumps(data)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(200)
+    for result in context.resp.json():
+        expect(result['status']).to_equal(201)
 
 
 @when('I visit the "home page"')
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration
+
+Settings come from the environment so the same file works locally and in
+the cloud: PORT, GUNICORN_WORKERS, GUNICORN_TIMEOUT, GUNICORN_WORKER_CLASS,
+GUNICORN_WORKER_CONNECTIONS and GUNICORN_PRELOAD.
+
+GUNICORN_PRELOAD=true loads the app once in the master before forking the
+workers, so the startup work (schema check, routes, models) is done once.
+
+GUNICORN_WORKER_CLASS=gevent serves requests asynchronously: each worker
+runs up to GUNICORN_WORKER_CONNECTIONS requests as greenlets, and psycopg2
+is made cooperative so a request waiting on Postgres lets the others run.
+"""
+import os
+import sys
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "8080"))
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+errorlog = "-"
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() in ("true", "1", "yes")
+
+
+def pre_fork(server, worker):  # pylint: disable=unused-argument
+    """ Closes the master's connections so no worker inherits one """
+    models = sys.modules.get("service.models")
+    if models is not None:
+        models.db.session.remove()
+        models.db.engine.dispose()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """ Gives each worker its own connection pool """
+    if worker_class == "gevent":
+        # gunicorn patches the standard library, psycopg2 has to be patched on its own
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        patch_psycopg()
+    # The app is only loaded before the fork with --preload. Its pooled
+    # connections are then shared with the parent: drop them so the worker
+    # opens its own
+    models = sys.modules.get("service.models")
+    if models is not None:
+        models.db.engine.dispose()
@@ -0,0 +1,18 @@
+-- Indexes for the Recommendations list lookup and duplicate check
+--
+-- Recommendations.init_db() creates these on startup when they are missing.
+-- On a large production table run this file by hand first instead, since
+-- CREATE INDEX CONCURRENTLY does not block readers and writers:
+--
+--   psql "$DATABASE_URI" -f migrations/0001_recommendation_indexes.sql
+--
+-- The unique index cannot be built while duplicate rows exist. List them with:
+--
+--   SELECT product_origin, product_target, relation, count(*)
+--   FROM recommendations GROUP BY 1, 2, 3 HAVING count(*) > 1;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendations_origin_relation_deleted
+    ON recommendations (product_origin, relation, is_deleted);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_recommendations_origin_target_relation
+    ON recommendations (product_origin, product_target, relation);
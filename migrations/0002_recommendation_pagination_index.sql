@@ -0,0 +1,4 @@
+-- Index for keyset pagination of one product's Recommendations (ORDER BY id)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendations_origin_id
+    ON recommendations (product_origin, id);
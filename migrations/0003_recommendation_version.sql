@@ -0,0 +1,3 @@
+-- Row version used for ETags and optimistic concurrency (If-Match)
+
+ALTER TABLE recommendations ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,4 @@
+-- Index for the ranked top-N read (least disliked live Recommendations of a product and relation first)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendations_ranking
+    ON recommendations (product_origin, relation, is_deleted, dislike, id);
@@ -0,0 +1,4 @@
+-- Index for the reverse lookup by target product (ORDER BY id) and for retiring a product
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendations_target_id
+    ON recommendations (product_target, id);
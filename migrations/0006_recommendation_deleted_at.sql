@@ -0,0 +1,9 @@
+-- When a Recommendation was deleted, tombstones older than the retention window are purged
+
+ALTER TABLE recommendations ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+-- tombstones from before the column existed start their retention window now
+UPDATE recommendations SET deleted_at = timezone('utc', now()) WHERE is_deleted = 1 AND deleted_at IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendations_tombstones
+    ON recommendations (deleted_at) WHERE is_deleted = 1;
@@ -0,0 +1,14 @@
+-- OPTIONAL: restrict the read indexes to live rows
+--
+-- The list, batch and ranked reads only look at rows with is_deleted = 0. On a
+-- table with many tombstones, partial indexes keep those reads from touching
+-- them and make the indexes smaller. The indexes keep their names, so the
+-- service does not create the full ones again on startup.
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_recommendations_origin_relation_deleted;
+CREATE INDEX CONCURRENTLY ix_recommendations_origin_relation_deleted
+    ON recommendations (product_origin, relation, is_deleted) WHERE is_deleted = 0;
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_recommendations_ranking;
+CREATE INDEX CONCURRENTLY ix_recommendations_ranking
+    ON recommendations (product_origin, relation, is_deleted, dislike, id) WHERE is_deleted = 0;
@@ -0,0 +1,6 @@
+-- Records the version the schema was migrated to, workers only check it on startup
+-- (SCHEMA_VERSION in service/models.py)
+
+CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);
+DELETE FROM schema_version;
+INSERT INTO schema_version (version) VALUES (8);
@@ -0,0 +1,21 @@
+-- The append-only change log read by GET /recommendations/changes, written in the
+-- same transaction as every change of a Recommendation
+
+CREATE TABLE IF NOT EXISTS recommendation_changes (
+    seq SERIAL PRIMARY KEY,
+    operation VARCHAR(16) NOT NULL,
+    recommendation_id INTEGER,
+    product_origin INTEGER,
+    product_target INTEGER,
+    relation INTEGER,
+    dislike INTEGER,
+    is_deleted INTEGER,
+    version INTEGER,
+    changed_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_recommendation_changes_changed_at
+    ON recommendation_changes (changed_at);
+
+DELETE FROM schema_version;
+INSERT INTO schema_version (version) VALUES (9);
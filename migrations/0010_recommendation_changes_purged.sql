@@ -0,0 +1,11 @@
+-- Records the highest seq purged from the change log, GET /recommendations/changes
+-- answers 410 Gone to consumers that are behind it
+
+CREATE TABLE IF NOT EXISTS recommendation_changes_purged (seq INTEGER NOT NULL);
+DELETE FROM recommendation_changes_purged;
+-- the entries before the oldest one left were purged
+INSERT INTO recommendation_changes_purged (seq)
+    SELECT MIN(seq) - 1 FROM recommendation_changes HAVING MIN(seq) > 1;
+
+DELETE FROM schema_version;
+INSERT INTO schema_version (version) VALUES (10);
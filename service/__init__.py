@@ -8,13 +8,14 @@ import os
 import sys
 import logging
 from flask import Flask
+from service.logs import start_queue_logging
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands
 
 # Set up logging for production
 if __name__ != "__main__":
@@ -28,6 +29,9 @@ if __name__ != "__main__":
     )
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
+    # the workers only queue records, a background thread writes them
+    if app.logger.handlers:
+        start_queue_logging(app.logger)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
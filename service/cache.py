@@ -0,0 +1,351 @@
+"""
+Read-through cache for per-product Recommendation lists
+
+The list endpoint caches the serialized live Recommendations of a product,
+keyed by (product-id, relation), and the model invalidates exactly the keys a
+write touches. Every key also has a generation that each invalidation moves
+on: a reader takes it before querying the database and its list is only
+stored when the generation did not move meanwhile, so a list read before a
+write commits never outlives the write's invalidation. CACHE_BACKEND picks
+where entries live:
+
+    memory  an LRU with a TTL inside each worker (the default)
+    redis   a shared server at CACHE_REDIS_URL (needs the redis package)
+    none    no caching
+"""
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+# Generation counters of the in-process cache, keys sharing one are invalidated together
+GENERATION_SLOTS = 4096
+# Seconds the shared generation counters live after their last invalidation,
+# far longer than any read that compares against them
+GENERATION_TTL = 3600
+
+
+class LRUCache:
+    """ In-process least recently used cache whose entries expire after ttl seconds """
+
+    def __init__(self, maxsize=1024, ttl=30.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generations = [0] * GENERATION_SLOTS
+        self._epoch = 0  # moved on by clear()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value stored for key, or None when missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        """ Returns the values stored for the keys, None for the missing or expired ones """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        """ Stores value for key, evicting the least recently used entry when full """
+        with self._lock:
+            self._store(key, value)
+
+    def generations(self, keys):
+        """ Returns the generation of each key, moved on by bump() and clear() """
+        with self._lock:
+            return [(self._epoch, self._generations[hash(key) % GENERATION_SLOTS]) for key in keys]
+
+    def bump(self, *keys):
+        """ Moves the generation of the keys on """
+        with self._lock:
+            for key in keys:
+                self._generations[hash(key) % GENERATION_SLOTS] += 1
+
+    def set_if_generation(self, key, value, generation):
+        """ Stores value for key unless its generation moved on, returns whether it was stored """
+        with self._lock:
+            if (self._epoch, self._generations[hash(key) % GENERATION_SLOTS]) != generation:
+                return False
+            self._store(key, value)
+            return True
+
+    def delete(self, *keys):
+        """ Removes the keys """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def _store(self, key, value):
+        """ Stores value for key, the lock must be held """
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache:
+    """
+    Cache kept in a shared key/value server so every worker sees the same entries
+
+    The client needs the redis-py get, mget, set(ex=), delete, scan_iter,
+    incr, expire and eval methods. Values are stored as JSON and expire after
+    ttl seconds on the server. The generations are counters under
+    prefix + "generation:", the bare one being the epoch clear() moves on.
+    """
+
+    # Stores ARGV[1] at KEYS[1] for ARGV[3] seconds when the epoch KEYS[2] and
+    # generation KEYS[3] still read ARGV[2], in one step on the server
+    SET_IF_GENERATION = """
+        local current = (redis.call('get', KEYS[2]) or '0') .. '.' .. (redis.call('get', KEYS[3]) or '0')
+        if current ~= ARGV[2] then
+            return 0
+        end
+        redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3])
+        return 1
+    """
+
+    def __init__(self, client, ttl=30.0, prefix="recommendations:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_prefix = prefix + "generation:"
+        self.evictions = 0  # the server evicts on its own and does not report it
+
+    def get(self, key):
+        """ Returns the value stored for key, or None when missing """
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def get_many(self, keys):
+        """ Returns the values stored for the keys in one round trip, None for the missing ones """
+        if not keys:
+            return []
+        raws = self.client.mget([self.prefix + key for key in keys])
+        return [None if raw is None else json.loads(raw) for raw in raws]
+
+    def set(self, key, value):
+        """ Stores value for key """
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)))
+
+    def generations(self, keys):
+        """ Returns the generation of each key in one round trip, moved on by bump() and clear() """
+        if not keys:
+            return []
+        raws = self.client.mget([self.generation_prefix] + [self.generation_prefix + key for key in keys])
+        epoch = int(raws[0] or 0)
+        return ["{}.{}".format(epoch, int(raw or 0)) for raw in raws[1:]]
+
+    def bump(self, *keys):
+        """ Moves the generation of the keys on """
+        for key in keys:
+            self.client.incr(self.generation_prefix + key)
+            self.client.expire(self.generation_prefix + key, GENERATION_TTL)
+
+    def set_if_generation(self, key, value, generation):
+        """ Stores value for key unless its generation moved on, returns whether it was stored """
+        return bool(self.client.eval(self.SET_IF_GENERATION, 3, self.prefix + key, self.generation_prefix,
+                                     self.generation_prefix + key, json.dumps(value), generation,
+                                     max(1, int(self.ttl))))
+
+    def delete(self, *keys):
+        """ Removes the keys """
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        """ Removes every entry with our prefix """
+        self.client.incr(self.generation_prefix)
+        keys = self._entry_keys()
+        if keys:
+            self.client.delete(*keys)
+
+    def _entry_keys(self):
+        """ Returns the keys of the stored values, without the generation counters """
+        generation_prefix = self.generation_prefix.encode()
+        return [key for key in self.client.scan_iter(match=self.prefix + "*")
+                if not (key.encode() if isinstance(key, str) else key).startswith(generation_prefix)]
+
+    def __len__(self):
+        return len(self._entry_keys())
+
+
+class ListCache:
+    """ Caches the serialized live Recommendations of a product by (product-id, relation) """
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_skips = 0
+
+    def init_app(self, app):
+        """ Creates the backend chosen by CACHE_BACKEND """
+        kind = app.config["CACHE_BACKEND"]
+        ttl = app.config["CACHE_TTL"]
+        if kind == "memory":
+            self.backend = LRUCache(maxsize=app.config["CACHE_MAXSIZE"], ttl=ttl)
+        elif kind == "redis":
+            import redis  # pylint: disable=import-outside-toplevel
+            self.backend = SharedCache(redis.Redis.from_url(app.config["CACHE_REDIS_URL"]), ttl=ttl)
+        elif kind == "none":
+            self.backend = None
+        else:
+            raise ValueError("Unknown CACHE_BACKEND '{}'".format(kind))
+        logger.info("Recommendation list cache: %s", kind)
+
+    @property
+    def enabled(self):
+        """ True when a backend is configured """
+        return self.backend is not None
+
+    def get(self, product_id, relation):
+        """ Returns the cached list for the product and relation, or None """
+        if self.backend is None:
+            return None
+        value = self.backend.get(self._key(product_id, relation))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get_many(self, product_ids, relation):
+        """ Returns the cached lists of the products for the relation, None where there is none """
+        if self.backend is None:
+            return [None] * len(product_ids)
+        values = self.backend.get_many([self._key(product_id, relation) for product_id in product_ids])
+        hits = sum(value is not None for value in values)
+        self.hits += hits
+        self.misses += len(values) - hits
+        return values
+
+    def generations(self, product_ids, relation):
+        """ Returns the generation of the products' lists, to take before reading them from the database """
+        if self.backend is None:
+            return [None] * len(product_ids)
+        return self.backend.generations([self._key(product_id, relation) for product_id in product_ids])
+
+    def set(self, product_id, relation, recommendations, generation=None):
+        """
+        Caches the list for the product and relation
+
+        With a generation from generations() the list is only cached when
+        no write invalidated it since, otherwise it may predate that write
+        """
+        if self.backend is None:
+            return
+        key = self._key(product_id, relation)
+        if generation is None:
+            self.backend.set(key, recommendations)
+        elif not self.backend.set_if_generation(key, recommendations, generation):
+            self.stale_skips += 1
+
+    def invalidate(self, pairs):
+        """
+        Drops the lists a write to Recommendations changes
+
+        Args:
+            pairs: the (product_origin, relation) of every written row, before
+                and after the write. The list of all relations of the product
+                is dropped as well.
+        """
+        if self.backend is None:
+            return
+        keys = set()
+        for product_id, relation in pairs:
+            keys.add(self._key(product_id, relation))
+            keys.add(self._key(product_id, None))
+        self.invalidations += len(keys)
+        # first, so a list read before the write is not cached once the key is deleted
+        self.backend.bump(*keys)
+        self.backend.delete(*keys)
+
+    def clear(self):
+        """ Drops every cached list """
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """ Returns the hit, miss, eviction and invalidation counters """
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "size": len(self.backend) if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend is not None else 0,
+            "invalidations": self.invalidations,
+            "stale_skips": self.stale_skips,
+        }
+
+    @staticmethod
+    def _key(product_id, relation):
+        return "list:{}:{}".format(int(product_id), int(relation or 0))
+
+
+# The cache used by the models and routes, configured by Recommendations.init_db()
+list_cache = ListCache()
+
+
+class IdempotencyStore:
+    """
+    Remembers the response to each Idempotency-Key so retried requests get it again
+
+    Entries live in the CACHE_BACKEND kind of store for IDEMPOTENCY_TTL seconds,
+    an in-process LRU when caching is off. With the memory store a retry only
+    finds the response on the worker that answered it first.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.replays = 0
+
+    def init_app(self, app):
+        """ Creates the backend chosen by CACHE_BACKEND """
+        ttl = app.config["IDEMPOTENCY_TTL"]
+        if app.config["CACHE_BACKEND"] == "redis":
+            import redis  # pylint: disable=import-outside-toplevel
+            self.backend = SharedCache(redis.Redis.from_url(app.config["CACHE_REDIS_URL"]), ttl=ttl,
+                                       prefix="recommendations-idempotency:")
+        else:
+            self.backend = LRUCache(maxsize=app.config["IDEMPOTENCY_MAXSIZE"], ttl=ttl)
+
+    def get(self, key):
+        """ Returns the stored response for the key, or None """
+        value = self.backend.get(key) if self.backend is not None else None
+        if value is not None:
+            self.replays += 1
+        return value
+
+    def set(self, key, response):
+        """ Stores the response for the key """
+        if self.backend is not None:
+            self.backend.set(key, response)
+
+
+# The store used by the create endpoint, configured by routes.init_db()
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,43 @@
+"""
+Command line tasks
+
+Run them with the flask command, for example:
+
+    FLASK_APP=service flask purge-deleted --retention-days 30
+"""
+from datetime import timedelta
+import click
+from service import app
+from service.models import Recommendations
+from service.graph import RecommendationGraph, numpy
+
+
+@app.cli.command("purge-deleted")
+@click.option("--retention-days", type=float, default=None,
+              help="Keep tombstones deleted less than this many days ago [TOMBSTONE_RETENTION_DAYS]")
+@click.option("--batch-size", type=int, default=None, help="Rows deleted per transaction [PURGE_BATCH_SIZE]")
+def purge_deleted(retention_days, batch_size):
+    """ Hard deletes the Recommendations deleted before the retention window and the old change log entries """
+    retention = timedelta(days=app.config["TOMBSTONE_RETENTION_DAYS"] if retention_days is None else retention_days)
+    purged = Recommendations.purge_deleted(retention, batch_size or app.config["PURGE_BATCH_SIZE"],
+                                           app.config["PURGE_PAUSE"],
+                                           progress=lambda total: click.echo("{} purged so far".format(total)))
+    click.echo("Purged {} deleted Recommendations".format(purged))
+    changes_purged = Recommendations.purge_changes(timedelta(days=app.config["CHANGE_LOG_RETENTION_DAYS"]))
+    click.echo("Purged {} change log entries".format(changes_purged))
+
+
+@app.cli.command("graph-snapshot")
+@click.option("--output", default=None, help="Snapshot file to write [GRAPH_SNAPSHOT_PATH]")
+def graph_snapshot(output):
+    """ Writes the live Recommendations to a graph snapshot file for the workers to map """
+    path = output or app.config["GRAPH_SNAPSHOT_PATH"]
+    if not path:
+        raise click.UsageError("Give --output or set GRAPH_SNAPSHOT_PATH")
+    if numpy is None:
+        raise click.ClickException("Graph snapshots need the numpy package")
+    # the workers merge in the change log from this seq, taken before the rows are read
+    seq = Recommendations.complete_seq()
+    graph = RecommendationGraph.from_rows(Recommendations.iter_all(app.config["EXPORT_BATCH_SIZE"]), seq)
+    graph.save(path)
+    click.echo("Wrote {} Recommendations of {} products to {}".format(len(graph), len(graph.origins), path))
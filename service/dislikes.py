@@ -0,0 +1,101 @@
+"""
+Write coalescing for dislikes
+
+When DISLIKE_COALESCE is on, dislikes are counted in memory per
+Recommendation id and a background thread adds them to the database in one
+batch every DISLIKE_FLUSH_INTERVAL seconds, so a burst of clicks on the
+same Recommendation costs a single UPDATE.
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import Counter
+from service.models import Recommendations
+
+logger = logging.getLogger("flask.app")
+
+
+class DislikeBuffer:
+    """ Buffers dislike increments per id and flushes them in batches """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 1.0
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._registered = False  # stop() runs at exit, registered once
+
+    def init_app(self, app):
+        """ Reads the coalescing settings from the Flask app """
+        self.app = app
+        self.enabled = app.config["DISLIKE_COALESCE"]
+        self.interval = app.config["DISLIKE_FLUSH_INTERVAL"]
+
+    def add(self, by_id, count=1):
+        """ Buffers count dislikes for the id and returns how many are pending for it """
+        self._ensure_started()
+        with self._lock:
+            self._pending[int(by_id)] += count
+            return self._pending[int(by_id)]
+
+    def pending(self, by_id):
+        """ Returns the number of dislikes not flushed yet for the id """
+        with self._lock:
+            return self._pending.get(int(by_id), 0)
+
+    def flush(self):
+        """ Writes every pending dislike to the database and returns how many ids were updated """
+        with self._lock:
+            counts, self._pending = self._pending, Counter()
+        if not counts:
+            return 0
+        try:
+            with self.app.app_context():
+                Recommendations.add_dislikes_many(counts)
+        except Exception:
+            # put them back so the next flush retries them
+            with self._lock:
+                self._pending.update(counts)
+            raise
+        return len(counts)
+
+    def stop(self):
+        """ Stops the flushing thread and writes what is still pending """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _ensure_started(self):
+        """ Starts the flushing thread in this process (threads do not survive a fork) """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="dislike-flush", daemon=True)
+            self._thread.start()
+            if not self._registered:
+                # the registration is inherited by forked children, so it is only needed once
+                atexit.register(self.stop)
+                self._registered = True
+
+    def _run(self):
+        """ Flushes the pending dislikes every interval until stopped """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Cannot flush dislikes: %s", error)
+
+
+# The buffer used by the routes, configured by routes.init_db()
+dislike_buffer = DislikeBuffer()
@@ -0,0 +1,30 @@
+"""
+Fast JSON encoding for the read endpoints
+
+The read endpoints select the serialized columns as rows, which already
+have the shape of the Swagger model. They are encoded straight to JSON here
+instead of being walked field by field by flask-restx's marshal, with
+orjson when it is installed and the standard library otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(value):
+    """ Returns value encoded as compact JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def rows_to_dicts(rows):
+    """ Returns the rows selected by Recommendations.serialized_columns() as dicts """
+    if not rows:
+        return []
+    # Core selects name their columns with str subclasses, which orjson refuses as keys
+    keys = [str(key) for key in rows[0].keys()]
+    return [dict(zip(keys, row)) for row in rows]
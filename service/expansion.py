@@ -0,0 +1,84 @@
+"""
+Multi-hop expansion of Recommendations
+
+expand() walks the Recommendations breadth first from a product: the
+products it recommends, the products those recommend, and so on up to a
+depth. Every node follows at most `fanout` of its best scored
+Recommendations, each scoring weight / (1 + dislike) as in the ranked read,
+and a path scores the product of its hops. A product is reported once, at
+the depth it was first reached, with its best scored path.
+
+Each level is read with one query for the whole frontier, or from the
+in-memory graph when one is given, so a request costs at most `depth`
+round trips.
+"""
+from service.models import Recommendations
+
+# Most products read by one query, below the bound parameter limit of every database
+ORIGINS_PER_QUERY = 500
+
+
+def expand(product_id, depth, relations, fanout, weights=None, max_dislike=None, limit=None, graph=None):
+    """
+    Returns the products reachable from a product within depth hops
+
+    Args:
+        product_id (int): the product to start from
+        depth (int): the most hops to follow
+        relations (list): the relations to follow
+        fanout (int): the most Recommendations followed from each product
+        weights (dict): the weight of each relation, 1.0 when missing
+        max_dislike (int): skip the Recommendations disliked more often
+        limit (int): the most products to return
+        graph (RecommendationGraph): read from this graph instead of the database
+
+    Returns dicts with the product_id, depth, score, the relation of the last
+    hop and the path of products from the start, best scored first
+    """
+    weights = weights or {}
+    seen = {product_id}
+    paths = {product_id: ([product_id], 1.0)}
+    results = []
+    for level in range(1, depth + 1):
+        if not paths:
+            break
+        reached = {}
+        edges = _best_edges(sorted(paths), fanout, relations, weights, max_dislike, graph)
+        for origin in sorted(paths):
+            path, path_score = paths[origin]
+            for edge_score, edge in edges.get(origin, ()):
+                target = edge.product_target
+                if target in seen:
+                    continue
+                score = path_score * edge_score
+                best = reached.get(target)
+                if best is None or score > best["score"]:
+                    reached[target] = {"product_id": target, "depth": level, "score": score,
+                                       "relation": edge.relation, "path": path + [target]}
+        seen.update(reached)
+        results.extend(reached.values())
+        paths = {target: (result["path"], result["score"]) for target, result in reached.items()}
+    results.sort(key=lambda result: (-result["score"], result["depth"], result["product_id"]))
+    return results[:limit] if limit else results
+
+
+def _best_edges(origins, fanout, relations, weights, max_dislike, graph):
+    """ Returns the best scored (score, edge) pairs of every origin, at most fanout each """
+    candidates = {}
+    if graph is not None:
+        for origin in origins:
+            candidates[origin] = [edge for edge in graph.neighbours(origin)
+                                  if edge.relation in relations
+                                  and (max_dislike is None or edge.dislike <= max_dislike)]
+    else:
+        for start in range(0, len(origins), ORIGINS_PER_QUERY):
+            rows = Recommendations.find_top_by_origins(origins[start:start + ORIGINS_PER_QUERY], fanout, relations,
+                                                       max_dislike)
+            for row in rows:
+                candidates.setdefault(row.product_origin, []).append(row)
+    best = {}
+    for origin, edges in candidates.items():
+        scored = [(weights.get(edge.relation, 1.0) / (1 + edge.dislike), edge) for edge in edges]
+        scored.sort(key=lambda pair: (-pair[0], pair[1].id))
+        best[origin] = scored[:fanout]
+    return best
@@ -0,0 +1,381 @@
+"""
+In-memory read engine for Recommendation lists
+
+When GRAPH_ENGINE is on, each worker keeps the live Recommendations as a
+compact adjacency structure in the CSR layout: the edges are sorted by
+product_origin then id and held in NumPy arrays (target, relation, dislike,
+id, version), and a sorted array of the origin products with their offsets
+points at each product's slice. GET /recommendations?product-id= is then
+answered from memory without a query.
+
+The graph is built from the table once, then a background thread reads
+the change log every GRAPH_REFRESH_INTERVAL seconds and swaps in a graph
+with the changes merged, so a refresh reads O(changes) rows. Readers never
+wait and see a graph at most that old. Needs the numpy package.
+
+A graph can also be saved as a snapshot file (flask graph-snapshot): a
+fixed header followed by each array, aligned to 8 bytes. With
+GRAPH_SNAPSHOT_PATH set the workers map that file read-only instead of
+querying the table, so the arrays are not copied and every worker on the
+host shares the same pages. The file is checked every interval and mapped
+again when a new snapshot replaced it.
+"""
+import os
+import mmap
+import time
+import struct
+import atexit
+import logging
+import threading
+from array import array
+from collections import namedtuple
+from service.models import Recommendations
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+logger = logging.getLogger("flask.app")
+
+FIELDS = ("id", "product_origin", "product_target", "relation", "dislike", "is_deleted", "version")
+
+# magic, format version, origin count, edge count, built_at, change log seq, padded to 64 bytes
+SNAPSHOT_MAGIC = b"RECGRAPH"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIQQdQ20x")
+# the arrays in file order with their dtype and whether they have an entry per origin or per edge
+SNAPSHOT_COLUMNS = (("origins", "<i8", "origins"), ("offsets", "<i8", "offsets"), ("ids", "<i8", "edges"),
+                    ("targets", "<i8", "edges"), ("relations", "<i4", "edges"), ("dislikes", "<i4", "edges"),
+                    ("versions", "<i4", "edges"))
+
+
+class SnapshotError(Exception):
+    """ Used when a snapshot file cannot be read """
+
+
+class Edge(namedtuple("Edge", FIELDS)):
+    """ One live Recommendation, shaped like the rows of Recommendations.serialized_columns() """
+
+    __slots__ = ()
+
+    def keys(self):
+        """ Returns the field names, like a selected row """
+        return self._fields
+
+
+class RecommendationGraph:
+    """ An immutable CSR adjacency of live Recommendations """
+
+    def __init__(self, origins, offsets, ids, targets, relations, dislikes, versions, built_at=None, seq=0):
+        self.origins = origins  # sorted unique origin products
+        self.offsets = offsets  # the edges of origins[i] are [offsets[i], offsets[i + 1])
+        self.ids = ids
+        self.targets = targets
+        self.relations = relations
+        self.dislikes = dislikes
+        self.versions = versions
+        self.built_at = time.time() if built_at is None else built_at  # when the rows were read
+        self.seq = seq  # the last change log entry the graph includes
+
+    @classmethod
+    def from_rows(cls, rows, seq=0):
+        """ Builds the graph from live rows of Recommendations.serialized_columns() """
+        columns = {name: array("q") for name in ("id", "product_origin", "product_target", "relation", "dislike",
+                                                 "version")}
+        for row in rows:
+            for name, column in columns.items():
+                column.append(getattr(row, name))
+        columns = {name: numpy.array(column, dtype=numpy.int64) for name, column in columns.items()}
+        return cls.from_columns(seq=seq, **columns)
+
+    @classmethod
+    def from_columns(cls, seq=0, **columns):
+        """ Builds the graph from one array per column of Recommendations.serialized_columns() but is_deleted """
+        # each product's edges in id order, like the list query
+        order = numpy.lexsort((columns["id"], columns["product_origin"]))
+        sorted_origins = columns["product_origin"][order]
+        origins, starts = numpy.unique(sorted_origins, return_index=True)
+        offsets = numpy.append(starts, len(sorted_origins)).astype(numpy.int64)
+        return cls(origins.astype(numpy.int64), offsets, columns["id"][order].astype(numpy.int64),
+                   columns["product_target"][order].astype(numpy.int64),
+                   columns["relation"][order].astype(numpy.int32), columns["dislike"][order].astype(numpy.int32),
+                   columns["version"][order].astype(numpy.int32), seq=seq)
+
+    def apply(self, entries):
+        """
+        Returns a new graph with change log entries merged in
+
+        Each entry carries the state of its Recommendation after the change,
+        so only the last entry of a Recommendation counts: its edge is dropped
+        and added back when it is live. Entries must not contain a reset.
+        """
+        latest = {}
+        for entry in entries:
+            latest[entry.recommendation_id] = entry
+        if not latest:
+            return self
+        changed = numpy.fromiter(latest, dtype=numpy.int64, count=len(latest))
+        kept = ~numpy.isin(self.ids, changed)
+        live = [entry for entry in latest.values() if entry.is_deleted == 0]
+        added = {
+            "id": [entry.recommendation_id for entry in live],
+            "product_origin": [entry.product_origin for entry in live],
+            "product_target": [entry.product_target for entry in live],
+            "relation": [entry.relation for entry in live],
+            "dislike": [entry.dislike for entry in live],
+            "version": [entry.version for entry in live],
+        }
+        current = {
+            "id": self.ids,
+            "product_origin": numpy.repeat(self.origins, numpy.diff(self.offsets)),
+            "product_target": self.targets,
+            "relation": self.relations,
+            "dislike": self.dislikes,
+            "version": self.versions,
+        }
+        columns = {name: numpy.concatenate((current[name][kept].astype(numpy.int64),
+                                            numpy.array(added[name], dtype=numpy.int64)))
+                   for name in current}
+        graph = self.from_columns(seq=max(self.seq, max(entry.seq for entry in entries)), **columns)
+        graph.built_at = self.built_at
+        return graph
+
+    def neighbours(self, product_id, relation=None):
+        """ Returns the live Recommendations of a product as Edges in id order """
+        index = int(numpy.searchsorted(self.origins, product_id))
+        if index == len(self.origins) or self.origins[index] != product_id:
+            return []
+        start, end = self.offsets[index], self.offsets[index + 1]
+        ids, targets = self.ids[start:end], self.targets[start:end]
+        relations, dislikes, versions = self.relations[start:end], self.dislikes[start:end], self.versions[start:end]
+        if relation:
+            mask = relations == relation
+            ids, targets, relations, dislikes, versions = (ids[mask], targets[mask], relations[mask],
+                                                           dislikes[mask], versions[mask])
+        return [Edge(by_id, product_id, target, kind, dislike, 0, version)
+                for by_id, target, kind, dislike, version in zip(ids.tolist(), targets.tolist(), relations.tolist(),
+                                                                 dislikes.tolist(), versions.tolist())]
+
+    def save(self, path):
+        """
+        Writes the graph to a snapshot file
+
+        The file is written next to the path and renamed over it, so workers
+        that mapped the previous snapshot keep reading it undisturbed
+        """
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self.origins), len(self),
+                                                self.built_at, self.seq))
+            for name, dtype, _ in SNAPSHOT_COLUMNS:
+                data = numpy.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes()
+                snapshot.write(data)
+                snapshot.write(b"\0" * (-len(data) % 8))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Maps a snapshot file read-only, the arrays are views of the mapped pages """
+        with open(path, "rb") as snapshot:
+            try:
+                pages = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as error:  # empty file
+                raise SnapshotError("{} is not a graph snapshot".format(path)) from error
+        if len(pages) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("{} is not a graph snapshot".format(path))
+        magic, version, origins, edges, built_at, seq = SNAPSHOT_HEADER.unpack_from(pages)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("{} is not a graph snapshot".format(path))
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError("{} has snapshot format {}, expected {}".format(path, version, SNAPSHOT_VERSION))
+        counts = {"origins": origins, "offsets": origins + 1, "edges": edges}
+        arrays = {}
+        offset = SNAPSHOT_HEADER.size
+        for name, dtype, count in SNAPSHOT_COLUMNS:
+            size = numpy.dtype(dtype).itemsize * counts[count]
+            if offset + size > len(pages):
+                raise SnapshotError("{} is truncated".format(path))
+            arrays[name] = numpy.frombuffer(pages, dtype=dtype, count=counts[count], offset=offset)
+            offset += size + (-size % 8)
+        return cls(built_at=built_at, seq=seq, **arrays)
+
+    @property
+    def nbytes(self):
+        """ Returns the memory held by the arrays """
+        return sum(column.nbytes for column in (self.origins, self.offsets, self.ids, self.targets, self.relations,
+                                                self.dislikes, self.versions))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class GraphEngine:
+    """ Keeps the graph of this worker and refreshes it in the background """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 60.0
+        self.snapshot_path = None
+        self.graph = None
+        self.source = None
+        self.loaded_at = None
+        self.load_seconds = None
+        self.refreshed_at = None
+        self._snapshot_key = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._registered = False  # stop() runs at exit, registered once
+
+    def init_app(self, app):
+        """ Reads the engine settings from the Flask app """
+        self.app = app
+        self.enabled = app.config["GRAPH_ENGINE"]
+        self.interval = app.config["GRAPH_REFRESH_INTERVAL"]
+        self.snapshot_path = app.config["GRAPH_SNAPSHOT_PATH"] or None
+        if self.enabled and numpy is None:
+            logger.warning("GRAPH_ENGINE needs the numpy package, reading from the database")
+            self.enabled = False
+
+    def current(self):
+        """ Returns the graph to read, None until the first one is loaded """
+        self._ensure_started()
+        return self.graph
+
+    def lookup(self, product_id, relation=None):
+        """ Returns the live Recommendations of a product, None until the first graph is loaded """
+        graph = self.current()
+        if graph is None:
+            return None
+        return graph.neighbours(product_id, relation)
+
+    def reload(self, from_database=False):
+        """
+        Swaps in a new graph and returns it
+
+        The graph is mapped from the snapshot file when one is configured and
+        present, and kept as is when the file did not change since it was
+        mapped. Otherwise, or with from_database, it is built from the
+        database.
+        """
+        start = time.perf_counter()
+        snapshot_key = self._stat_snapshot()
+        if snapshot_key is not None and not from_database:
+            if snapshot_key == self._snapshot_key and self.graph is not None:
+                return self.graph
+            graph, source = RecommendationGraph.load(self.snapshot_path), "snapshot"
+        else:
+            with self.app.app_context():
+                # changes logged while the rows are read are merged again by the next refresh
+                seq = Recommendations.complete_seq()
+                graph = RecommendationGraph.from_rows(Recommendations.iter_all(self.app.config["EXPORT_BATCH_SIZE"]),
+                                                      seq)
+            source = "database"
+        self.graph, self.source, self._snapshot_key = graph, source, snapshot_key
+        self.loaded_at = self.refreshed_at = time.time()
+        self.load_seconds = time.perf_counter() - start
+        logger.info("Loaded %s Recommendations into the graph from the %s in %.2fs", len(graph), source,
+                    self.load_seconds)
+        return graph
+
+    def refresh(self):
+        """
+        Brings the graph up to date and returns it
+
+        The first graph is loaded in full, and the snapshot file is mapped
+        again whenever it was replaced. Then the change log entries since the
+        graph's seq are merged in, unless some were purged, there is a reset
+        among them or more entries than edges, when reading the table in full
+        is cheaper.
+        """
+        graph = self.graph
+        snapshot_key = self._stat_snapshot()
+        if graph is None or (snapshot_key is not None and snapshot_key != self._snapshot_key):
+            graph = self.reload()
+        batch_size = self.app.config["EXPORT_BATCH_SIZE"]
+        entries = []
+        with self.app.app_context():
+            if graph.seq < Recommendations.purged_seq():
+                return self.reload(from_database=True)
+            while True:
+                batch = Recommendations.find_changes(entries[-1].seq if entries else graph.seq, batch_size)
+                entries.extend(batch)
+                if any(entry.operation == "reset" for entry in batch) or len(entries) > max(len(graph), batch_size):
+                    return self.reload(from_database=True)
+                if len(batch) < batch_size:
+                    break
+        if entries:
+            self.graph = graph.apply(entries)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Merged %s changes into the graph", len(entries))
+        self.refreshed_at = time.time()
+        return self.graph
+
+    def _stat_snapshot(self):
+        """ Returns what identifies the current snapshot file, None without one """
+        if not self.snapshot_path:
+            return None
+        try:
+            info = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            logger.warning("No graph snapshot at %s, reading from the database", self.snapshot_path)
+            return None
+        return info.st_ino, info.st_mtime_ns, info.st_size
+
+    def stats(self):
+        """ Returns the size of the graph and when it was loaded """
+        graph = self.graph
+        return {
+            "enabled": self.enabled,
+            "edges": len(graph) if graph is not None else 0,
+            "products": len(graph.origins) if graph is not None else 0,
+            "bytes": graph.nbytes if graph is not None else 0,
+            "bytes_per_edge": round(graph.nbytes / len(graph), 2) if graph is not None and len(graph) else None,
+            "source": self.source,
+            "built_at": graph.built_at if graph is not None else None,
+            "seq": graph.seq if graph is not None else None,
+            "loaded_at": self.loaded_at,
+            "refreshed_at": self.refreshed_at,
+            "load_seconds": self.load_seconds,
+        }
+
+    def stop(self):
+        """ Stops the refresh thread """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        """ Starts the refresh thread in this process (threads do not survive a fork) """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="graph-refresh", daemon=True)
+            self._thread.start()
+            if not self._registered:
+                # the registration is inherited by forked children, so it is only needed once
+                atexit.register(self.stop)
+                self._registered = True
+
+    def _run(self):
+        """ Loads the graph now and refreshes it every interval until stopped """
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Cannot load the recommendation graph: %s", error)
+            self._stopped.wait(self.interval)
+
+
+# The engine used by the routes, configured by routes.init_db()
+graph_engine = GraphEngine()
@@ -0,0 +1,95 @@
+"""
+Request and queue logging
+
+RequestLog writes one record per request with its timing fields instead of
+a log line per handler and finder. Only a sample of the successful fast
+requests is logged; server errors and slow requests always are.
+
+start_queue_logging() moves the handlers of a logger behind a queue, so the
+workers only put records on the queue and a background thread does the I/O.
+"""
+import os
+import time
+import queue
+import random
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, request
+
+
+class RequestLog:
+    """ Logs a sample of the requests as one structured record each """
+
+    def __init__(self):
+        self.app = None
+        self.random = random.Random()
+
+    def init_app(self, app):
+        """ Installs the request hooks """
+        if self.app is not None:
+            return
+        self.app = app
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def should_log(self, status, duration_ms):
+        """ Returns whether a request with the status and duration is logged """
+        if status >= 500 or duration_ms >= self.app.config["LOG_SLOW_REQUEST_MS"]:
+            return True
+        rate = self.app.config["LOG_SAMPLE_RATE"]
+        return rate >= 1 or (rate > 0 and self.random.random() < rate)
+
+    @staticmethod
+    def _before_request():
+        g.request_log_start = time.perf_counter()
+
+    def _after_request(self, response):
+        start = g.get("request_log_start")
+        if start is None:
+            return response
+        duration_ms = (time.perf_counter() - start) * 1000.0
+        if not self.should_log(response.status_code, duration_ms) or not self.app.logger.isEnabledFor(logging.INFO):
+            return response
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "route": request.url_rule.rule if request.url_rule is not None else None,
+            "status": response.status_code,
+            "duration_ms": round(duration_ms, 2),
+            # counted by the metrics hooks
+            "queries": g.get("metrics_queries"),
+            "db_ms": round(g.metrics_query_time * 1000.0, 2) if "metrics_query_time" in g else None,
+        }
+        self.app.logger.info("%(method)s %(path)s %(status)s %(duration_ms)sms queries=%(queries)s db=%(db_ms)sms",
+                             fields, extra={"request": fields})
+        return response
+
+
+# The request log of the service, set up by routes.init_db()
+request_log = RequestLog()
+
+
+def start_queue_logging(target):
+    """
+    Moves the handlers of the target logger behind a queue
+
+    A listener thread hands the queued records to the original handlers. It
+    is started again in forked children, where the parent's thread is gone.
+    Returns the listener.
+    """
+    handlers = list(target.handlers)
+    records = queue.Queue(-1)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    target.handlers = [QueueHandler(records)]
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart():
+        fresh = QueueListener(records, *handlers, respect_handler_level=True)
+        fresh.start()
+        atexit.register(fresh.stop)
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=restart)
+    return listener
@@ -0,0 +1,230 @@
+"""
+Prometheus metrics
+
+Request hooks on the Flask app time every request and count the database
+queries it runs (through SQLAlchemy engine events) and the time spent
+encoding its response. GET /metrics renders them in the Prometheus text
+format together with the connection pool gauges and the cache counters.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.cache import list_cache
+from service.pool import pool_metrics
+
+# Prometheus' default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ A value that only goes up, one per combination of label values """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """ Adds amount to the counter of the label values """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """ Returns the counter of the label values """
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """ Yields the (name, labels, value) of every sample """
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """ Counts observations in cumulative buckets, one set per combination of label values """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """ Records one observation for the label values """
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def count(self, *label_values):
+        """ Returns the number of observations for the label values """
+        series = self._values.get(label_values)
+        return series["count"] if series else 0
+
+    def samples(self):
+        """ Yields the (name, labels, value) of every bucket, sum and count """
+        with self._lock:
+            items = [(label_values, dict(series, buckets=list(series["buckets"])))
+                     for label_values, series in self._values.items()]
+        for label_values, series in items:
+            for bound, count in zip(self.buckets, series["buckets"]):
+                labels = _format_labels(self.labels + ("le",), label_values + (_format_number(bound),))
+                yield self.name + "_bucket", labels, count
+            labels = _format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            yield self.name + "_bucket", labels, series["count"]
+            yield self.name + "_sum", _format_labels(self.labels, label_values), series["sum"]
+            yield self.name + "_count", _format_labels(self.labels, label_values), series["count"]
+
+
+class Gauge:
+    """ A value read from a callback when the metrics are rendered """
+
+    def __init__(self, name, description, callback, kind="gauge"):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        """ Yields the current value, skipped when the callback has none """
+        value = self.callback()
+        if value is not None:
+            yield self.name, "", value
+
+
+class Metrics:
+    """ The metrics of the service and the hooks that record them """
+
+    def __init__(self):
+        self.requests = Counter("http_requests_total", "HTTP requests by method, route and status",
+                                ("method", "route", "status"))
+        self.latency = Histogram("http_request_duration_seconds", "HTTP request latency by method and route",
+                                 ("method", "route"))
+        self.queries = Histogram("db_queries_per_request", "Database queries run by one request", ("route",),
+                                 buckets=QUERY_COUNT_BUCKETS)
+        self.query_time = Histogram("db_query_duration_seconds_per_request",
+                                    "Time one request spent in database queries", ("route",))
+        self.serialization = Histogram("response_serialization_seconds",
+                                       "Time spent encoding the response body", ("route",))
+        self.collectors = [self.requests, self.latency, self.queries, self.query_time, self.serialization]
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            self.add_gauge("db_pool_" + name, "Connection pool {} connections".format(name),
+                           lambda name=name: pool_metrics.snapshot()[name])
+        for name in ("connect", "checkout", "checkin", "invalidate"):
+            self.add_gauge("db_pool_{}_total".format(name), "Connection pool {} events".format(name),
+                           lambda name=name: pool_metrics.snapshot()[name], kind="counter")
+        for name in ("hits", "misses", "evictions", "invalidations", "stale_skips"):
+            self.add_gauge("list_cache_{}_total".format(name), "Recommendation list cache {}".format(name),
+                           lambda name=name: list_cache.stats()[name], kind="counter")
+        self.app = None
+
+    def init_app(self, app, api):
+        """ Installs the request hooks, the query listeners and the JSON encoding timer """
+        if self.app is not None:
+            return
+        self.app = app
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # every engine, init_db() creates a new one when it runs again
+        event.listen(Engine, "before_cursor_execute", self._before_query)
+        event.listen(Engine, "after_cursor_execute", self._after_query)
+        encode = api.representations["application/json"]
+
+        def timed_encode(data, code, headers=None):
+            with self.time_serialization():
+                return encode(data, code, headers)
+
+        api.representations["application/json"] = timed_encode
+
+    @staticmethod
+    @contextmanager
+    def time_serialization():
+        """ Adds the time spent in the block to the serialization time of the request """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if has_request_context():
+                g.metrics_serialization = g.get("metrics_serialization", 0.0) + time.perf_counter() - start
+
+    def add_gauge(self, name, description, callback, kind="gauge"):
+        """ Adds a metric read from callback() when the metrics are rendered """
+        self.collectors.append(Gauge(name, description, callback, kind))
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        lines = []
+        for collector in self.collectors:
+            lines.append("# HELP {} {}".format(collector.name, collector.description))
+            lines.append("# TYPE {} {}".format(collector.name, collector.kind))
+            for name, labels, value in collector.samples():
+                lines.append("{}{} {}".format(name, labels, _format_number(value)))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _route():
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    @staticmethod
+    def _before_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_time = 0.0
+
+    def _after_request(self, response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+        route = self._route()
+        self.requests.inc(request.method, route, response.status_code)
+        self.latency.observe(time.perf_counter() - start, request.method, route)
+        self.queries.observe(g.metrics_queries, route)
+        self.query_time.observe(g.metrics_query_time, route)
+        if "metrics_serialization" in g:
+            self.serialization.observe(g.metrics_serialization, route)
+        return response
+
+    @staticmethod
+    def _before_query(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+        if has_request_context():
+            g.metrics_query_start = time.perf_counter()
+
+    @staticmethod
+    def _after_query(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+        if has_request_context() and "metrics_query_start" in g and "metrics_queries" in g:
+            g.metrics_queries += 1
+            g.metrics_query_time += time.perf_counter() - g.pop("metrics_query_start")
+
+
+# The metrics of the service, set up by routes.init_db()
+metrics = Metrics()
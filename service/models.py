@@ -3,9 +3,19 @@ Models for Recommendation
 
 All of the models are stored in this module
 """
+import time
 import logging
+import threading
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask import request
+from sqlalchemy import inspect, bindparam, func, literal_column, select, tuple_, union_all, event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import CreateColumn
+from service.cache import list_cache
+from service.pool import pool_metrics
 
 logger = logging.getLogger("flask.app")
 
@@ -18,12 +28,62 @@ class DataValidationError(Exception):
     pass
 
 
+class DuplicateRecommendationError(Exception):
+    """ Used when a write would duplicate an existing (origin, target, relation) """
+    pass
+
+
+class StaleRecommendationError(Exception):
+    """ Used when a Recommendation changed since it was read (its version moved on) """
+    pass
+
+
+class SchemaVersionError(Exception):
+    """ Used when the database schema is not the version the models expect """
+    pass
+
+
+# The version of the database schema, the number of the latest file in the
+# migrations folder. Bump it with every migration.
+SCHEMA_VERSION = 10
+
+# Holds the single version the database schema was last migrated to
+schema_version = db.Table("schema_version", db.Column("version", db.Integer, nullable=False))
+
+# The append-only change log: one entry per Recommendation written, with its
+# state after the change, in the same transaction as the write. A reset is a
+# single entry without a Recommendation. seq orders the entries.
+CHANGE_OPERATIONS = ("create", "update", "delete", "dislike", "reset")
+changes = db.Table(
+    "recommendation_changes",
+    db.Column("seq", db.Integer, primary_key=True),
+    db.Column("operation", db.String(16), nullable=False),
+    db.Column("recommendation_id", db.Integer, nullable=True),
+    db.Column("product_origin", db.Integer, nullable=True),
+    db.Column("product_target", db.Integer, nullable=True),
+    db.Column("relation", db.Integer, nullable=True),
+    db.Column("dislike", db.Integer, nullable=True),
+    db.Column("is_deleted", db.Integer, nullable=True),
+    db.Column("version", db.Integer, nullable=True),
+    db.Column("changed_at", db.DateTime, nullable=False),
+    db.Index("ix_recommendation_changes_changed_at", "changed_at"),
+    sqlite_autoincrement=True,  # never reuse a seq
+)
+# Holds the single highest seq the purge removed from the change log. Entries
+# are purged in seq order, so a consumer that read up to it missed nothing
+changes_purged = db.Table("recommendation_changes_purged", db.Column("seq", db.Integer, nullable=False))
+# Most snapshots kept by the change log horizon while transactions are in flight
+HORIZON_OBSERVATIONS = 1000
+
+
 class Recommendations(db.Model):
     """
     Class that represents a <your resource model name>
     """
 
     app = None
+    _top_statements = {}  # see _top_statement()
+    _top_compiled = {}
 
     # Table Schema
 
@@ -33,6 +93,27 @@ class Recommendations(db.Model):
     relation = db.Column(db.Integer, nullable=False)  # 1 for cross-sell, 2 for up-sell, 3 for accessory
     dislike = db.Column(db.Integer, nullable=False)  # the counter of the times customers click "dislike"
     is_deleted = db.Column(db.Integer, nullable=False, default=0)  # 0 is not deleted, 1 is deleted
+    version = db.Column(db.Integer, nullable=False, server_default="1")  # bumped on every change, used for ETags
+    deleted_at = db.Column(db.DateTime, nullable=True)  # when is_deleted was set (UTC), tombstones are purged by age
+
+    # Indexes for the list lookup (product-id + relation, live rows only), the
+    # duplicate check done before every create and keyset pagination
+    __table_args__ = (
+        db.Index("ix_recommendations_origin_relation_deleted", "product_origin", "relation", "is_deleted"),
+        db.Index("uq_recommendations_origin_target_relation", "product_origin", "product_target", "relation",
+                 unique=True),
+        # walks one product's rows in id order so a page costs O(page)
+        db.Index("ix_recommendations_origin_id", "product_origin", "id"),
+        # the same for the reverse lookup by target product, also used to retire a product
+        db.Index("ix_recommendations_target_id", "product_target", "id"),
+        # only tombstones, finds the ones old enough to purge
+        db.Index("ix_recommendations_tombstones", "deleted_at", postgresql_where=is_deleted == 1,
+                 sqlite_where=is_deleted == 1),
+        # keeps each product's live rows of a relation ranked by dislikes, so top-N costs O(N)
+        db.Index("ix_recommendations_ranking", "product_origin", "relation", "is_deleted", "dislike", "id"),
+    )
+    # the ORM bumps version on every UPDATE and only updates the version it read
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<Recommendations %s %s %s id=[%s]>" % (self.product_origin, self.product_target, self.relation, self.id)
@@ -45,6 +126,64 @@ class Recommendations(db.Model):
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        list_cache.invalidate([(self.product_origin, self.relation)])
+
+    def upsert(self):
+        """
+        Creates the Recommendation, or brings back the deleted one with the same key
+
+        PostgreSQL does it with a single INSERT ... ON CONFLICT statement that
+        returns the stored row. Other databases insert, and read the existing
+        row when the unique index refuses the insert. Either way concurrent
+        identical creates end with one row. Returns the serialized stored
+        Recommendation, which is left as it is when it already existed
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Upserting %s %s %s", self.product_origin, self.product_target, self.relation)
+        if db.engine.dialect.name == "postgresql":
+            return self._upsert_on_conflict()
+        try:
+            self.create()
+            return self.serialize()
+        except IntegrityError:
+            db.session.rollback()
+        existing = Recommendations.query.filter_by(product_origin=self.product_origin,
+                                                   product_target=self.product_target,
+                                                   relation=self.relation).first()
+        if existing is None:
+            raise DuplicateRecommendationError("Recommendation from {} to {} with relation {} could not be stored"
+                                               .format(self.product_origin, self.product_target, self.relation))
+        if existing.is_deleted == 1:
+            existing.is_deleted = 0
+            existing.save()
+        return existing.serialize()
+
+    def _upsert_on_conflict(self):
+        """ Inserts the Recommendation or brings back its tombstone with one statement (PostgreSQL) """
+        table = self.__table__
+        columns = [table.c[column.key] for column in self.serialized_columns()]
+        statement = postgresql_insert(table).values(
+            product_origin=self.product_origin, product_target=self.product_target, relation=self.relation,
+            dislike=self.dislike, is_deleted=self.is_deleted,
+            deleted_at=datetime.utcnow() if self.is_deleted == 1 else None,
+        ).on_conflict_do_update(
+            index_elements=[table.c.product_origin, table.c.product_target, table.c.relation],
+            set_={"is_deleted": 0, "deleted_at": None, "version": table.c.version + 1},
+            # a live row is not written again
+            where=table.c.is_deleted == 1,
+        ).returning(*columns, literal_column("xmax = 0").label("inserted"))
+        row = db.session.execute(statement).first()
+        if row is None:
+            row = db.session.execute(select(columns).where(table.c.product_origin == self.product_origin)
+                                     .where(table.c.product_target == self.product_target)
+                                     .where(table.c.relation == self.relation)).first()
+            db.session.commit()
+            return dict(row)
+        stored = dict(row)
+        record_changes(db.session.connection(), "create" if stored.pop("inserted") else "update", [stored])
+        db.session.commit()
+        list_cache.invalidate([(self.product_origin, self.relation)])
+        return stored
 
     def update(self, payload):
         """
@@ -60,14 +199,47 @@ class Recommendations(db.Model):
         if "is_deleted" in payload:
             self.is_deleted = payload["is_deleted"]
         db.session.add(self)
-        db.session.commit()
+        message = "Recommendation from {} to {} with relation {} already exists".format(
+            self.product_origin, self.product_target, self.relation)
+        pairs = self._cache_pairs()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise DuplicateRecommendationError(message)
+        except StaleDataError:
+            db.session.rollback()
+            raise StaleRecommendationError("Recommendation with id '{}' was changed by another request".format(self.id))
+        list_cache.invalidate(pairs)
 
     def save(self):
         """
         Updates a Recommendation to the database
         """
-        logger.info("Saving %s %s %s", self.product_origin, self.product_target, self.relation)
-        db.session.commit()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Saving %s %s %s", self.product_origin, self.product_target, self.relation)
+        pairs = self._cache_pairs()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise StaleRecommendationError("Recommendation with id '{}' was changed by another request".format(self.id))
+        list_cache.invalidate(pairs)
+
+    def soft_delete(self):
+        """ Marks a Recommendation as deleted, it stays in the database as a tombstone """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deleting %s %s %s", self.product_origin, self.product_target, self.relation)
+        if self.is_deleted == 0:
+            self.is_deleted = 1
+            self.save()
+
+    def _cache_pairs(self):
+        """ Returns every (product_origin, relation) of this row before and after its pending changes """
+        state = inspect(self)
+        origins = state.attrs.product_origin.history.sum() or [self.product_origin]
+        relations = state.attrs.relation.history.sum() or [self.relation]
+        return [(origin, relation) for origin in origins for relation in relations]
 
     # def delete(self):
     #     """ Removes a Recommendation from the data store """
@@ -78,7 +250,8 @@ class Recommendations(db.Model):
     def serialize(self):
         """ Serializes a Recommendation into a dictionary """
         return {"id": self.id, "product_origin": self.product_origin, "product_target": self.product_target,
-                "relation": self.relation, "dislike": self.dislike, "is_deleted": self.is_deleted}
+                "relation": self.relation, "dislike": self.dislike, "is_deleted": self.is_deleted,
+                "version": self.version}
 
     def deserialize(self, data):
         """
@@ -133,51 +306,698 @@ class Recommendations(db.Model):
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        list_cache.init_app(app)
         app.app_context().push()
+        pool_metrics.init_engine(db.engine)
+        try:
+            # migrations only add to the schema, so a newer one works as well
+            stored = cls.stored_schema_version()
+            if stored is not None and stored >= SCHEMA_VERSION:
+                return
+            if app.config.get("DB_SCHEMA_MODE") == "verify":
+                raise SchemaVersionError("The database schema is at version {}, version {} is needed: run the "
+                                         "migrations".format(stored, SCHEMA_VERSION))
+            cls.migrate()
+        finally:
+            # hand the connection back: with --preload it would be shared by the forked workers
+            db.session.remove()
+
+    @classmethod
+    def migrate(cls):
+        """ Brings the database schema up to SCHEMA_VERSION and records it """
+        logger.info("Migrating the database schema to version %s", SCHEMA_VERSION)
         db.create_all()  # make our sqlalchemy tables
+        cls.create_missing_columns()
+        cls.create_missing_indexes()
+        with db.engine.begin() as connection:
+            connection.execute(schema_version.delete())
+            connection.execute(schema_version.insert(), {"version": SCHEMA_VERSION})
+
+    @staticmethod
+    def stored_schema_version():
+        """ Returns the version the database schema was last migrated to, None when it was never recorded """
+        try:
+            return db.session.execute(select([db.func.max(schema_version.c.version)])).scalar()
+        except (OperationalError, ProgrammingError):
+            # the table does not exist yet
+            db.session.rollback()
+            return None
+
+    @classmethod
+    def create_missing_columns(cls):
+        """
+        Adds any column declared on the table that the database does not have yet
+
+        New columns must be nullable or have a server default so existing rows
+        get a value
+        """
+        existing = {column["name"] for column in inspect(db.engine).get_columns(cls.__tablename__)}
+        for column in cls.__table__.columns:
+            if column.name in existing:
+                continue
+            logger.info("Adding column %s", column.name)
+            ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            db.engine.execute("ALTER TABLE {} ADD COLUMN {}".format(cls.__tablename__, ddl))
+
+    @classmethod
+    def create_missing_indexes(cls):
+        """
+        Creates any index declared on the table that the database does not have yet
+
+        create_all() only creates missing tables, so databases created before an
+        index was declared are upgraded here
+        """
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(cls.__tablename__)}
+        for index in cls.__table__.indexes:
+            if index.name in existing:
+                continue
+            logger.info("Creating index %s", index.name)
+            try:
+                index.create(bind=db.engine)
+            except Exception as error:  # pylint: disable=broad-except
+                # e.g. duplicate rows blocking the unique index, see migrations/
+                logger.error("Cannot create index %s: %s", index.name, error)
 
     @classmethod
     def all(cls):
         """ Returns all of the Recommendation in the database """
-        logger.info("Processing all Recommendation")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing all Recommendation")
         return cls.query.all()
 
     @classmethod
     def find_by_id(cls, by_id):
         """ Finds a Recommendation by it's ID """
-        logger.info("Processing lookup for id %s ...", by_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
     @classmethod
-    def find_by_attributes(cls, origin, target, relation):
-        """ Finds a Recommendation by it's ID """
-        logger.info("Processing lookup for origin %s target %s relation %s ...", origin, target, relation)
-        result = cls.query
+    def find_row_by_id(cls, by_id):
+        """ Finds a Recommendation by it's ID as a lightweight row (see find_live_by_attributes) """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing row lookup for id %s ...", by_id)
+        return db.session.query(*cls.serialized_columns()).filter(cls.id == by_id).first()
+
+    @classmethod
+    def add_dislikes(cls, by_id, count=1):
+        """
+        Adds count to the dislike counter of a Recommendation
+
+        The increment runs in the database (dislike = dislike + count) so
+        concurrent dislikes are never lost. Returns the serialized
+        Recommendation, or None when there is no Recommendation with the id
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adding %s dislikes to id %s ...", count, by_id)
+        table = cls.__table__
+        columns = [table.c[column.key] for column in cls.serialized_columns()]
+        statement = table.update().where(table.c.id == by_id).values(dislike=table.c.dislike + count,
+                                                                     version=table.c.version + 1)
+        if db.engine.dialect.name == "postgresql":
+            row = db.session.execute(statement.returning(*columns)).first()
+        else:
+            result = db.session.execute(statement)
+            row = db.session.execute(select(columns).where(table.c.id == by_id)).first() if result.rowcount else None
+        if row:
+            record_changes(db.session.connection(), "dislike", [row])
+        db.session.commit()
+        if not row:
+            return None
+        list_cache.invalidate([(row["product_origin"], row["relation"])])
+        return dict(row)
+
+    @classmethod
+    def add_dislikes_many(cls, counts):
+        """
+        Adds dislikes to many Recommendations in one transaction
+
+        Args:
+            counts (dict): the number of dislikes to add keyed by id
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adding dislikes to %s Recommendations", len(counts))
+        table = cls.__table__
+        statement = table.update().where(table.c.id == bindparam("by_id")).values(
+            dislike=table.c.dislike + bindparam("count"), version=table.c.version + 1)
+        db.session.execute(statement, [{"by_id": by_id, "count": count} for by_id, count in counts.items()])
+        rows = [row._asdict() for row in db.session.query(*cls.serialized_columns()).filter(cls.id.in_(list(counts)))]
+        record_changes(db.session.connection(), "dislike", rows)
+        db.session.commit()
+        list_cache.invalidate([(row["product_origin"], row["relation"]) for row in rows])
+
+    @classmethod
+    def find_by_attributes(cls, origin, target, relation, limit=None, after_id=None):
+        """
+        Finds Recommendations by origin, target and relation ordered by id
+
+        Pass limit and after_id to read one page: the page starts after the id
+        of the last row of the previous page (keyset pagination)
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing lookup for origin %s target %s relation %s ...", origin, target, relation)
+        result = cls._filter_by_attributes(cls.query, origin, target, relation).order_by(cls.id)
+        return cls._paginate(result, limit, after_id).all()
+
+    @classmethod
+    def find_live_by_attributes(cls, origin, target, relation, limit=None, after_id=None):
+        """
+        Finds the Recommendations that are not deleted for the read path
+
+        The deleted filter runs in the database and only the serialized columns
+        are selected, so the result is a list of lightweight rows (use
+        row._asdict() to serialize) rather than ORM objects. Rows are ordered
+        by id and paginate like find_by_attributes
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing live lookup for origin %s target %s relation %s ...", origin, target, relation)
+        result = db.session.query(*cls.serialized_columns()).filter(cls.is_deleted == 0)
+        result = cls._filter_by_attributes(result, origin, target, relation).order_by(cls.id)
+        return cls._paginate(result, limit, after_id).all()
+
+    @classmethod
+    def find_live_by_origins(cls, origins, relation=None):
+        """
+        Finds the live Recommendations of many products with one IN query
+
+        Returns lightweight rows (see find_live_by_attributes) ordered by
+        product and id, so each product's rows are in the order of its list
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing live lookup for %s origins relation %s ...", len(origins), relation)
+        result = db.session.query(*cls.serialized_columns()).filter(cls.product_origin.in_(origins))
+        result = result.filter(cls.is_deleted == 0)
+        if relation:
+            result = result.filter(cls.relation == relation)
+        return result.order_by(cls.product_origin, cls.id).all()
+
+    @classmethod
+    def find_top(cls, origin, top, relations, weights=None):
+        """
+        Finds the top ranked live Recommendations of a product
+
+        A Recommendation scores weights[relation] / (1 + dislike), so within a
+        relation the least disliked rank first. The ranking index keeps every
+        relation in that order, so the top rows of each relation are read
+        with one bounded index scan each and merged here.
+
+        Args:
+            origin (int): the product to rank the Recommendations of
+            top (int): the number of Recommendations to return
+            relations (list): the relations to rank
+            weights (dict): the weight of each relation, 1.0 when missing
+
+        Returns the serialized Recommendations with their score, best first
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing top %s lookup for origin %s relations %s ...", top, origin, relations)
+        if not relations:
+            return []
+        weights = weights or {}
+        keys = [column.key for column in cls.serialized_columns()]
+        params = {"origin": origin, "top": top}
+        params.update(("relation_{}".format(number), relation) for number, relation in enumerate(relations))
+        recommendations = []
+        connection = db.session.connection().execution_options(compiled_cache=cls._top_compiled)
+        for row in connection.execute(cls._top_statement(len(relations)), params):
+            recommendation = dict(zip(keys, row))
+            recommendation["score"] = weights.get(row["relation"], 1.0) / (1 + row["dislike"])
+            recommendations.append(recommendation)
+        recommendations.sort(key=lambda item: (-item["score"], item["id"]))
+        return recommendations[:top]
+
+    @classmethod
+    def _top_statement(cls, relations):
+        """
+        Returns the UNION ALL of the top rows of each of `relations` relations
+
+        The statement only has bound parameters, so it is built once for each
+        number of relations and reused, and its compiled form is cached
+        """
+        statement = cls._top_statements.get(relations)
+        if statement is None:
+            table = cls.__table__
+            columns = [table.c[column.key] for column in cls.serialized_columns()]
+            ranked = [
+                select(columns).where(table.c.product_origin == bindparam("origin"))
+                .where(table.c.relation == bindparam("relation_{}".format(number))).where(table.c.is_deleted == 0)
+                .order_by(table.c.dislike, table.c.id).limit(bindparam("top")).alias()
+                for number in range(relations)
+            ]
+            statement = cls._top_statements[relations] = union_all(*[select([subquery]) for subquery in ranked])
+        return statement
+
+    @classmethod
+    def find_top_by_origins(cls, origins, top, relations, max_dislike=None):
+        """
+        Finds the least disliked live Recommendations of many products
+
+        Every product keeps at most `top` Recommendations of each relation,
+        picked in a single query with a window over the ranking index order
+
+        Args:
+            origins (list): the products to read the Recommendations of
+            top (int): the Recommendations kept per product and relation
+            relations (list): the relations to read
+            max_dislike (int): skip the Recommendations disliked more often
+
+        Returns the rows of Recommendations.serialized_columns() by product
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing top %s lookup for %s origins relations %s ...", top, len(origins), relations)
+        if not origins or not relations:
+            return []
+        table = cls.__table__
+        keys = [column.key for column in cls.serialized_columns()]
+        rank = func.row_number().over(partition_by=(table.c.product_origin, table.c.relation),
+                                      order_by=(table.c.dislike, table.c.id)).label("rank")
+        ranked = select([table.c[key] for key in keys] + [rank]) \
+            .where(table.c.product_origin.in_(origins)).where(table.c.relation.in_(relations)) \
+            .where(table.c.is_deleted == 0)
+        if max_dislike is not None:
+            ranked = ranked.where(table.c.dislike <= max_dislike)
+        ranked = ranked.alias()
+        statement = select([ranked.c[key] for key in keys]).where(ranked.c.rank <= top) \
+            .order_by(ranked.c.product_origin, ranked.c.dislike, ranked.c.id)
+        return db.session.execute(statement).fetchall()
+
+    @classmethod
+    def iter_all(cls, batch_size, include_deleted=False):
+        """
+        Iterates over every Recommendation as lightweight rows in id order
+
+        Rows are fetched batch_size at a time through a server-side cursor where
+        the database supports one, so memory stays flat whatever the table size
+        """
+        logger.info("Processing export of all Recommendation")
+        result = db.session.query(*cls.serialized_columns())
+        if not include_deleted:
+            result = result.filter(cls.is_deleted == 0)
+        return result.order_by(cls.id).execution_options(stream_results=True).yield_per(batch_size)
+
+    @classmethod
+    def serialized_columns(cls):
+        """ Returns the columns that serialize() writes, in the same order """
+        return [cls.id, cls.product_origin, cls.product_target, cls.relation, cls.dislike, cls.is_deleted,
+                cls.version]
+
+    @classmethod
+    def _paginate(cls, result, limit, after_id):
+        """ Restricts a query ordered by id to the page of rows after after_id """
+        if after_id:
+            result = result.filter(cls.id > after_id)
+        if limit:
+            result = result.limit(limit)
+        return result
+
+    @classmethod
+    def _filter_by_attributes(cls, result, origin, target, relation):
+        """ Adds the origin, target and relation filters that are set to a query """
         if origin:
             result = result.filter(cls.product_origin == origin)
         if target:
             result = result.filter(cls.product_target == target)
         if relation:
             result = result.filter(cls.relation == relation)
-        return result.all()
+        return result
 
-    # @classmethod
-    # def find_by_attributes_for_delete(cls, product_id):
-    #     """ Finds all YourResourceModels by product_id """
-    #     logger.info("Processing lookup for all rows contian %s ...", product_id)
-    #     result = cls.query
-    #     result1 = result.filter(cls.product_origin == product_id)
-    #     result2 = result.filter(cls.product_target == product_id)
-    #     return result1.all()+result2.all()
+    @classmethod
+    def retire_product(cls, product_id):
+        """
+        Soft deletes every live Recommendation from or to a product
+
+        Used when a product is discontinued: a single UPDATE marks the rows
+        where the product is the origin or the target as deleted. Returns the
+        number of Recommendations retired
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Retiring product %s ...", product_id)
+        table = cls.__table__
+        columns = [table.c[column.key] for column in cls.serialized_columns()]
+        touches = (table.c.product_origin == product_id) | (table.c.product_target == product_id)
+        statement = table.update().where(touches).where(table.c.is_deleted == 0).values(
+            is_deleted=1, deleted_at=datetime.utcnow(), version=table.c.version + 1)
+        if db.engine.dialect.name == "postgresql":
+            rows = [dict(row) for row in db.session.execute(statement.returning(*columns))]
+        else:
+            rows = [dict(row, is_deleted=1, version=row["version"] + 1)
+                    for row in db.session.execute(select(columns).where(touches).where(table.c.is_deleted == 0))]
+            db.session.execute(statement)
+        record_changes(db.session.connection(), "delete", rows)
+        db.session.commit()
+        list_cache.invalidate([(row["product_origin"], row["relation"]) for row in rows])
+        return len(rows)
 
     @classmethod
     def find_or_404(cls, by_id):
         """ Find a Recommendation by it's id """
-        logger.info("Processing lookup or 404 for id %s ...", by_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing lookup or 404 for id %s ...", by_id)
         return cls.query.get_or_404(by_id)
 
     @classmethod
-    def remove_all(cls):
-        """ Removes all documents from the database """
-        cls.query.delete()
+    def bulk_upsert(cls, recommendations, batch_size=1000):
+        """
+        Creates many Recommendations in a single transaction
+
+        Like a single create, a recommendation that already exists is returned
+        as it is and a deleted one is brought back. Returns the serialized
+        stored recommendations in the same order as recommendations.
+        """
+        logger.info("Processing bulk upsert of %s Recommendations", len(recommendations))
+        keys = [cls._key(recommendation) for recommendation in recommendations]
+        # ON CONFLICT cannot touch the same row twice in one statement
+        unique = list(dict(zip(keys, recommendations)).values())
+        stored = {}
+        try:
+            for start in range(0, len(unique), batch_size):
+                batch = unique[start:start + batch_size]
+                if db.engine.dialect.name == "postgresql":
+                    rows = cls._upsert_batch_on_conflict(batch)
+                else:
+                    rows = cls._upsert_batch(batch)
+                stored.update(((row["product_origin"], row["product_target"], row["relation"]), row)
+                              for row in rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        list_cache.invalidate({(origin, relation) for origin, _, relation in stored})
+        return [stored[key] for key in keys]
+
+    @classmethod
+    def _upsert_batch_on_conflict(cls, recommendations):
+        """ Upserts a batch with one INSERT ... ON CONFLICT statement (PostgreSQL) """
+        table = cls.__table__
+        now = datetime.utcnow()
+        statement = postgresql_insert(table).values([
+            {"product_origin": recommendation.product_origin, "product_target": recommendation.product_target,
+             "relation": recommendation.relation, "dislike": recommendation.dislike,
+             "is_deleted": recommendation.is_deleted,
+             # the mapper events that stamp deleted_at do not run for Core statements
+             "deleted_at": now if recommendation.is_deleted == 1 else None}
+            for recommendation in recommendations
+        ])
+        columns = [table.c[column.key] for column in cls.serialized_columns()]
+        key_columns = [table.c.product_origin, table.c.product_target, table.c.relation]
+        statement = statement.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={"is_deleted": 0, "deleted_at": None, "version": table.c.version + 1},
+            # a live row is not written again, so it leaves no dead tuple behind
+            where=table.c.is_deleted == 1,
+        ).returning(*columns,
+                    # xmax is 0 on rows this statement inserted
+                    literal_column("xmax = 0").label("inserted"))
+        rows = []
+        written = {True: [], False: []}
+        for row in db.session.execute(statement):
+            row = dict(row)
+            written[row.pop("inserted")].append(row)
+            rows.append(row)
+        # only the inserted and the revived rows are returned, so only they are logged
+        record_changes(db.session.connection(), "create", written[True])
+        record_changes(db.session.connection(), "update", written[False])
+        if len(rows) < len(recommendations):
+            # the live rows are not returned, read them as they are
+            returned = {(row["product_origin"], row["product_target"], row["relation"]) for row in rows}
+            missing = [key for key in map(cls._key, recommendations) if key not in returned]
+            rows.extend(dict(row) for row in db.session.execute(
+                select(columns).where(tuple_(*key_columns).in_(missing))))
+        return rows
+
+    @classmethod
+    def _upsert_batch(cls, recommendations):
+        """ Upserts a batch with a lookup then inserts, for databases without ON CONFLICT support """
+        origins = {recommendation.product_origin for recommendation in recommendations}
+        existing = {cls._key(recommendation): recommendation
+                    for recommendation in cls.query.filter(cls.product_origin.in_(origins))}
+        stored = []
+        for recommendation in recommendations:
+            found = existing.get(cls._key(recommendation))
+            if found is None:
+                recommendation.id = None
+                db.session.add(recommendation)
+                found = recommendation
+            elif found.is_deleted == 1:
+                found.is_deleted = 0
+            stored.append(found)
+        db.session.flush()
+        return [recommendation.serialize() for recommendation in stored]
+
+    @staticmethod
+    def _key(recommendation):
+        """ Returns the (origin, target, relation) that identifies a Recommendation """
+        return (recommendation.product_origin, recommendation.product_target, recommendation.relation)
+
+    @classmethod
+    def purge_deleted(cls, retention, batch_size=1000, pause=0.0, progress=None):
+        """
+        Hard deletes the tombstones that were deleted more than retention ago
+
+        Tombstones are removed batch_size at a time, each batch in its own
+        short transaction with a pause in between, so locks are never held
+        for long and other requests get through.
+
+        Args:
+            retention (timedelta): how long a tombstone is kept
+            batch_size (int): the most rows deleted per transaction
+            pause (float): seconds to wait between batches
+            progress (callable): called with the running total after each batch
+
+        Returns the number of rows purged
+        """
+        cutoff = datetime.utcnow() - retention
+        logger.info("Purging Recommendations deleted before %s", cutoff.isoformat())
+        table = cls.__table__
+        expired = select([table.c.id]).where(table.c.is_deleted == 1).where(table.c.deleted_at < cutoff)
+        # the row may have been brought back since it was selected
+        purged = cls._delete_in_batches(expired.order_by(table.c.deleted_at), table.c.is_deleted == 1,
+                                        batch_size, pause, progress)
+        logger.info("Purged %s deleted Recommendations", purged)
+        return purged
+
+    @classmethod
+    def find_changes(cls, since, limit=None):
+        """ Returns the change log entries after the seq since, oldest first, up to complete_seq() """
+        statement = select([changes]).where(changes.c.seq > since).order_by(changes.c.seq)
+        if db.engine.dialect.name == "postgresql":
+            statement = statement.where(changes.c.seq <= cls.complete_seq())
+        if limit:
+            statement = statement.limit(limit)
+        return db.session.execute(statement).fetchall()
+
+    @staticmethod
+    def complete_seq():
+        """
+        Returns the seq up to which the change log will not change any more
+
+        Writers append to the change log concurrently, so on PostgreSQL a
+        smaller seq can still be in flight when a bigger one is committed.
+        Each call reads the newest seq and the transactions in flight in the
+        same snapshot (see ChangeLogHorizon). Other databases serialize the
+        writes, so every committed seq is complete.
+        """
+        if db.engine.dialect.name != "postgresql":
+            return db.session.execute(select([func.max(changes.c.seq)])).scalar() or 0
+        newest, in_flight = db.session.execute(select([
+            select([func.max(changes.c.seq)]).as_scalar(),
+            func.array(select([func.txid_snapshot_xip(func.txid_current_snapshot())]).as_scalar()),
+        ])).first()
+        return change_log_horizon.observe(newest or 0, in_flight)
+
+    @staticmethod
+    def change_log_bounds():
+        """ Returns the oldest and the newest seq in the change log, (None, None) when it is empty """
+        return tuple(db.session.execute(select([func.min(changes.c.seq), func.max(changes.c.seq)])).first())
+
+    @staticmethod
+    def purged_seq():
+        """ Returns the highest seq purged from the change log, 0 when nothing was purged """
+        return db.session.execute(select([func.max(changes_purged.c.seq)])).scalar() or 0
+
+    @staticmethod
+    def purge_changes(retention):
+        """
+        Deletes the change log entries up to the newest one older than retention
+
+        The newest entry is always kept and the highest seq deleted is
+        recorded (see purged_seq), so a consumer that fell further behind can
+        tell it missed entries. Returns the number of entries deleted
+        """
+        cutoff = datetime.utcnow() - retention
+        newest = select([func.max(changes.c.seq)]).as_scalar()
+        through = db.session.execute(select([func.max(changes.c.seq)]).where(changes.c.changed_at < cutoff)
+                                     .where(changes.c.seq < newest)).scalar()
+        purged = 0
+        if through is not None:
+            purged = db.session.execute(changes.delete().where(changes.c.seq <= through)).rowcount
+            db.session.execute(changes_purged.delete())
+            db.session.execute(changes_purged.insert(), {"seq": through})
         db.session.commit()
+        logger.info("Purged %s change log entries from before %s", purged, cutoff.isoformat())
+        return purged
+
+    @classmethod
+    def remove_all(cls, batch_size=10000, pause=0.0, progress=None):
+        """
+        Removes all Recommendations from the database
+
+        PostgreSQL empties the table with TRUNCATE and SQLite with a DELETE
+        without a WHERE clause, which it runs as a truncate. Both only hold
+        their lock for a moment whatever the table size. Other databases
+        delete the rows that exist when the reset starts batch_size at a
+        time, each batch in its own transaction (see purge_deleted), so
+        readers and writers are never blocked for the whole reset.
+
+        Returns the number of rows removed. On PostgreSQL it is the planner's
+        estimate of the table size: counting would hold the writers off for
+        a scan of the whole table
+        """
+        logger.info("Removing all Recommendations")
+        table = cls.__table__
+        dialect = db.engine.dialect.name
+        if dialect == "postgresql":
+            # reltuples is -1 for a table that was never analyzed
+            removed = int(db.session.execute(
+                db.text("SELECT GREATEST(reltuples, 0) FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+                {"name": table.name}).scalar() or 0)
+            db.session.execute("TRUNCATE TABLE {}".format(table.name))
+            record_changes(db.session.connection(), "reset", [None])
+            db.session.commit()
+        elif dialect == "sqlite":
+            removed = db.session.execute(table.delete()).rowcount
+            record_changes(db.session.connection(), "reset", [None])
+            db.session.commit()
+        else:
+            last_id = db.session.query(db.func.max(cls.id)).scalar() or 0
+            existing = select([table.c.id]).where(table.c.id <= last_id).order_by(table.c.id)
+            # logged first so that consumers drop their copy before the batches commit
+            record_changes(db.session.connection(), "reset", [None])
+            db.session.commit()
+            removed = cls._delete_in_batches(existing, None, batch_size, pause, progress)
+        list_cache.clear()
+        return removed
+
+    @classmethod
+    def _delete_in_batches(cls, ids, condition, batch_size, pause, progress):
+        """
+        Deletes the rows whose ids the ids statement selects, batch_size at a time
+
+        Every batch is its own transaction and condition, when given, is checked
+        again as the rows are deleted. progress is called with the running
+        total after each batch. Returns the number of rows deleted
+        """
+        table = cls.__table__
+        deleted = 0
+        while True:
+            batch = [row.id for row in db.session.execute(ids.limit(batch_size))]
+            if batch:
+                statement = table.delete().where(table.c.id.in_(batch))
+                if condition is not None:
+                    statement = statement.where(condition)
+                deleted += db.session.execute(statement).rowcount
+            db.session.commit()
+            if progress is not None and batch:
+                progress(deleted)
+            if len(batch) < batch_size:
+                return deleted
+            if pause:
+                time.sleep(pause)
+
+
+@event.listens_for(Recommendations, "before_insert")
+@event.listens_for(Recommendations, "before_update")
+def track_deleted_at(mapper, connection, target):  # pylint: disable=unused-argument
+    """ Stamps deleted_at when a Recommendation is deleted and clears it when it is brought back """
+    if target.is_deleted == 1 and target.deleted_at is None:
+        target.deleted_at = datetime.utcnow()
+    elif target.is_deleted != 1 and target.deleted_at is not None:
+        target.deleted_at = None
+
+
+@event.listens_for(Recommendations, "after_insert")
+def log_insert(mapper, connection, target):  # pylint: disable=unused-argument
+    """ Logs the creation of a Recommendation in the change log """
+    record_changes(connection, "create", [target.serialize()])
+
+
+@event.listens_for(Recommendations, "after_update")
+def log_update(mapper, connection, target):
+    """ Logs a change of a Recommendation, or its deletion, in the change log """
+    state = inspect(target)
+    # objects flushed without a net change are not updated
+    if not any(state.attrs[column.key].history.has_changes() for column in mapper.column_attrs):
+        return
+    deleted = state.attrs.is_deleted.history
+    operation = "delete" if target.is_deleted == 1 and deleted.deleted and deleted.deleted[0] != 1 else "update"
+    record_changes(connection, operation, [target.serialize()])
+
+
+def record_changes(connection, operation, rows):
+    """
+    Appends the new state of rows to the change log on the connection of the write
+
+    Writers do not wait on each other. On PostgreSQL the transaction is given
+    its id before it takes a seq, which ChangeLogHorizon relies on to find
+    the seqs still in flight. A reset is logged with the single row None.
+    """
+    if not rows:
+        return
+    if connection.dialect.name == "postgresql":
+        connection.execute(select([func.txid_current()]))
+    now = datetime.utcnow()
+    entries = []
+    for row in rows:
+        entry = {"operation": operation, "changed_at": now, "recommendation_id": None, "product_origin": None,
+                 "product_target": None, "relation": None, "dislike": None, "is_deleted": None, "version": None}
+        if row is not None:
+            entry.update((key, row[key]) for key in ("product_origin", "product_target", "relation", "dislike",
+                                                     "is_deleted", "version"))
+            entry["recommendation_id"] = row["id"]
+        entries.append(entry)
+    connection.execute(changes.insert(), entries)
+
+
+class ChangeLogHorizon:
+    """
+    Finds the seq up to which the change log is complete on PostgreSQL
+
+    A writer has its transaction id before it takes a seq. So when a snapshot
+    shows newest as the biggest committed seq, every transaction holding a
+    smaller one either finished or is among the in-flight ids of that
+    snapshot. Once none of those ids is in flight any more, newest is
+    complete. A snapshot without any transaction in flight is complete at
+    once. The snapshots are kept per process, so every reader only waits
+    for the writers it saw in flight.
+    """
+
+    def __init__(self):
+        self.complete = 0
+        self._pending = []  # (newest, in-flight ids) of the snapshots not complete yet, oldest first
+        self._lock = threading.Lock()
+
+    def observe(self, newest, in_flight):
+        """ Records the newest seq and in-flight transaction ids of a snapshot, returns the complete seq """
+        in_flight = frozenset(in_flight or ())
+        with self._lock:
+            if newest < self.complete:
+                # the change log was created again
+                self.complete, self._pending = 0, []
+            # a complete snapshot also completes the older ones
+            finished = [number for number, (_, ids) in enumerate(self._pending) if not ids & in_flight]
+            if finished:
+                self.complete = max(self.complete, self._pending[finished[-1]][0])
+                del self._pending[:finished[-1] + 1]
+            if newest > self.complete and self._pending and self._pending[-1][0] == newest:
+                # a writer of the seqs up to newest was in flight in both snapshots
+                in_flight &= self._pending.pop()[1]
+            if not in_flight:
+                self.complete, self._pending = max(self.complete, newest), []
+            elif newest > self.complete:
+                self._pending.append((newest, in_flight))
+                del self._pending[:-HORIZON_OBSERVATIONS]
+            return self.complete
+
+
+# The complete seq of the change log as this process last saw it
+change_log_horizon = ChangeLogHorizon()
@@ -0,0 +1,65 @@
+"""
+Connection pool metrics
+
+Counts the connection pool events of the SQLAlchemy engine and reports the
+pool gauges. Other modules can register a hook to be called on every event.
+"""
+import threading
+import logging
+from sqlalchemy import event
+
+logger = logging.getLogger("flask.app")
+
+EVENTS = ("connect", "checkout", "checkin", "invalidate")
+
+
+class PoolMetrics:
+    """ Counts the pool events of an engine and reports its gauges """
+
+    def __init__(self):
+        self.engine = None
+        self.counts = dict.fromkeys(EVENTS, 0)
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def init_engine(self, engine):
+        """ Starts listening to the pool events of the engine """
+        if self.engine is engine:
+            return
+        self.engine = engine
+        for name in EVENTS:
+            event.listen(engine, name, self._listener(name))
+
+    def add_hook(self, hook):
+        """ Calls hook(event_name, metrics) after every pool event """
+        self._hooks.append(hook)
+
+    def snapshot(self):
+        """ Returns the pool gauges and the event counters """
+        pool = self.engine.pool if self.engine is not None else None
+        gauges = {"pool": type(pool).__name__ if pool is not None else None}
+        # only QueuePool keeps a fixed number of connections
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            gauge = getattr(pool, name, None)
+            gauges[name] = gauge() if callable(gauge) else None
+        with self._lock:
+            gauges.update(self.counts)
+        return gauges
+
+    def _listener(self, name):
+        """ Returns the event listener for the named pool event """
+
+        def listener(*_):
+            with self._lock:
+                self.counts[name] += 1
+            for hook in self._hooks:
+                try:
+                    hook(name, self)
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.error("Pool metrics hook failed: %s", error)
+
+        return listener
+
+
+# The metrics of the service engine, set up by Recommendations.init_db()
+pool_metrics = PoolMetrics()
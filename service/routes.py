@@ -6,17 +6,34 @@ Describe what your service does here
 
 import os
 import sys
+import time
+import json
+import hashlib
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort, request
+from datetime import timedelta
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, request, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Recommendations, DataValidationError
+from service.models import Recommendations, DataValidationError, DuplicateRecommendationError, \
+    StaleRecommendationError, CHANGE_OPERATIONS, db
+from service.dislikes import dislike_buffer
+from service.cache import list_cache, idempotency_store
+from service.pool import pool_metrics
+from service.metrics import metrics
+from service.logs import request_log
+from service.graph import graph_engine
+from service.expansion import expand
+from service import encoding
 
 # Import Flask application
 from . import app
 
+# Times a PUT or DELETE without If-Match is tried on a Recommendation that keeps changing under it
+WRITE_ATTEMPTS = 3
+
 
 ######################################################################
 # GET INDEX
@@ -31,6 +48,15 @@ def index():
     return app.send_static_file("index.html")
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def get_metrics():
+    """ Returns the service metrics in the Prometheus text format """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -63,14 +89,93 @@ recommendation_model = api.inherit(
     {
         'id': fields.Integer(readOnly=True,
                              description='The unique id assigned internally by service'),
+        'version': fields.Integer(readOnly=True,
+                                  description='Increases on every change, the ETag is built from it'),
     }
 )
 
+ranked_model = api.inherit(
+    'RankedRecommendationModel',
+    recommendation_model,
+    {
+        'score': fields.Float(readOnly=True,
+                              description='The weight of the relation divided by 1 + dislike, higher ranks first'),
+    }
+)
+
+expansion_model = api.model('ExpandedProductModel', {
+    'product_id': fields.Integer(readOnly=True, description='The ID of the reached Product'),
+    'depth': fields.Integer(readOnly=True, description='The number of hops from the Origin Product'),
+    'score': fields.Float(readOnly=True, description='The product of the scores of the hops, higher first'),
+    'relation': fields.Integer(readOnly=True, description='The relation of the last hop'),
+    'path': fields.List(fields.Integer, readOnly=True,
+                        description='The Products from the Origin Product to the reached one'),
+})
+
+change_model = api.model('RecommendationChangeModel', {
+    'seq': fields.Integer(readOnly=True, description='The position of the change in the change log'),
+    'operation': fields.String(readOnly=True, enum=list(CHANGE_OPERATIONS), description='What changed'),
+    'recommendation_id': fields.Integer(readOnly=True, description='The Recommendation changed, null on reset'),
+    'product_origin': fields.Integer(readOnly=True),
+    'product_target': fields.Integer(readOnly=True),
+    'relation': fields.Integer(readOnly=True),
+    'dislike': fields.Integer(readOnly=True),
+    'is_deleted': fields.Integer(readOnly=True),
+    'version': fields.Integer(readOnly=True, description='The version of the Recommendation after the change'),
+    'changed_at': fields.DateTime(readOnly=True),
+})
+
+changes_page_model = api.model('RecommendationChangesModel', {
+    'changes': fields.List(fields.Nested(change_model), readOnly=True),
+    'last_seq': fields.Integer(readOnly=True, description='Pass as since to read the following changes'),
+})
+
 # query string arguments
 recommendation_args = reqparse.RequestParser()
 recommendation_args.add_argument('product-id', type=int, required=False,
                                  help='List Recommendations by Origin Product')
+recommendation_args.add_argument('target-id', type=int, required=False,
+                                 help='List Recommendations by Target Product')
 recommendation_args.add_argument('relation', type=int, required=False, help='List Recommendations by relation')
+recommendation_args.add_argument('limit', type=inputs.positive, required=False,
+                                 help='Return at most this many Recommendations (one page)')
+recommendation_args.add_argument('after-id', type=int, required=False,
+                                 help='Return the page after the Recommendation with this id (next cursor)')
+
+ranking_args = reqparse.RequestParser()
+ranking_args.add_argument('top', type=inputs.positive, required=False, default=10,
+                          help='Return this many of the best ranked Recommendations')
+ranking_args.add_argument('relation', type=int, required=False, help='Rank only the Recommendations of a relation')
+
+expansion_args = reqparse.RequestParser()
+expansion_args.add_argument('depth', type=inputs.positive, required=False, default=2,
+                            help='Follow Recommendations up to this many hops away')
+expansion_args.add_argument('relation', type=int, action='append', required=False,
+                            help='Follow only the Recommendations of these relations')
+expansion_args.add_argument('fan-out', type=inputs.positive, required=False, default=10,
+                            help='Follow at most this many of the best ranked Recommendations of each product')
+expansion_args.add_argument('max-dislike', type=inputs.natural, required=False,
+                            help='Skip the Recommendations disliked more often than this')
+expansion_args.add_argument('limit', type=inputs.positive, required=False, default=100,
+                            help='Return this many of the best scored products')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=inputs.natural, required=False, default=0,
+                          help='Return the changes after this seq, the last_seq of the previous response')
+changes_args.add_argument('limit', type=inputs.positive, required=False, default=100,
+                          help='Return at most this many changes')
+changes_args.add_argument('wait', type=inputs.natural, required=False, default=0,
+                          help='Wait up to this many seconds for a change when there is none yet, '
+                               'on the gevent workers only')
+
+batch_args = reqparse.RequestParser()
+batch_args.add_argument('product-id', type=int, action='append', required=True,
+                        help='An Origin Product to list the Recommendations of, repeat it for every product')
+batch_args.add_argument('relation', type=int, required=False, help='List Recommendations by relation')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('include-deleted', type=inputs.boolean, required=False, default=False,
+                         help='Also export deleted Recommendations')
 
 
 ######################################################################
@@ -88,6 +193,30 @@ def request_validation_error(error):
            }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(DuplicateRecommendationError)
+def duplicate_recommendation_error(error):
+    """ Handles writes that would duplicate an existing Recommendation """
+    message = str(error)
+    app.logger.error(message)
+    return {
+               'status_code': status.HTTP_409_CONFLICT,
+               'error': 'Conflict',
+               'message': message
+           }, status.HTTP_409_CONFLICT
+
+
+@api.errorhandler(StaleRecommendationError)
+def stale_recommendation_error(error):
+    """ Handles writes based on a version of a Recommendation that is no longer current """
+    message = str(error)
+    app.logger.error(message)
+    return {
+               'status_code': status.HTTP_412_PRECONDITION_FAILED,
+               'error': 'Precondition Failed',
+               'message': message
+           }, status.HTTP_412_PRECONDITION_FAILED
+
+
 ######################################################################
 #  PATH: /recommendations/{id}
 ######################################################################
@@ -108,17 +237,23 @@ class RecommendationResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_recommendations')
     @api.response(404, 'Recommendation not found')
-    @api.marshal_with(recommendation_model)
+    @api.response(304, 'Recommendation not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', recommendation_model)
+    @api.header('ETag', 'Changes whenever the Recommendation changes')
     def get(self, recommendation_id):
         """
         Retrieve a single Recommendation
         This endpoint will return a Recommendation based on it's id
         """
-        app.logger.info("Request for recommendation with id: %s", recommendation_id)
-        recommendation = Recommendations.find_by_id(recommendation_id)
-        if not recommendation:
+        app.logger.debug("Request for recommendation with id: %s", recommendation_id)
+        row = Recommendations.find_row_by_id(recommendation_id)
+        if not row:
             abort(status.HTTP_404_NOT_FOUND, "Recommendation with id '{}' was not found.".format(recommendation_id))
-        return recommendation.serialize(), status.HTTP_200_OK
+        etag = recommendation_etag(row)
+        headers = {'ETag': quote_etag(etag)}
+        if request.if_none_match.contains_weak(etag):
+            return '', status.HTTP_304_NOT_MODIFIED, headers
+        return json_response(row._asdict(), status.HTTP_200_OK, headers)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING RECOMMENDATION
@@ -126,6 +261,8 @@ class RecommendationResource(Resource):
     @api.doc('update_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted Recommendation data was not valid')
+    @api.response(409, 'A Recommendation with the same origin, target and relation exists')
+    @api.response(412, 'The Recommendation changed since the ETag in If-Match')
     @api.expect(recommendation_model)
     @api.marshal_with(recommendation_model)
     def put(self, recommendation_id):
@@ -134,14 +271,18 @@ class RecommendationResource(Resource):
 
         This endpoint will update a Recommendation based the body that is posted
         """
-        app.logger.info('Request to Update a recommendation with id [%s]', recommendation_id)
-        recommendation = Recommendations.find_by_id(recommendation_id)
-        if recommendation:
+        app.logger.debug('Request to Update a recommendation with id [%s]', recommendation_id)
+
+        def update(recommendation):
             recommendation.deserialize(api.payload)
             if not recommendation.product_origin or not recommendation.product_target or not recommendation.relation:
                 abort(status.HTTP_400_BAD_REQUEST, 'The posted Recommendation data was not valid')
             recommendation.update(api.payload)
-            return recommendation.serialize(), status.HTTP_200_OK
+
+        recommendation = write_recommendation(recommendation_id, update)
+        if recommendation:
+            headers = {'ETag': quote_etag(recommendation_etag(recommendation))}
+            return recommendation.serialize(), status.HTTP_200_OK, headers
         else:
             abort(status.HTTP_404_NOT_FOUND, "Recommendation with id '{}' was not found.".format(recommendation_id))
 
@@ -150,19 +291,16 @@ class RecommendationResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('delete_recommendations')
     @api.response(204, 'Recommendation deleted')
+    @api.response(412, 'The Recommendation changed since the ETag in If-Match')
     def delete(self, recommendation_id):
         """
         Delete a Recommendation
 
         This endpoint will delete a Recommendation based the id specified in the path
         """
-        app.logger.info('Request to Delete a recommendation with id [%s]', recommendation_id)
-        recommendation = Recommendations.find_by_id(recommendation_id)
-        if recommendation:
-            if recommendation.is_deleted == 0:
-                recommendation.is_deleted = 1
-                recommendation.save()
-            app.logger.info('Recommendation with id [%s] was deleted', recommendation_id)
+        app.logger.debug('Request to Delete a recommendation with id [%s]', recommendation_id)
+        if write_recommendation(recommendation_id, Recommendations.soft_delete):
+            app.logger.debug('Recommendation with id [%s] was deleted', recommendation_id)
 
         return '', status.HTTP_204_NO_CONTENT
 
@@ -178,48 +316,255 @@ class RecommendationCollection(Resource):
     # LIST ALL RECOMMENDATIONS
     # ------------------------------------------------------------------
     @api.doc('list_recommendations')
+    @api.header('Link', 'URL of the next page when limit was given and more Recommendations remain')
+    @api.header('ETag', 'Changes whenever a Recommendation in the list changes')
+    @api.response(304, 'List not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [recommendation_model])
     @api.expect(recommendation_args, validate=True)
-    @api.marshal_list_with(recommendation_model)
     def get(self):
         """ Returns all of the Recommendations """
-        app.logger.info('Request to list Recommendations...')
+        app.logger.debug('Request to list Recommendations...')
         args = recommendation_args.parse_args()
-        recommendationList = Recommendations.find_by_attributes(args['product-id'], 0, args['relation'])
-        recommendations = [recommendation.serialize() for recommendation in recommendationList if
-                           recommendation.is_deleted == 0]
-        app.logger.info('[%s] Recommendations returned', len(recommendations))
-        return recommendations, status.HTTP_200_OK
+        limit = min(args['limit'], app.config['MAX_PAGE_SIZE']) if args['limit'] else None
+        # only whole lists of one product are cached
+        cacheable = args['product-id'] and not args['target-id'] and not limit and not args['after-id']
+        cached = list_cache.get(args['product-id'], args['relation']) if cacheable else None
+        if cached is not None:
+            app.logger.debug('[%s] Recommendations returned from cache', cached['count'])
+            return list_response(cached['body'], cached['etag'])
+        rows = graph_engine.lookup(args['product-id'], args['relation']) if cacheable and graph_engine.enabled else None
+        if rows is not None:
+            # not cached: the graph may be older than the last write, which invalidated the cache
+            entry = list_entry(rows)
+            app.logger.debug('[%s] Recommendations returned from the graph', entry['count'])
+            return list_response(entry['body'], entry['etag'])
+        # taken before the query: a write committing meanwhile keeps the list out of the cache
+        generation = list_cache.generations([args['product-id']], args['relation'])[0] if cacheable else None
+        # read one extra row to know whether there is a next page
+        rows = Recommendations.find_live_by_attributes(args['product-id'], args['target-id'], args['relation'],
+                                                       limit=limit + 1 if limit else None,
+                                                       after_id=args['after-id'])
+        headers = {}
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            headers = next_page_headers(args, rows[-1].id)
+        entry = list_entry(rows)
+        if cacheable:
+            list_cache.set(args['product-id'], args['relation'], entry, generation)
+        app.logger.debug('[%s] Recommendations returned', len(rows))
+        return list_response(entry['body'], entry['etag'], headers)
 
     # ------------------------------------------------------------------
     # ADD A NEW RECOMMENDATION
     # ------------------------------------------------------------------
-    @api.doc('create_recommendations')
+    @api.doc('create_recommendations', params={'Idempotency-Key': {
+        'in': 'header', 'type': 'string',
+        'description': 'Retries with the same key get the first response again instead of creating again'}})
     @api.response(400, 'The posted Recommendation data was not valid')
+    @api.response(422, 'The Idempotency-Key was used for a different Recommendation')
     @api.expect(create_model)
     @api.marshal_with(recommendation_model, code=201)
     def post(self):
         """
         Creates a Recommendation
 
-        This endpoint will create a Recommendation based the data in the body that is posted
+        This endpoint will create a Recommendation based the data in the body that is posted.
+        Posting an existing Recommendation returns it, a deleted one is brought back.
         """
-        app.logger.info("Request to create a recommendation")
+        app.logger.debug("Request to create a recommendation")
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            if not key or len(key) > 255:
+                abort(status.HTTP_400_BAD_REQUEST, 'The Idempotency-Key must have 1 to 255 characters')
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            replay = idempotency_store.get(key)
+            if replay is not None:
+                if replay['fingerprint'] != fingerprint:
+                    abort(status.HTTP_422_UNPROCESSABLE_ENTITY,
+                          'The Idempotency-Key was already used for a different Recommendation')
+                return replay['body'], status.HTTP_201_CREATED, {'Location': replay['location'],
+                                                                 'Idempotent-Replayed': 'true'}
         recommendation = Recommendations()
         recommendation.deserialize(api.payload)
         if not recommendation.product_origin or not recommendation.product_target or not recommendation.relation:
             abort(status.HTTP_400_BAD_REQUEST, 'The posted Recommendation data was not valid')
-        recommendationList = Recommendations.find_by_attributes(recommendation.product_origin,
-                                                                recommendation.product_target,
-                                                                recommendation.relation)
-        if len(recommendationList) == 0:
-            recommendation.create()
-        else:
-            recommendation = recommendationList[0]
-            if recommendation.is_deleted == 1:
-                recommendation.is_deleted = 0
-                recommendation.save()
-        location_url = api.url_for(RecommendationResource, recommendation_id=recommendation.id, _external=True)
-        return recommendation.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        stored = recommendation.upsert()
+        location_url = api.url_for(RecommendationResource, recommendation_id=stored['id'], _external=True)
+        if key is not None:
+            idempotency_store.set(key, {'fingerprint': fingerprint, 'body': stored, 'location': location_url})
+        return stored, status.HTTP_201_CREATED, {'Location': location_url}
+
+
+######################################################################
+#  PATH: /recommendations/bulk
+######################################################################
+@api.route('/recommendations/bulk')
+class BulkResource(Resource):
+    """ Creates many Recommendations in one request """
+
+    # ------------------------------------------------------------------
+    # ADD MANY RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('bulk_create_recommendations')
+    @api.response(400, 'The posted body was not a list of Recommendations')
+    @api.expect([create_model])
+    @api.response(200, 'One result per posted Recommendation, in order')
+    def post(self):
+        """
+        Creates many Recommendations
+
+        This endpoint takes a JSON array, or newline delimited JSON sent as
+        application/x-ndjson, and creates every valid Recommendation in one
+        transaction. Each result carries the status a single create would return.
+        """
+        app.logger.debug("Request to bulk create recommendations")
+        items = parse_bulk_body()
+        results = [None] * len(items)
+        valid = []
+        for index, data in enumerate(items):
+            try:
+                recommendation = Recommendations().deserialize(data)
+            except DataValidationError as error:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST, 'message': str(error)}
+                continue
+            if not recommendation.product_origin or not recommendation.product_target or not recommendation.relation:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST,
+                                  'message': 'The posted Recommendation data was not valid'}
+                continue
+            valid.append((index, recommendation))
+
+        stored = Recommendations.bulk_upsert([recommendation for _, recommendation in valid],
+                                             batch_size=app.config['BULK_BATCH_SIZE'])
+        for (index, _), recommendation in zip(valid, stored):
+            results[index] = {'status': status.HTTP_201_CREATED, 'recommendation': recommendation}
+        app.logger.debug('[%s] of [%s] Recommendations created', len(stored), len(items))
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/batch
+######################################################################
+@api.route('/recommendations/batch')
+class BatchResource(Resource):
+    """ Reads the Recommendations of many products at once """
+
+    # ------------------------------------------------------------------
+    # LIST THE RECOMMENDATIONS OF MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('batch_list_recommendations')
+    @api.response(400, 'Too many products were asked for')
+    @api.response(200, 'Success: a map of product-id to the list of its Recommendations')
+    @api.expect(batch_args, validate=True)
+    def get(self):
+        """
+        Returns the Recommendations of many products
+
+        The lists that are not cached are read with a single query, the
+        response maps every product-id to its list
+        """
+        app.logger.debug('Request to batch list Recommendations...')
+        args = batch_args.parse_args()
+        product_ids = list(dict.fromkeys(args['product-id']))
+        if len(product_ids) > app.config['BATCH_MAX_PRODUCTS']:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'At most {} products can be read at once'.format(app.config['BATCH_MAX_PRODUCTS']))
+        cached = list_cache.get_many(product_ids, args['relation'])
+        bodies = {product_id: entry['body'] for product_id, entry in zip(product_ids, cached) if entry is not None}
+        missing = [product_id for product_id in product_ids if product_id not in bodies]
+        if missing:
+            generations = dict(zip(missing, list_cache.generations(missing, args['relation'])))
+            grouped = {product_id: [] for product_id in missing}
+            for row in Recommendations.find_live_by_origins(missing, args['relation']):
+                grouped[row.product_origin].append(row)
+            for product_id, rows in grouped.items():
+                entry = list_entry(rows)
+                list_cache.set(product_id, args['relation'], entry, generations[product_id])
+                bodies[product_id] = entry['body']
+        app.logger.debug('Recommendations of [%s] products returned, [%s] from cache',
+                         len(product_ids), len(product_ids) - len(missing))
+        # the lists are already encoded, only the map around them is added
+        body = '{' + ','.join('"{}":{}'.format(product_id, bodies[product_id]) for product_id in product_ids) + '}'
+        return Response(body, status.HTTP_200_OK, mimetype='application/json')
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+@api.route('/recommendations/export')
+class ExportResource(Resource):
+    """ Streams every Recommendation for offline jobs """
+
+    # ------------------------------------------------------------------
+    # EXPORT ALL RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('export_recommendations')
+    @api.expect(export_args, validate=True)
+    @api.produces(['application/x-ndjson'])
+    @api.response(200, 'One JSON Recommendation per line')
+    @api.header('X-Last-Seq', 'The change log seq to read the changes after, taken before the export')
+    def get(self):
+        """
+        Export all Recommendations
+
+        This endpoint streams every Recommendation as newline delimited JSON.
+        X-Last-Seq is the complete change log seq before the first row was
+        read: reading the changes after it catches up on everything written
+        while the export streams, some of it maybe twice.
+        """
+        app.logger.debug('Request to export Recommendations...')
+        args = export_args.parse_args()
+        last_seq = Recommendations.complete_seq()
+        rows = Recommendations.iter_all(app.config['EXPORT_BATCH_SIZE'], include_deleted=args['include-deleted'])
+        lines = (json.dumps(row._asdict()) + '\n' for row in rows)
+        return Response(stream_with_context(lines), status=status.HTTP_200_OK, mimetype='application/x-ndjson',
+                        headers={'X-Last-Seq': str(last_seq)})
+
+
+######################################################################
+#  PATH: /recommendations/changes
+######################################################################
+@api.route('/recommendations/changes')
+class ChangesResource(Resource):
+    """ The change log of the Recommendations """
+
+    # ------------------------------------------------------------------
+    # READ THE CHANGES
+    # ------------------------------------------------------------------
+    @api.doc('list_recommendation_changes')
+    @api.response(200, 'Success', changes_page_model)
+    @api.response(400, 'wait was given but the workers cannot hold requests')
+    @api.response(410, 'The changes after since were purged from the change log')
+    @api.expect(changes_args, validate=True)
+    def get(self):
+        """
+        Returns the changes of the Recommendations after a seq
+
+        Every create, update, delete and dislike is logged with the new state
+        of the Recommendation, and a reset as a single entry. Start from the
+        export, read the changes after its X-Last-Seq header and pass last_seq
+        as since to the next request. With wait the request returns as soon as there is a change,
+        which the gevent workers only accept.
+        """
+        args = changes_args.parse_args()
+        since = args['since']
+        app.logger.debug('Request for the Recommendation changes after [%s]', since)
+        # since is the last seq read, so nothing is missing when it is the last one purged
+        if since < Recommendations.purged_seq():
+            abort(status.HTTP_410_GONE, 'The changes after {} were purged, read the export again'.format(since))
+        if args['wait'] and not app.config['CHANGES_WAIT_ENABLED']:
+            abort(status.HTTP_400_BAD_REQUEST, 'wait is only served by the gevent workers, poll without it')
+        limit = min(args['limit'], app.config['MAX_PAGE_SIZE'])
+        deadline = time.monotonic() + min(args['wait'], app.config['CHANGES_MAX_WAIT'])
+        rows = Recommendations.find_changes(since, limit)
+        while not rows and time.monotonic() < deadline:
+            # hand the connection back to the pool while waiting
+            db.session.remove()
+            time.sleep(app.config['CHANGES_POLL_INTERVAL'])
+            rows = Recommendations.find_changes(since, limit)
+        entries = encoding.rows_to_dicts(rows)
+        for entry in entries:
+            entry['changed_at'] = entry['changed_at'].isoformat()
+        return json_response({'changes': entries, 'last_seq': rows[-1].seq if rows else since})
 
 
 ######################################################################
@@ -235,19 +580,56 @@ class DislikeResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('dislike_recommendations')
     @api.response(404, 'Recommendation not found')
+    @api.response(202, 'Dislike buffered, it is written on the next flush (DISLIKE_COALESCE)')
     def put(self, recommendation_id):
         """
         Dislike a Recommendation
 
         This endpoint will dislike a Recommendation
         """
-        app.logger.info('Request to dislike a Recommendation')
-        recommendation = Recommendations.find_by_id(recommendation_id)
+        app.logger.debug('Request to dislike a Recommendation')
+        if dislike_buffer.enabled:
+            row = Recommendations.find_row_by_id(recommendation_id)
+            if not row:
+                abort(status.HTTP_404_NOT_FOUND, 'Recommendation with id [{}] was not found.'.format(recommendation_id))
+            recommendation = row._asdict()
+            recommendation['dislike'] += dislike_buffer.add(row.id)
+            return recommendation, status.HTTP_202_ACCEPTED
+        recommendation = Recommendations.add_dislikes(recommendation_id)
         if not recommendation:
             abort(status.HTTP_404_NOT_FOUND, 'Recommendation with id [{}] was not found.'.format(recommendation_id))
-        recommendation.dislike += 1
-        recommendation.save()
-        return recommendation.serialize(), status.HTTP_200_OK
+        return recommendation, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/purge
+######################################################################
+@api.route('/recommendations/purge')
+class PurgeResource(Resource):
+    """ Removes old tombstones for good """
+
+    # ------------------------------------------------------------------
+    # PURGE DELETED RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('purge_recommendations')
+    @api.response(200, 'The number of deleted Recommendations purged')
+    @api.response(403, 'The purge endpoint is disabled')
+    def post(self):
+        """
+        Purge deleted Recommendations
+
+        This endpoint removes the Recommendations deleted more than
+        TOMBSTONE_RETENTION_DAYS ago, in small batches, and the change log
+        entries older than CHANGE_LOG_RETENTION_DAYS. It is meant for a
+        scheduler and only runs when PURGE_ENDPOINT_ENABLED is set
+        """
+        app.logger.debug('Request to purge deleted Recommendations')
+        if not app.config['PURGE_ENDPOINT_ENABLED']:
+            abort(status.HTTP_403_FORBIDDEN, 'The purge endpoint is disabled')
+        purged = Recommendations.purge_deleted(timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS']),
+                                               app.config['PURGE_BATCH_SIZE'], app.config['PURGE_PAUSE'])
+        changes_purged = Recommendations.purge_changes(timedelta(days=app.config['CHANGE_LOG_RETENTION_DAYS']))
+        return {'purged': purged, 'changes_purged': changes_purged}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -262,16 +644,133 @@ class ResetResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('reset_recommendations')
     @api.response(204, 'All Recommendations deleted')
+    @api.header('X-Removed-Count', 'The number of Recommendations removed, estimated on PostgreSQL')
     def delete(self):
         """
         Delete all Recommendations
 
         This endpoint will delete all Recommendations to reset the database
         """
-        app.logger.info('Request to Delete all recommendations...')
-        Recommendations.remove_all()
+        app.logger.debug('Request to Delete all recommendations...')
+
+        def progress(total):
+            app.logger.info('[%s] Recommendations removed', total)
+
+        removed = Recommendations.remove_all(app.config['RESET_BATCH_SIZE'], app.config['RESET_PAUSE'], progress)
         app.logger.info("Removed all Recommendations from the database")
-        return '', status.HTTP_204_NO_CONTENT
+        return '', status.HTTP_204_NO_CONTENT, {'X-Removed-Count': str(removed)}
+
+
+######################################################################
+#  PATH: /products/{id}/recommendations
+######################################################################
+@api.route('/products/<int:product_id>/recommendations')
+@api.param('product_id', 'The Origin Product identifier')
+class RankingResource(Resource):
+    """ The ranked Recommendations of a product """
+
+    # ------------------------------------------------------------------
+    # LIST THE TOP RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('rank_recommendations')
+    @api.response(200, 'Success', [ranked_model])
+    @api.expect(ranking_args, validate=True)
+    def get(self, product_id):
+        """
+        Returns the top ranked Recommendations of a product
+
+        Recommendations are ranked by the weight of their relation divided by
+        1 + dislike, so the least disliked come first
+        """
+        app.logger.debug('Request to rank the Recommendations of product [%s]', product_id)
+        args = ranking_args.parse_args()
+        top = min(args['top'], app.config['MAX_PAGE_SIZE'])
+        weights = app.config['RELATION_WEIGHTS']
+        relations = [args['relation']] if args['relation'] else sorted(weights)
+        recommendations = Recommendations.find_top(product_id, top, relations, weights)
+        app.logger.debug('[%s] ranked Recommendations returned', len(recommendations))
+        return json_response(recommendations)
+
+
+######################################################################
+#  PATH: /products/{id}/retire
+######################################################################
+@api.route('/products/<int:product_id>/retire')
+@api.param('product_id', 'The Product identifier')
+class RetireResource(Resource):
+    """ Retires a discontinued product """
+
+    # ------------------------------------------------------------------
+    # RETIRE A PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc('retire_product')
+    @api.response(200, 'The Recommendations from and to the product were deleted')
+    def put(self, product_id):
+        """
+        Retire a product
+
+        This endpoint deletes every Recommendation where the product is the
+        origin or the target, in a single update
+        """
+        app.logger.debug('Request to retire product [%s]', product_id)
+        retired = Recommendations.retire_product(product_id)
+        app.logger.info('Retired product [%s], [%s] Recommendations deleted', product_id, retired)
+        return {'product_id': product_id, 'retired': retired}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{id}/expansion
+######################################################################
+@api.route('/products/<int:product_id>/expansion')
+@api.param('product_id', 'The Origin Product identifier')
+class ExpansionResource(Resource):
+    """ The products reachable from a product through Recommendations """
+
+    # ------------------------------------------------------------------
+    # EXPAND THE RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc('expand_recommendations')
+    @api.response(200, 'Success', [expansion_model])
+    @api.expect(expansion_args, validate=True)
+    def get(self, product_id):
+        """
+        Returns the products recommended up to depth hops away
+
+        Each product follows its fan-out best ranked Recommendations, a path
+        scores the product of the scores of its hops and every product is
+        returned once with its best path
+        """
+        app.logger.debug('Request to expand the Recommendations of product [%s]', product_id)
+        args = expansion_args.parse_args()
+        weights = app.config['RELATION_WEIGHTS']
+        graph = graph_engine.current() if graph_engine.enabled else None
+        products = expand(product_id, min(args['depth'], app.config['EXPAND_MAX_DEPTH']),
+                          args['relation'] or sorted(weights), min(args['fan-out'], app.config['EXPAND_MAX_FANOUT']),
+                          weights, args['max-dislike'], min(args['limit'], app.config['MAX_PAGE_SIZE']), graph)
+        app.logger.debug('[%s] expanded products returned', len(products))
+        return json_response(products)
+
+
+######################################################################
+#  PATH: /stats
+######################################################################
+@api.route('/stats')
+class StatsResource(Resource):
+    """ Runtime statistics of the service """
+
+    # ------------------------------------------------------------------
+    # RETRIEVE THE STATISTICS
+    # ------------------------------------------------------------------
+    @api.doc('get_stats')
+    def get(self):
+        """
+        Retrieve runtime statistics
+
+        This endpoint returns the counters of the Recommendation list cache,
+        of the database connection pool and the size of the in-memory graph
+        """
+        return {'cache': list_cache.stats(), 'pool': pool_metrics.snapshot(),
+                'graph': graph_engine.stats()}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -283,7 +782,101 @@ def abort(error_code: int, message: str):
     api.abort(error_code, message)
 
 
+def parse_bulk_body():
+    """Returns the list of items posted as a JSON array or as newline delimited JSON"""
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                # keep the position so the result lines up with the line
+                items.append(None)
+        return items
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, 'The posted body must be a JSON array of Recommendations')
+    return items
+
+
+def recommendation_etag(recommendation):
+    """Returns the ETag (unquoted) of a Recommendation, from its id and version"""
+    return '{}-{}'.format(recommendation.id, recommendation.version)
+
+
+def list_etag(rows):
+    """Returns the ETag (unquoted) of a list of Recommendation rows"""
+    versions = ','.join('{}-{}'.format(row.id, row.version) for row in rows)
+    return hashlib.md5(versions.encode()).hexdigest()
+
+
+def list_entry(rows):
+    """Returns the encoded list of Recommendation rows and its ETag, as the list cache keeps them"""
+    with metrics.time_serialization():
+        body = encoding.dumps(encoding.rows_to_dicts(rows)).decode()
+    return {'etag': list_etag(rows), 'body': body, 'count': len(rows)}
+
+
+def list_response(body, etag, headers=None):
+    """Returns the encoded list, or 304 when the client already has this ETag"""
+    headers = dict(headers or {}, ETag=quote_etag(etag))
+    if request.if_none_match.contains_weak(etag):
+        return '', status.HTTP_304_NOT_MODIFIED, headers
+    return Response(body, status.HTTP_200_OK, headers, mimetype='application/json')
+
+
+def json_response(value, code=status.HTTP_200_OK, headers=None):
+    """Returns value encoded by the fast encoder, the Swagger models only document the read endpoints"""
+    with metrics.time_serialization():
+        body = encoding.dumps(value)
+    return Response(body, code, headers, mimetype='application/json')
+
+
+def check_if_match(recommendation):
+    """Aborts with 412 when an If-Match header does not match the Recommendation's ETag"""
+    if request.if_match and not request.if_match.contains(recommendation_etag(recommendation)):
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              "Recommendation with id '{}' was changed, its ETag no longer matches".format(recommendation.id))
+
+
+def write_recommendation(recommendation_id, write):
+    """
+    Reads a Recommendation and calls write with it, returns it or None when it does not exist
+
+    Every write only updates the version it read. With If-Match a change in
+    between is refused with 412. Without it the client did not ask for that
+    check, so the Recommendation is read again and the write retried.
+    """
+    for attempt in range(WRITE_ATTEMPTS):
+        recommendation = Recommendations.find_by_id(recommendation_id)
+        if not recommendation:
+            return None
+        check_if_match(recommendation)
+        try:
+            write(recommendation)
+            return recommendation
+        except StaleRecommendationError:
+            if request.if_match or attempt == WRITE_ATTEMPTS - 1:
+                raise
+            app.logger.info('Recommendation with id [%s] changed while it was written, retrying', recommendation_id)
+
+
+def next_page_headers(args, last_id):
+    """Returns the Link and X-Next-Cursor headers pointing at the page after last_id"""
+    query = {name: value for name, value in args.items() if value is not None}
+    query['after-id'] = last_id
+    next_url = api.url_for(RecommendationCollection, _external=True, **query)
+    return {'Link': '<{}>; rel="next"'.format(next_url), 'X-Next-Cursor': str(last_id)}
+
+
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Recommendations.init_db(app)
+    dislike_buffer.init_app(app)
+    metrics.init_app(app, api)
+    request_log.init_app(app)
+    graph_engine.init_app(app)
+    idempotency_store.init_app(app)
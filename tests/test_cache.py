@@ -0,0 +1,236 @@
+"""
+Test cases for the Recommendation list cache
+
+"""
+import fnmatch
+import unittest
+from types import SimpleNamespace
+from service.cache import LRUCache, SharedCache, ListCache, IdempotencyStore
+
+
+class FakeClock:
+    """ A clock the tests move by hand """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """ Stand-in for a redis-py client, keeps everything in a dictionary """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match="*"):
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def eval(self, script, numkeys, *args):
+        """ Runs SharedCache.SET_IF_GENERATION, the only script the cache sends """
+        (key, epoch, generation), (value, expected, _) = args[:numkeys], args[numkeys:]
+        current = "{}.{}".format(int(self.data.get(epoch, 0)), int(self.data.get(generation, 0)))
+        if current != expected:
+            return 0
+        self.set(key, value)
+        return 1
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for LRUCache """
+
+    def test_get_and_set(self):
+        """ Store and read back a value """
+        cache = LRUCache(maxsize=2, ttl=10)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", [1])
+        self.assertEqual(cache.get("a"), [1])
+        self.assertEqual(cache.get_many(["a", "missing"]), [[1], None])
+        cache.delete("a", "missing")
+        self.assertIsNone(cache.get("a"))
+
+    def test_expire_after_ttl(self):
+        """ Entries expire after the ttl """
+        clock = FakeClock()
+        cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+        cache.set("a", [1])
+        clock.now = 9.9
+        self.assertEqual(cache.get("a"), [1])
+        clock.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_evict_least_recently_used(self):
+        """ The least recently used entry is evicted when full """
+        cache = LRUCache(maxsize=2, ttl=10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+    def test_set_if_generation(self):
+        """ Store a value only while the generation of its key did not move """
+        cache = LRUCache(maxsize=2, ttl=10)
+        generation = cache.generations(["a"])[0]
+        cache.bump("a")
+        self.assertFalse(cache.set_if_generation("a", [1], generation))
+        self.assertIsNone(cache.get("a"))
+        generation = cache.generations(["a"])[0]
+        self.assertTrue(cache.set_if_generation("a", [1], generation))
+        self.assertEqual(cache.get("a"), [1])
+        cache.clear()
+        self.assertFalse(cache.set_if_generation("a", [1], generation))
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Test Cases for SharedCache """
+
+    def test_get_set_delete_clear(self):
+        """ Store values as JSON in the shared client """
+        client = FakeRedis()
+        client.set("other", "keep")
+        cache = SharedCache(client, ttl=10)
+        cache.set("a", [{"id": 1}])
+        self.assertEqual(cache.get("a"), [{"id": 1}])
+        self.assertIn("recommendations:a", client.data)
+        cache.set("b", [])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_many(["a", "c", "b"]), [[{"id": 1}], None, []])
+        self.assertEqual(cache.get_many([]), [])
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+        self.assertIn("other", client.data)
+
+    def test_set_if_generation(self):
+        """ Store a value only while the generation of its key did not move """
+        client = FakeRedis()
+        cache = SharedCache(client, ttl=10)
+        generation, other = cache.generations(["a", "b"])
+        cache.bump("a")
+        self.assertFalse(cache.set_if_generation("a", [1], generation))
+        self.assertTrue(cache.set_if_generation("b", [2], other))
+        self.assertTrue(cache.set_if_generation("a", [1], cache.generations(["a"])[0]))
+        self.assertEqual(cache.get_many(["a", "b"]), [[1], [2]])
+        self.assertEqual(len(cache), 2)  # the generation counters are not entries
+        generation = cache.generations(["a"])[0]
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(cache.set_if_generation("a", [1], generation))
+        self.assertEqual(cache.generations([]), [])
+
+
+class TestListCache(unittest.TestCase):
+    """ Test Cases for ListCache """
+
+    def setUp(self):
+        self.cache = ListCache()
+        self.cache.backend = SharedCache(FakeRedis())
+
+    def test_disabled(self):
+        """ Without a backend nothing is cached """
+        cache = ListCache()
+        self.assertFalse(cache.enabled)
+        cache.set(1, None, [1])
+        self.assertIsNone(cache.get(1, None))
+        cache.invalidate([(1, 1)])
+        self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_hits_and_misses(self):
+        """ Count hits and misses """
+        self.assertIsNone(self.cache.get(1, 2))
+        self.cache.set(1, 2, [{"id": 1}])
+        self.assertEqual(self.cache.get(1, 2), [{"id": 1}])
+        self.assertIsNone(self.cache.get(1, None))
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["backend"], "SharedCache")
+
+    def test_get_many(self):
+        """ Read the lists of many products at once """
+        self.cache.set(1, 2, [{"id": 1}])
+        self.cache.set(3, 2, [])
+        self.assertEqual(self.cache.get_many([1, 2, 3], 2), [[{"id": 1}], None, []])
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(ListCache().get_many([1, 2], None), [None, None])
+
+    def test_invalidate(self):
+        """ Invalidate the relation list and the all relations list of a product """
+        self.cache.set(1, None, [])
+        self.cache.set(1, 2, [])
+        self.cache.set(1, 3, [])
+        self.cache.set(4, 2, [])
+        self.cache.invalidate([(1, 2)])
+        self.assertIsNone(self.cache.get(1, None))
+        self.assertIsNone(self.cache.get(1, 2))
+        self.assertEqual(self.cache.get(1, 3), [])
+        self.assertEqual(self.cache.get(4, 2), [])
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(4, 2))
+
+    def test_skip_lists_read_before_a_write(self):
+        """ Keep a list out of the cache when a write invalidated it while it was read """
+        generation, other = self.cache.generations([1, 4], 2)
+        self.cache.invalidate([(1, 2)])  # the write commits after the list was read
+        self.cache.set(1, 2, [{"id": 1}], generation)
+        self.cache.set(4, 2, [], other)
+        self.assertIsNone(self.cache.get(1, 2))
+        self.assertEqual(self.cache.get(4, 2), [])
+        self.assertEqual(self.cache.stats()["stale_skips"], 1)
+        self.assertEqual(ListCache().generations([1, 4], 2), [None, None])
+
+
+class TestIdempotencyStore(unittest.TestCase):
+    """ Test Cases for IdempotencyStore """
+
+    def test_store_and_replay(self):
+        """ Return the stored response and count the replays """
+        store = IdempotencyStore()
+        store.backend = SharedCache(FakeRedis(), prefix="idempotency:")
+        self.assertIsNone(store.get("a"))
+        store.set("a", {"body": {"id": 1}})
+        self.assertEqual(store.get("a"), {"body": {"id": 1}})
+        self.assertEqual(store.replays, 1)
+
+    def test_memory_without_cache(self):
+        """ Keep the responses in memory when caching is off """
+        store = IdempotencyStore()
+        store.init_app(SimpleNamespace(config={"CACHE_BACKEND": "none", "IDEMPOTENCY_TTL": 60, "IDEMPOTENCY_MAXSIZE": 10}))
+        self.assertIsInstance(store.backend, LRUCache)
+
@@ -0,0 +1,85 @@
+"""
+Test cases for the dislike write coalescing buffer
+
+"""
+import time
+import logging
+import unittest
+from unittest.mock import patch
+from service import app
+from service.models import Recommendations, db
+from service.dislikes import DislikeBuffer
+
+
+######################################################################
+#  D I S L I K E   B U F F E R   T E S T   C A S E S
+######################################################################
+class TestDislikeBuffer(unittest.TestCase):
+    """ Test Cases for DislikeBuffer """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        Recommendations.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        for target in (2, 3):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        self.buffer = DislikeBuffer()
+        self.buffer.init_app(app)
+        self.buffer.interval = 60
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.buffer.stop()
+        db.session.remove()
+        db.drop_all()
+
+    def test_add_and_flush(self):
+        """ Buffer dislikes and write them in one batch """
+        self.assertEqual(self.buffer.add(1), 1)
+        self.assertEqual(self.buffer.add("1"), 2)
+        self.assertEqual(self.buffer.add(2, 3), 3)
+        self.assertEqual(self.buffer.pending(1), 2)
+        self.assertEqual(Recommendations.find_by_id(1).dislike, 0)
+
+        self.assertEqual(self.buffer.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(Recommendations.find_by_id(1).dislike, 2)
+        self.assertEqual(Recommendations.find_by_id(2).dislike, 3)
+        self.assertEqual(self.buffer.pending(1), 0)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_flush_on_interval(self):
+        """ Flush pending dislikes from the background thread """
+        self.buffer.interval = 0.01
+        self.buffer.add(1)
+        deadline = time.time() + 5
+        while self.buffer.pending(1) and time.time() < deadline:
+            time.sleep(0.01)
+        self.buffer.stop()
+        db.session.expire_all()
+        self.assertEqual(Recommendations.find_by_id(1).dislike, 1)
+
+    def test_stop_flushes(self):
+        """ Write pending dislikes when stopped """
+        self.buffer.add(2)
+        self.buffer.stop()
+        db.session.expire_all()
+        self.assertEqual(Recommendations.find_by_id(2).dislike, 1)
+
+    def test_stop_registered_once(self):
+        """ Register the exit flush once however often the thread is started again """
+        with patch("service.dislikes.atexit.register") as register:
+            self.buffer.add(1)
+            self.buffer._pid = -1  # as in a forked child
+            self.buffer.add(1)
+            self.buffer.stop()
+            self.buffer.add(1)
+        register.assert_called_once_with(self.buffer.stop)
@@ -0,0 +1,39 @@
+"""
+Test cases for the fast JSON encoding
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from service import encoding
+
+
+class Row(tuple):
+    """ A tuple with the keys() of a selected row """
+
+    def keys(self):
+        return ["id", "version"]
+
+
+######################################################################
+#  E N C O D I N G   T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for the fast JSON encoding """
+
+    def test_dumps(self):
+        """ Encode to compact JSON bytes """
+        value = [{"id": 1, "version": 2}]
+        self.assertEqual(json.loads(encoding.dumps(value)), value)
+        self.assertNotIn(b" ", encoding.dumps(value))
+
+    def test_dumps_without_orjson(self):
+        """ Encode with the standard library when orjson is missing """
+        with patch.object(encoding, "orjson", None):
+            self.assertEqual(encoding.dumps({"id": 1}), b'{"id":1}')
+
+    def test_rows_to_dicts(self):
+        """ Turn selected rows into dicts """
+        self.assertEqual(encoding.rows_to_dicts([Row((1, 2)), Row((3, 4))]),
+                         [{"id": 1, "version": 2}, {"id": 3, "version": 4}])
+        self.assertEqual(encoding.rows_to_dicts([]), [])
@@ -0,0 +1,80 @@
+"""
+Test cases for the multi-hop expansion of Recommendations
+
+"""
+import logging
+import unittest
+from service import app
+from service.models import Recommendations, db
+from service.expansion import expand
+from service.graph import RecommendationGraph, numpy
+
+# origin, target, relation, dislike
+EDGES = [
+    (1, 2, 1, 0), (1, 3, 1, 1), (1, 4, 3, 0),
+    (2, 5, 3, 0), (2, 6, 3, 4), (2, 1, 1, 0),  # 2 leads back to 1
+    (3, 5, 1, 0), (3, 7, 1, 0),
+    (5, 8, 1, 0),
+]
+
+
+######################################################################
+#  E X P A N S I O N   T E S T   C A S E S
+######################################################################
+class TestExpansion(unittest.TestCase):
+    """ Test Cases for expand() """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        Recommendations.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        for origin, target, relation, dislike in EDGES:
+            Recommendations(product_origin=origin, product_target=target, relation=relation, dislike=dislike,
+                            is_deleted=0).create()
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+        db.drop_all()
+
+    def test_expand(self):
+        """ Reach every product once with its best path """
+        products = expand(1, 2, [1, 2, 3], 10)
+        by_product = {product["product_id"]: product for product in products}
+        self.assertEqual(sorted(by_product), [2, 3, 4, 5, 6, 7])
+        self.assertEqual(by_product[5]["path"], [1, 2, 5])
+        self.assertEqual(by_product[5]["depth"], 2)
+        self.assertEqual(by_product[7]["score"], 0.5)
+        self.assertEqual(by_product[6]["score"], 0.2)
+        self.assertEqual([product["product_id"] for product in products][:3], [2, 4, 5])
+        self.assertEqual(expand(1, 3, [1, 2, 3], 10)[-1]["product_id"], 6)
+        self.assertIn(8, [product["product_id"] for product in expand(1, 3, [1, 2, 3], 10)])
+
+    def test_expand_filters(self):
+        """ Follow only the allowed relations, dislikes and fan-out """
+        self.assertEqual([product["product_id"] for product in expand(1, 3, [1], 10)], [2, 3, 5, 7, 8])
+        self.assertEqual(sorted(product["product_id"] for product in expand(1, 2, [1, 3], 1)), [2, 5])
+        self.assertNotIn(6, [product["product_id"] for product in expand(1, 2, [1, 3], 10, max_dislike=1)])
+        self.assertEqual(len(expand(1, 3, [1, 3], 10, limit=2)), 2)
+        self.assertEqual(expand(9, 3, [1, 3], 10), [])
+
+    def test_expand_weights(self):
+        """ Score the hops with the weight of their relation """
+        products = expand(1, 1, [1, 3], 10, weights={1: 1.0, 3: 2.0})
+        self.assertEqual(products[0], {"product_id": 4, "depth": 1, "score": 2.0, "relation": 3, "path": [1, 4]})
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_expand_from_graph(self):
+        """ Walk the in-memory graph like the database """
+        graph = RecommendationGraph.from_rows(Recommendations.iter_all(100))
+        for relations, fanout, max_dislike in (([1, 2, 3], 10, None), ([1, 3], 1, None), ([1, 3], 10, 1)):
+            self.assertEqual(expand(1, 3, relations, fanout, max_dislike=max_dislike, graph=graph),
+                             expand(1, 3, relations, fanout, max_dislike=max_dislike))
@@ -0,0 +1,202 @@
+"""
+Test cases for the in-memory recommendation graph
+
+"""
+import os
+import logging
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest.mock import patch
+from service import app, graph
+from service.models import Recommendations, db
+from service.graph import RecommendationGraph, GraphEngine, SnapshotError
+
+
+######################################################################
+#  G R A P H   T E S T   C A S E S
+######################################################################
+@unittest.skipIf(graph.numpy is None, "numpy is not installed")
+class TestRecommendationGraph(unittest.TestCase):
+    """ Test Cases for RecommendationGraph and GraphEngine """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        Recommendations.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        for origin, target, relation in ((2, 5, 1), (1, 3, 2), (2, 4, 1), (1, 4, 1), (2, 6, 3)):
+            Recommendations(product_origin=origin, product_target=target, relation=relation, dislike=0,
+                            is_deleted=0).create()
+        gone = Recommendations(product_origin=1, product_target=9, relation=1, dislike=0, is_deleted=0)
+        gone.create()
+        gone.soft_delete()
+
+        self.snapshot = os.path.join(tempfile.mkdtemp(), "graph.snapshot")
+
+    def tearDown(self):
+        """ This runs after each test """
+        db.session.remove()
+        db.drop_all()
+        if os.path.exists(self.snapshot):
+            os.remove(self.snapshot)
+        os.rmdir(os.path.dirname(self.snapshot))
+
+    def test_neighbours_match_the_database(self):
+        """ Read the same live lists from the graph as from the database """
+        loaded = RecommendationGraph.from_rows(Recommendations.iter_all(2))
+        self.assertEqual(len(loaded), 5)
+        self.assertEqual(len(loaded.origins), 2)
+        for origin in (1, 2, 3):
+            for relation in (None, 1, 2):
+                expected = [tuple(row) for row in Recommendations.find_live_by_attributes(origin, None, relation)]
+                self.assertEqual([tuple(edge) for edge in loaded.neighbours(origin, relation)], expected)
+
+    def test_edges_serialize_like_rows(self):
+        """ Give the edges the keys of the selected rows """
+        loaded = RecommendationGraph.from_rows(Recommendations.iter_all(100))
+        edge = loaded.neighbours(1)[0]
+        self.assertEqual(list(edge.keys()), [column.key for column in Recommendations.serialized_columns()])
+        self.assertIsInstance(edge.product_target, int)
+
+    def test_empty_graph(self):
+        """ Build a graph without Recommendations """
+        loaded = RecommendationGraph.from_rows([])
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(loaded.neighbours(1), [])
+
+    def test_engine_reload(self):
+        """ Swap in a new graph and report its size """
+        engine = GraphEngine()
+        engine.init_app(app)
+        self.assertIsNone(engine.stats()["loaded_at"])
+        engine.reload()
+        stats = engine.stats()
+        self.assertEqual(stats["edges"], 5)
+        self.assertEqual(stats["products"], 2)
+        self.assertGreater(stats["bytes_per_edge"], 0)
+        with patch.object(engine, "_ensure_started"):
+            self.assertEqual(len(engine.lookup(2, 1)), 2)
+
+    def test_engine_without_numpy(self):
+        """ Stay disabled when numpy is missing """
+        engine = GraphEngine()
+        with patch.dict(app.config, {"GRAPH_ENGINE": True}), patch.object(graph, "numpy", None):
+            engine.init_app(app)
+        self.assertFalse(engine.enabled)
+
+    def test_snapshot_round_trip(self):
+        """ Map a saved graph back with the same Recommendations """
+        built = RecommendationGraph.from_rows(Recommendations.iter_all(100))
+        built.save(self.snapshot)
+        mapped = RecommendationGraph.load(self.snapshot)
+        self.assertEqual(len(mapped), 5)
+        self.assertEqual(mapped.built_at, built.built_at)
+        self.assertFalse(mapped.ids.flags.writeable)
+        for origin in (1, 2, 3):
+            self.assertEqual(mapped.neighbours(origin), built.neighbours(origin))
+
+    def test_empty_snapshot(self):
+        """ Save and map a graph without Recommendations """
+        RecommendationGraph.from_rows([]).save(self.snapshot)
+        self.assertEqual(RecommendationGraph.load(self.snapshot).neighbours(1), [])
+
+    def test_bad_snapshot(self):
+        """ Refuse files that are not complete snapshots """
+        with open(self.snapshot, "wb") as snapshot:
+            snapshot.write(b"not a snapshot" * 10)
+        self.assertRaises(SnapshotError, RecommendationGraph.load, self.snapshot)
+        RecommendationGraph.from_rows(Recommendations.iter_all(100)).save(self.snapshot)
+        with open(self.snapshot, "r+b") as snapshot:
+            snapshot.truncate(100)
+        self.assertRaises(SnapshotError, RecommendationGraph.load, self.snapshot)
+
+    def test_engine_follows_the_snapshot(self):
+        """ Map the snapshot file and map it again only when it is replaced """
+        engine = GraphEngine()
+        with patch.dict(app.config, {"GRAPH_SNAPSHOT_PATH": self.snapshot}):
+            engine.init_app(app)
+        engine.reload()
+        self.assertEqual(engine.stats()["source"], "database")
+        RecommendationGraph.from_rows(Recommendations.iter_all(100)).save(self.snapshot)
+        first = engine.reload()
+        self.assertEqual(engine.stats()["source"], "snapshot")
+        self.assertIs(engine.reload(), first)
+        RecommendationGraph.from_rows([]).save(self.snapshot)
+        self.assertEqual(len(engine.reload()), 0)
+
+    def test_snapshot_command(self):
+        """ Write a snapshot from the command line """
+        result = app.test_cli_runner().invoke(args=["graph-snapshot", "--output", self.snapshot])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("5 Recommendations", result.output)
+        self.assertEqual(len(RecommendationGraph.load(self.snapshot)), 5)
+
+    def test_apply_changes(self):
+        """ Merge change log entries like reading the table again """
+        loaded = RecommendationGraph.from_rows(Recommendations.iter_all(100), seq=7)
+        moved = Recommendations.find_by_id(1)
+        moved.update({"product_origin": 3})
+        Recommendations.add_dislikes(3)
+        Recommendations.find_by_id(4).soft_delete()
+        Recommendations(product_origin=1, product_target=7, relation=1, dislike=0, is_deleted=0).create()
+        merged = loaded.apply(Recommendations.find_changes(loaded.seq))
+        fresh = RecommendationGraph.from_rows(Recommendations.iter_all(100))
+        self.assertEqual(merged.seq, 11)
+        self.assertEqual(len(merged), len(fresh))
+        for origin in (1, 2, 3):
+            self.assertEqual(merged.neighbours(origin), fresh.neighbours(origin))
+        self.assertIs(merged.apply([]), merged)
+
+    def test_engine_refresh(self):
+        """ Keep the graph up to date from the change log """
+        engine = GraphEngine()
+        engine.init_app(app)
+        first = engine.refresh()
+        self.assertEqual(first.seq, 7)
+        self.assertIs(engine.refresh(), first)
+        Recommendations.add_dislikes(1, 3)
+        self.assertEqual(engine.refresh().neighbours(2, 1)[0].dislike, 3)
+        self.assertIsNot(engine.graph, first)
+        Recommendations.remove_all()
+        with patch.object(engine, "reload", wraps=engine.reload) as reload:
+            self.assertEqual(len(engine.refresh()), 0)
+            reload.assert_called_once()
+
+    def test_engine_merges_changes_into_the_snapshot(self):
+        """ Merge the change log past the snapshot's seq and map it again only when it is replaced """
+        RecommendationGraph.from_rows(Recommendations.iter_all(100), seq=Recommendations.complete_seq()) \
+            .save(self.snapshot)
+        engine = GraphEngine()
+        with patch.dict(app.config, {"GRAPH_SNAPSHOT_PATH": self.snapshot}):
+            engine.init_app(app)
+        engine.refresh()
+        self.assertEqual(engine.stats()["source"], "snapshot")
+        Recommendations.add_dislikes(1, 3)
+        with patch.object(RecommendationGraph, "load", wraps=RecommendationGraph.load) as load:
+            self.assertEqual(engine.refresh().neighbours(2, 1)[0].dislike, 3)
+            load.assert_not_called()
+        # the entries after the snapshot were purged: read the table, not the same snapshot again
+        Recommendations.add_dislikes(1, 1)
+        Recommendations.add_dislikes(1, 1)
+        Recommendations.purge_changes(timedelta(0))
+        self.assertEqual(engine.refresh().neighbours(2, 1)[0].dislike, 5)
+        self.assertEqual(engine.stats()["source"], "database")
+        Recommendations.add_dislikes(1, 1)
+        self.assertEqual(engine.refresh().neighbours(2, 1)[0].dislike, 6)
+        self.assertEqual(engine.stats()["source"], "database")
+        RecommendationGraph.from_rows([], seq=Recommendations.complete_seq()).save(self.snapshot)
+        self.assertEqual(len(engine.refresh()), 0)
+        self.assertEqual(engine.stats()["source"], "snapshot")
+
+    def test_snapshot_keeps_seq(self):
+        """ Save the change log seq in the snapshot """
+        RecommendationGraph.from_rows(Recommendations.iter_all(100), seq=7).save(self.snapshot)
+        self.assertEqual(RecommendationGraph.load(self.snapshot).seq, 7)
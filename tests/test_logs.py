@@ -0,0 +1,54 @@
+"""
+Test cases for the request and queue logging
+
+"""
+import logging
+import logging.handlers
+import unittest
+from unittest.mock import Mock
+from service.logs import RequestLog, start_queue_logging
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the records it handles """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+######################################################################
+#  L O G G I N G   T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the request and queue logging """
+
+    def test_should_log(self):
+        """ Log a sample of the requests, errors and slow requests always """
+        request_log = RequestLog()
+        request_log.app = Mock(config={"LOG_SAMPLE_RATE": 0, "LOG_SLOW_REQUEST_MS": 100})
+        self.assertFalse(request_log.should_log(200, 5))
+        self.assertTrue(request_log.should_log(500, 5))
+        self.assertTrue(request_log.should_log(200, 150))
+        request_log.app.config["LOG_SAMPLE_RATE"] = 1
+        self.assertTrue(request_log.should_log(200, 5))
+        request_log.app.config["LOG_SAMPLE_RATE"] = 0.5
+        request_log.random.seed(1)
+        sampled = sum(request_log.should_log(200, 5) for _ in range(1000))
+        self.assertTrue(400 < sampled < 600)
+
+    def test_queue_logging(self):
+        """ Hand the records to the handlers through a queue """
+        target = logging.getLogger("test.queue")
+        target.propagate = False
+        handler = ListHandler()
+        target.handlers = [handler]
+        listener = start_queue_logging(target)
+        self.assertIsInstance(target.handlers[0], logging.handlers.QueueHandler)
+        target.warning("queued %s", 1)
+        # wait for the listener thread
+        listener.queue.join()
+        self.assertEqual([record.getMessage() for record in handler.records], ["queued 1"])
@@ -0,0 +1,51 @@
+"""
+Test cases for the Prometheus metrics
+
+"""
+import unittest
+from service.metrics import Counter, Histogram, Metrics
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the metric types """
+
+    def test_counter(self):
+        """ Count by label values """
+        counter = Counter("requests_total", "Requests", ("method", "status"))
+        counter.inc("GET", 200)
+        counter.inc("GET", 200)
+        counter.inc("PUT", 404, amount=3)
+        self.assertEqual(counter.value("GET", 200), 2)
+        self.assertEqual(counter.value("PUT", 404), 3)
+        self.assertEqual(counter.value("POST", 201), 0)
+        samples = list(counter.samples())
+        self.assertIn(("requests_total", '{method="GET",status="200"}', 2), samples)
+
+    def test_histogram(self):
+        """ Count observations in cumulative buckets """
+        histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "/a")
+        histogram.observe(0.5, "/a")
+        histogram.observe(5.0, "/a")
+        self.assertEqual(histogram.count("/a"), 3)
+        self.assertEqual(histogram.count("/b"), 0)
+        samples = {(name, labels): value for name, labels, value in histogram.samples()}
+        self.assertEqual(samples[("latency_seconds_bucket", '{route="/a",le="0.1"}')], 1)
+        self.assertEqual(samples[("latency_seconds_bucket", '{route="/a",le="1.0"}')], 2)
+        self.assertEqual(samples[("latency_seconds_bucket", '{route="/a",le="+Inf"}')], 3)
+        self.assertEqual(samples[("latency_seconds_sum", '{route="/a"}')], 5.55)
+
+    def test_render(self):
+        """ Render the metrics in the text format """
+        metrics = Metrics()
+        metrics.requests.inc("GET", '/a"b', 200)
+        metrics.add_gauge("answer", "The answer", lambda: 42)
+        metrics.add_gauge("missing", "Nothing yet", lambda: None)
+        text = metrics.render()
+        self.assertIn("# TYPE http_requests_total counter\n", text)
+        self.assertIn('http_requests_total{method="GET",route="/a\\"b",status="200"} 1\n', text)
+        self.assertIn("# TYPE answer gauge\nanswer 42\n", text)
+        self.assertNotIn("\nmissing ", text)
@@ -5,8 +5,13 @@ Test cases for YourResourceModel Model
 import logging
 import unittest
 import os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import inspect
 from werkzeug.exceptions import NotFound
-from service.models import Recommendations, DataValidationError, db
+from service.models import Recommendations, DataValidationError, DuplicateRecommendationError, \
+    StaleRecommendationError, SchemaVersionError, SCHEMA_VERSION, schema_version, changes, db, ChangeLogHorizon
+from service.pool import pool_metrics
 from service import app
 
 
@@ -193,3 +198,337 @@ class TestRecommendations(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """ Find or return 404 NOT found """
         self.assertRaises(NotFound, Recommendations.find_or_404, 0)
+
+    def test_indexes_created(self):
+        """ Create the list lookup and duplicate check indexes """
+        indexes = {index["name"]: index for index in inspect(db.engine).get_indexes("recommendations")}
+        self.assertIn("ix_recommendations_origin_relation_deleted", indexes)
+        self.assertIn("uq_recommendations_origin_target_relation", indexes)
+        self.assertTrue(indexes["uq_recommendations_origin_target_relation"]["unique"])
+
+    def test_create_missing_indexes(self):
+        """ Add indexes to a table created before they were declared """
+        for index in Recommendations.__table__.indexes:
+            index.drop(bind=db.engine)
+        self.assertEqual(inspect(db.engine).get_indexes("recommendations"), [])
+        Recommendations.create_missing_indexes()
+        self.assertEqual(len(inspect(db.engine).get_indexes("recommendations")),
+                         len(Recommendations.__table__.indexes))
+
+    def test_update_to_a_duplicate(self):
+        """ Update a Recommendation into one that already exists """
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        recommendation = Recommendations(product_origin=1, product_target=3, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        payload = {'product_origin': 1, 'product_target': 2, 'relation': 1}
+        self.assertRaises(DuplicateRecommendationError, recommendation.update, payload)
+        self.assertEqual(Recommendations.find_by_id(recommendation.id).product_target, 3)
+
+    def test_find_live_by_attributes(self):
+        """ Find the Recommendations that are not deleted as rows """
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        Recommendations(product_origin=1, product_target=3, relation=1, dislike=0, is_deleted=1).create()
+        Recommendations(product_origin=1, product_target=4, relation=2, dislike=0, is_deleted=0).create()
+        rows = Recommendations.find_live_by_attributes(origin=1, target=0, relation=1)
+        self.assertEqual(len(rows), 1)
+        self.assertNotIsInstance(rows[0], Recommendations)
+        self.assertEqual(rows[0]._asdict(), Recommendations.find_by_id(1).serialize())
+        rows = Recommendations.find_live_by_attributes(origin=1, target=0, relation=0)
+        self.assertEqual([row.product_target for row in rows], [2, 4])
+
+    def test_find_by_attributes_by_page(self):
+        """ Find Recommendations one page at a time """
+        for target in range(2, 7):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        page = Recommendations.find_by_attributes(1, 0, 1, limit=2)
+        self.assertEqual([recommendation.id for recommendation in page], [1, 2])
+        page = Recommendations.find_by_attributes(1, 0, 1, limit=2, after_id=page[-1].id)
+        self.assertEqual([recommendation.id for recommendation in page], [3, 4])
+        page = Recommendations.find_live_by_attributes(1, 0, 1, limit=2, after_id=4)
+        self.assertEqual([row.id for row in page], [5])
+
+    def test_bulk_upsert(self):
+        """ Create many Recommendations in one transaction """
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=3, is_deleted=0).create()
+        Recommendations(product_origin=1, product_target=3, relation=1, dislike=0, is_deleted=1).create()
+        recommendations = [
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0)
+            for target in (2, 3, 4, 5)
+        ]
+        stored = Recommendations.bulk_upsert(recommendations, batch_size=2)
+        self.assertEqual([row["id"] for row in stored], [1, 2, 3, 4])
+        self.assertEqual(stored[0]["dislike"], 3)
+        self.assertEqual([row["is_deleted"] for row in stored], [0, 0, 0, 0])
+        self.assertEqual(len(Recommendations.all()), 4)
+        # the live Recommendation is left as it is and not logged
+        self.assertEqual([(entry.operation, entry.recommendation_id) for entry in Recommendations.find_changes(2)],
+                         [("update", 2), ("create", 3), ("create", 4)])
+
+    def test_add_dislikes(self):
+        """ Add dislikes to a Recommendation in the database """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        data = Recommendations.add_dislikes(recommendation.id)
+        self.assertEqual(data["dislike"], 1)
+        data = Recommendations.add_dislikes(recommendation.id, 5)
+        self.assertEqual(data, dict(recommendation.serialize(), dislike=6))
+        self.assertIsNone(Recommendations.add_dislikes(99))
+
+    def test_add_dislikes_many(self):
+        """ Add dislikes to many Recommendations at once """
+        for target in (2, 3, 4):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=1, is_deleted=0).create()
+        Recommendations.add_dislikes_many({1: 2, 3: 10})
+        self.assertEqual([recommendation.dislike for recommendation in Recommendations.all()], [3, 1, 11])
+
+    def test_find_live_by_origins(self):
+        """ Find the live Recommendations of many products at once """
+        for origin, target, relation, is_deleted in [(2, 3, 1, 0), (1, 2, 1, 0), (1, 3, 2, 0), (1, 4, 1, 1),
+                                                     (5, 6, 1, 0)]:
+            Recommendations(product_origin=origin, product_target=target, relation=relation, dislike=0,
+                            is_deleted=is_deleted).create()
+        rows = Recommendations.find_live_by_origins([1, 2, 9])
+        self.assertEqual([(row.product_origin, row.product_target) for row in rows], [(1, 2), (1, 3), (2, 3)])
+        rows = Recommendations.find_live_by_origins([1, 2], relation=2)
+        self.assertEqual([row._asdict() for row in rows], [Recommendations.find_by_id(3).serialize()])
+
+    def test_retire_product(self):
+        """ Delete every Recommendation from or to a product """
+        for origin, target in [(1, 2), (3, 1), (1, 4), (2, 3)]:
+            Recommendations(product_origin=origin, product_target=target, relation=1, dislike=0,
+                            is_deleted=0).create()
+        Recommendations(product_origin=5, product_target=1, relation=1, dislike=0, is_deleted=1).create()
+        self.assertEqual(Recommendations.retire_product(1), 3)
+        rows = Recommendations.find_live_by_attributes(0, 0, 0)
+        self.assertEqual([(row.product_origin, row.product_target) for row in rows], [(2, 3)])
+        self.assertEqual(Recommendations.find_by_id(1).version, 2)
+        self.assertEqual(Recommendations.find_by_id(5).version, 1)
+        self.assertEqual(Recommendations.retire_product(1), 0)
+
+    def test_find_top(self):
+        """ Find the best ranked live Recommendations of a product """
+        for target, relation, dislike, is_deleted in [(2, 1, 4, 0), (3, 1, 0, 0), (4, 1, 0, 1), (5, 2, 1, 0),
+                                                      (6, 3, 0, 0), (7, 1, 1, 0)]:
+            Recommendations(product_origin=1, product_target=target, relation=relation, dislike=dislike,
+                            is_deleted=is_deleted).create()
+        Recommendations(product_origin=9, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        top = Recommendations.find_top(1, 3, [1, 2, 3])
+        self.assertEqual([item["product_target"] for item in top], [3, 6, 5])
+        self.assertEqual([item["score"] for item in top], [1.0, 1.0, 0.5])
+        top = Recommendations.find_top(1, 10, [1, 2, 3], {1: 1.0, 2: 4.0, 3: 0.1})
+        self.assertEqual([item["product_target"] for item in top], [5, 3, 7, 2, 6])
+        top = Recommendations.find_top(1, 2, [1])
+        self.assertEqual([item["product_target"] for item in top], [3, 7])
+        self.assertEqual(Recommendations.find_top(1, 2, []), [])
+
+    def test_find_top_by_origins(self):
+        """ Find the least disliked live Recommendations of many products """
+        for origin, target, relation, dislike, is_deleted in [(1, 2, 1, 3, 0), (1, 3, 1, 0, 0), (1, 4, 1, 1, 0),
+                                                              (1, 5, 2, 0, 0), (1, 6, 1, 0, 1), (7, 8, 1, 0, 0),
+                                                              (9, 2, 1, 0, 0)]:
+            Recommendations(product_origin=origin, product_target=target, relation=relation, dislike=dislike,
+                            is_deleted=is_deleted).create()
+        rows = Recommendations.find_top_by_origins([1, 7], 2, [1, 2])
+        self.assertEqual([(row.product_origin, row.product_target) for row in rows], [(1, 3), (1, 5), (1, 4), (7, 8)])
+        rows = Recommendations.find_top_by_origins([1], 5, [1], max_dislike=1)
+        self.assertEqual([row.product_target for row in rows], [3, 4])
+        self.assertEqual(Recommendations.find_top_by_origins([], 5, [1]), [])
+
+    def test_find_row_by_id(self):
+        """ Find a Recommendation by ID as a row """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        self.assertEqual(Recommendations.find_row_by_id(recommendation.id)._asdict(), recommendation.serialize())
+        self.assertIsNone(Recommendations.find_row_by_id(99))
+
+    def test_version_changes(self):
+        """ Bump the version on every change """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        self.assertEqual(recommendation.version, 1)
+        recommendation.update({'relation': 2})
+        self.assertEqual(recommendation.version, 2)
+        self.assertEqual(Recommendations.add_dislikes(recommendation.id)["version"], 3)
+        Recommendations.add_dislikes_many({recommendation.id: 2})
+        self.assertEqual(Recommendations.find_row_by_id(recommendation.id).version, 4)
+
+    def test_update_a_stale_recommendation(self):
+        """ Refuse to update a Recommendation changed since it was read """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        recommendation.relation = 2  # read version 1 and change it
+        db.session.execute("UPDATE recommendations SET version = 2")
+        self.assertRaises(StaleRecommendationError, recommendation.update, {'relation': 2})
+        self.assertEqual(Recommendations.find_by_id(recommendation.id).relation, 1)
+
+    def test_create_missing_columns(self):
+        """ Add columns to a table created before they were declared """
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        db.session.remove()
+        db.engine.execute("ALTER TABLE recommendations DROP COLUMN version")
+        Recommendations.create_missing_columns()
+        self.assertEqual(Recommendations.find_by_id(1).version, 1)
+
+    def test_deleted_at(self):
+        """ Stamp deleted_at on delete and clear it when brought back """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        self.assertIsNone(recommendation.deleted_at)
+        recommendation.soft_delete()
+        self.assertLessEqual(recommendation.deleted_at, datetime.utcnow())
+        recommendation.is_deleted = 0
+        recommendation.save()
+        self.assertIsNone(recommendation.deleted_at)
+        Recommendations(product_origin=2, product_target=3, relation=1, dislike=0, is_deleted=0).create()
+        Recommendations.retire_product(3)
+        self.assertIsNotNone(Recommendations.find_by_id(2).deleted_at)
+
+    def test_purge_deleted(self):
+        """ Purge the tombstones older than the retention window in batches """
+        for target in range(2, 9):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        for recommendation in Recommendations.all()[:5]:
+            recommendation.soft_delete()
+        # four of the tombstones are old enough
+        old = datetime.utcnow() - timedelta(days=40)
+        for by_id in (1, 2, 3, 4):
+            recommendation = Recommendations.find_by_id(by_id)
+            recommendation.deleted_at = old
+            recommendation.save()
+        progress = []
+        purged = Recommendations.purge_deleted(timedelta(days=30), batch_size=3, progress=progress.append)
+        self.assertEqual(purged, 4)
+        self.assertEqual(progress, [3, 4])
+        self.assertEqual([recommendation.id for recommendation in Recommendations.all()], [5, 6, 7])
+        self.assertEqual(Recommendations.purge_deleted(timedelta(days=30)), 0)
+
+    def test_remove_all_in_batches(self):
+        """ Remove every Recommendation a batch at a time """
+        for target in range(2, 9):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        progress = []
+        # the batched reset of databases that cannot truncate
+        with patch.object(db.engine.dialect, "name", "other"):
+            self.assertEqual(Recommendations.remove_all(batch_size=3, progress=progress.append), 7)
+            self.assertEqual(progress, [3, 6, 7])
+            self.assertEqual(Recommendations.all(), [])
+            self.assertEqual(Recommendations.remove_all(), 0)
+
+    def test_remove_all(self):
+        """ Remove every Recommendation at once """
+        for target in range(2, 5):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        removed = Recommendations.remove_all()
+        if db.engine.dialect.name != "postgresql":
+            # PostgreSQL reports the planner's estimate
+            self.assertEqual(removed, 3)
+        self.assertEqual(Recommendations.all(), [])
+
+    def test_upsert(self):
+        """ Create a Recommendation once and bring back its tombstone """
+        first = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).upsert()
+        self.assertEqual((first["id"], first["version"]), (1, 1))
+        again = Recommendations(product_origin=1, product_target=2, relation=1, dislike=5, is_deleted=0).upsert()
+        self.assertEqual(again, first)
+        Recommendations.find_by_id(1).soft_delete()
+        revived = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).upsert()
+        self.assertEqual((revived["id"], revived["is_deleted"], revived["version"]), (1, 0, 3))
+        self.assertEqual(len(Recommendations.all()), 1)
+        self.assertEqual([entry.operation for entry in Recommendations.find_changes(0)], ["create", "delete", "update"])
+
+    def test_change_log(self):
+        """ Log the new state of every changed Recommendation in order """
+        recommendation = Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        recommendation.update({"relation": 2})
+        recommendation.save()  # nothing changed, nothing logged
+        Recommendations.add_dislikes(recommendation.id)
+        Recommendations.add_dislikes_many({recommendation.id: 2})
+        db.session.refresh(recommendation)
+        recommendation.soft_delete()
+        Recommendations(product_origin=2, product_target=1, relation=1, dislike=0, is_deleted=0).create()
+        self.assertEqual(Recommendations.retire_product(2), 1)
+        Recommendations.remove_all()
+        entries = Recommendations.find_changes(0)
+        self.assertEqual([entry.operation for entry in entries],
+                         ["create", "update", "dislike", "dislike", "delete", "create", "delete", "reset"])
+        self.assertEqual([entry.seq for entry in entries], list(range(1, 9)))
+        self.assertEqual([(entry.relation, entry.dislike, entry.is_deleted, entry.version) for entry in entries[:5]],
+                         [(1, 0, 0, 1), (2, 0, 0, 2), (2, 1, 0, 3), (2, 3, 0, 4), (2, 3, 1, 5)])
+        self.assertEqual((entries[6].recommendation_id, entries[6].is_deleted, entries[6].version), (2, 1, 2))
+        self.assertIsNone(entries[7].recommendation_id)
+        self.assertEqual([entry.seq for entry in Recommendations.find_changes(5, limit=2)], [6, 7])
+        self.assertEqual(Recommendations.change_log_bounds(), (1, 8))
+
+    def test_change_log_rolls_back_with_the_write(self):
+        """ Log nothing when the write fails """
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        recommendation = Recommendations(product_origin=1, product_target=3, relation=1, dislike=0, is_deleted=0)
+        recommendation.create()
+        self.assertRaises(DuplicateRecommendationError, recommendation.update, {"product_target": 2})
+        self.assertEqual([entry.operation for entry in Recommendations.find_changes(0)], ["create", "create"])
+
+    def test_purge_changes(self):
+        """ Purge the old change log entries but the newest """
+        for target in range(2, 5):
+            Recommendations(product_origin=1, product_target=target, relation=1, dislike=0, is_deleted=0).create()
+        self.assertEqual(Recommendations.purge_changes(timedelta(days=1)), 0)
+        self.assertEqual(Recommendations.purged_seq(), 0)
+        db.session.execute(changes.update().values(changed_at=datetime.utcnow() - timedelta(days=2)))
+        db.session.commit()
+        self.assertEqual(Recommendations.purge_changes(timedelta(days=1)), 2)
+        self.assertEqual(Recommendations.change_log_bounds(), (3, 3))
+        self.assertEqual(Recommendations.purged_seq(), 2)
+        Recommendations(product_origin=1, product_target=5, relation=1, dislike=0, is_deleted=0).create()
+        self.assertEqual(Recommendations.purge_changes(timedelta(0)), 1)
+        self.assertEqual(Recommendations.purged_seq(), 3)
+
+    def test_change_log_horizon(self):
+        """ Hold back the seqs a writer in flight may still fill in """
+        horizon = ChangeLogHorizon()
+        self.assertEqual(horizon.observe(5, []), 5)
+        self.assertEqual(horizon.observe(8, [100]), 5)
+        self.assertEqual(horizon.observe(9, [100, 101]), 5)
+        self.assertEqual(horizon.observe(9, [101, 102]), 8)
+        self.assertEqual(horizon.observe(9, [102]), 9)  # 102 started after seq 9 was committed
+        self.assertEqual(horizon.observe(12, [103]), 9)
+        self.assertEqual(horizon.observe(13, []), 13)
+        self.assertEqual(horizon.observe(2, []), 2)  # the change log was created again
+
+    def test_complete_seq(self):
+        """ Read every committed seq where the writes are serialized """
+        self.assertEqual(Recommendations.complete_seq(), 0)
+        Recommendations(product_origin=1, product_target=2, relation=1, dislike=0, is_deleted=0).create()
+        self.assertEqual(Recommendations.complete_seq(), 1)
+
+    def test_init_db_schema_version(self):
+        """ Migrate the schema only when its recorded version is older """
+        self.assertIsNone(Recommendations.stored_schema_version())
+        Recommendations.init_db(app)
+        self.assertEqual(Recommendations.stored_schema_version(), SCHEMA_VERSION)
+        with patch.object(Recommendations, "migrate") as migrate:
+            Recommendations.init_db(app)
+            self.assertFalse(migrate.called)
+
+    def test_init_db_returns_its_connection(self):
+        """ Leave no connection checked out after initializing the database """
+        db.session.remove()
+        # the first call migrates the schema, the second finds it up to date
+        for _ in range(2):
+            before = pool_metrics.snapshot()
+            Recommendations.init_db(app)
+            after = pool_metrics.snapshot()
+            self.assertGreater(after["checkout"], before["checkout"])
+            self.assertEqual(after["checkout"] - before["checkout"], after["checkin"] - before["checkin"])
+
+    def test_init_db_verify_schema(self):
+        """ Refuse to start on an old schema in verify mode """
+        db.session.execute(schema_version.insert(), {"version": SCHEMA_VERSION - 1})
+        db.session.commit()
+        with patch.dict(app.config, {"DB_SCHEMA_MODE": "verify"}):
+            self.assertRaises(SchemaVersionError, Recommendations.init_db, app)
+        db.session.execute(schema_version.delete())
+        db.session.execute(schema_version.insert(), {"version": SCHEMA_VERSION})
+        db.session.commit()
+        with patch.dict(app.config, {"DB_SCHEMA_MODE": "verify"}):
+            Recommendations.init_db(app)
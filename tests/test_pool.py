@@ -0,0 +1,55 @@
+"""
+Test cases for the connection pool metrics
+
+"""
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, NullPool
+from service.pool import PoolMetrics
+
+
+######################################################################
+#  P O O L   M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestPoolMetrics(unittest.TestCase):
+    """ Test Cases for PoolMetrics """
+
+    def test_count_events(self):
+        """ Count the pool events and report the gauges """
+        engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=2)
+        metrics = PoolMetrics()
+        metrics.init_engine(engine)
+        metrics.init_engine(engine)  # listening twice would count twice
+        events = []
+        metrics.add_hook(lambda name, _: events.append(name))
+
+        connection = engine.connect()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["pool"], "QueuePool")
+        self.assertEqual(snapshot["size"], 2)
+        self.assertEqual(snapshot["checkedout"], 1)
+        self.assertEqual(snapshot["connect"], 1)
+        self.assertEqual(snapshot["checkout"], 1)
+        connection.close()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["checkedout"], 0)
+        self.assertEqual(snapshot["checkin"], 1)
+        self.assertEqual(events, ["connect", "checkout", "checkin"])
+
+    def test_pool_without_gauges(self):
+        """ Report no gauges for pools that keep no connections """
+        metrics = PoolMetrics()
+        self.assertIsNone(metrics.snapshot()["pool"])
+        metrics.init_engine(create_engine("sqlite://", poolclass=NullPool))
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["pool"], "NullPool")
+        self.assertIsNone(snapshot["size"])
+
+    def test_failing_hook(self):
+        """ A failing hook does not break the connection """
+        engine = create_engine("sqlite://", poolclass=QueuePool)
+        metrics = PoolMetrics()
+        metrics.init_engine(engine)
+        metrics.add_hook(lambda name, _: 1 / 0)
+        engine.connect().close()
+        self.assertEqual(metrics.snapshot()["checkin"], 1)
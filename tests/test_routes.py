@@ -7,14 +7,19 @@ Test cases can be run with the following:
 """
 import os
 import logging
+from datetime import timedelta
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 from flask import json
 from service import status  # HTTP Status Codes
 from service.models import db
-from service.routes import app, init_db
+from flask_restx import marshal
+from service.routes import app, api, init_db, recommendation_model
 from service.models import Recommendations
+from service.dislikes import dislike_buffer
+from service.cache import list_cache, idempotency_store
+from service.graph import graph_engine, numpy
 
 # Product_id
 PO = 3
@@ -46,6 +51,8 @@ class TestYourResourceServer(TestCase):
         """ This runs before each test """
         db.drop_all()
         db.create_all()
+        list_cache.clear()
+        idempotency_store.backend.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -170,6 +177,50 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(resp_data['dislike'], 0)
         self.assertEqual(resp_data['is_deleted'], 0)
 
+    def test_bulk_create_recommendations(self):
+        """ Create many Recommendations in one request """
+        # an existing live one and a deleted one
+        for target in (3, 4):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.delete('/recommendations/2')
+
+        items = [
+            {'product_origin': 2, 'product_target': 3, 'dislike': 5, 'relation': 1},
+            {'product_origin': 2, 'product_target': 4, 'dislike': 0, 'relation': 1},
+            {'product_origin': 2, 'product_target': 5, 'dislike': 0, 'relation': 2},
+            {'product_origin': 2, 'product_target': "bad data", 'dislike': 0, 'relation': 1},
+            {'product_origin': 0, 'product_target': 6, 'dislike': 0, 'relation': 1},
+            {'product_origin': 2, 'product_target': 5, 'dislike': 0, 'relation': 2},
+        ]
+        resp = self.app.post("/recommendations/bulk", data=json.dumps(items), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([result['status'] for result in results], [201, 201, 201, 400, 400, 201])
+        self.assertEqual(results[0]['recommendation']['id'], 1)
+        self.assertEqual(results[0]['recommendation']['dislike'], 0)
+        self.assertEqual(results[1]['recommendation']['id'], 2)
+        self.assertEqual(results[1]['recommendation']['is_deleted'], 0)
+        self.assertEqual(results[2]['recommendation']['id'], 3)
+        self.assertEqual(results[5]['recommendation']['id'], 3)
+        self.assertIn('message', results[3])
+
+        resp = self.app.get('/recommendations?product-id=2')
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_bulk_create_recommendations_ndjson(self):
+        """ Create many Recommendations from newline delimited JSON """
+        lines = [json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+                 for target in (3, 4)]
+        body = "\n".join(lines[:1] + ["not json"] + lines[1:]) + "\n"
+        resp = self.app.post("/recommendations/bulk", data=body, content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in resp.get_json()], [201, 400, 201])
+
+        resp = self.app.post("/recommendations/bulk", data=json.dumps({'product_origin': 2}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_retrieve_a_reconmmendation(self):
         """ Read a Recommendation """
         recommendation_rawdata = {'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1}
@@ -214,6 +265,445 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(resp_data, [])
 
+    def test_list_skips_deleted_recommendations(self):
+        """ List Recommendations without the deleted ones """
+        for target in (3, 4):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        resp = self.app.delete('/recommendations/1')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+        resp = self.app.get('/recommendations?product-id=2')
+        resp_data = resp.get_json()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp_data), 1)
+        self.assertEqual(resp_data[0]['id'], 2)
+        self.assertEqual(resp_data[0]['product_target'], 4)
+
+    def test_list_recommendations_by_page(self):
+        """ List Recommendations one page at a time """
+        for target in range(3, 8):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+
+        resp = self.app.get('/recommendations?product-id=2&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in resp.get_json()], [1, 2])
+        self.assertEqual(resp.headers['X-Next-Cursor'], '2')
+        self.assertIn('after-id=2', resp.headers['Link'])
+        self.assertIn('product-id=2', resp.headers['Link'])
+
+        next_url = resp.headers['Link'].split(';')[0].strip('<>')
+        resp = self.app.get(next_url)
+        self.assertEqual([row['id'] for row in resp.get_json()], [3, 4])
+
+        resp = self.app.get('/recommendations?product-id=2&limit=2&after-id=4')
+        self.assertEqual([row['id'] for row in resp.get_json()], [5])
+        self.assertNotIn('Link', resp.headers)
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+        resp = self.app.get('/recommendations?product-id=2&limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_recommendations(self):
+        """ Export all Recommendations as NDJSON """
+        for target in (3, 4, 5):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.delete('/recommendations/2')
+
+        resp = self.app.get('/recommendations/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertTrue(resp.is_streamed)
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [1, 3])
+        self.assertEqual(rows[0]['product_target'], 3)
+
+        resp = self.app.get('/recommendations/export?include-deleted=true')
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        self.assertEqual([row['is_deleted'] for row in rows], [0, 1, 0])
+
+    def test_read_responses_match_the_model(self):
+        """ Encode the read responses with the fields of the Swagger model """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        expected = marshal(Recommendations.find_by_id(1).serialize(), recommendation_model)
+
+        resp = self.app.get('/recommendations/1')
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.get_json(), expected)
+        for _ in range(2):  # from the database, then from the cache
+            resp = self.app.get('/recommendations?product-id=2')
+            self.assertEqual(resp.content_type, 'application/json')
+            self.assertEqual(resp.get_json(), [expected])
+
+    def test_rank_recommendations(self):
+        """ Read the top ranked Recommendations of a product """
+        for target, relation in [(3, 1), (4, 1), (5, 2)]:
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0,
+                                    'relation': relation})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.put('/recommendations/1/dislike')
+
+        resp = self.app.get('/products/2/recommendations?top=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['product_target'] for item in resp.get_json()], [4, 5])
+        self.assertEqual(resp.get_json()[0]['score'], 1.0)
+        resp = self.app.get('/products/2/recommendations?relation=1')
+        self.assertEqual([item['product_target'] for item in resp.get_json()], [4, 3])
+        resp = self.app.get('/products/2/recommendations?top=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_with_idempotency_key(self):
+        """ Replay the first response to a retried create """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        headers = {'Idempotency-Key': 'create-2-3'}
+        first = self.app.post("/recommendations", data=data_json, content_type='application/json', headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.app.delete('/recommendations/1')
+
+        retry = self.app.post("/recommendations", data=data_json, content_type='application/json', headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.assertEqual(retry.get_json(), first.get_json())
+        # the retry did not bring the deleted Recommendation back
+        self.assertEqual(self.app.get('/recommendations/1').get_json()['is_deleted'], 1)
+
+        other_json = json.dumps({'product_origin': 2, 'product_target': 4, 'dislike': 0, 'relation': 1})
+        resp = self.app.post("/recommendations", data=other_json, content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        resp = self.app.post("/recommendations", data=other_json, content_type='application/json',
+                             headers={'Idempotency-Key': 'x' * 256})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recommendation_changes(self):
+        """ Read the changes of the Recommendations incrementally """
+        self.assertEqual(self.app.get('/recommendations/export').headers['X-Last-Seq'], '0')
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.put('/recommendations/1/dislike')
+        self.assertEqual(self.app.get('/recommendations/export').headers['X-Last-Seq'], '2')
+        self.app.delete('/recommendations/1')
+
+        resp = self.app.get('/recommendations/changes?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        body = resp.get_json()
+        self.assertEqual([change['operation'] for change in body['changes']], ['create', 'dislike'])
+        self.assertEqual(body['changes'][1]['dislike'], 1)
+        self.assertEqual(body['last_seq'], 2)
+        body = self.app.get('/recommendations/changes?since=2').get_json()
+        self.assertEqual([change['operation'] for change in body['changes']], ['delete'])
+        self.assertEqual(body['changes'][0]['recommendation_id'], 1)
+        resp = self.app.get('/recommendations/changes?since=3&wait=1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {'CHANGES_WAIT_ENABLED': True}):
+            body = self.app.get('/recommendations/changes?since=3&wait=1').get_json()
+        self.assertEqual(body, {'changes': [], 'last_seq': 3})
+
+        Recommendations.purge_changes(timedelta(0))
+        resp = self.app.get('/recommendations/changes?since=1')
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        resp = self.app.get('/recommendations/changes')
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        # the consumer that read the last purged entry missed nothing
+        body = self.app.get('/recommendations/changes?since=2').get_json()
+        self.assertEqual([change['seq'] for change in body['changes']], [3])
+
+    def test_expand_recommendations(self):
+        """ Read the products recommended up to two hops away """
+        for origin, target, relation in [(2, 3, 1), (3, 4, 3), (2, 5, 2), (5, 6, 1)]:
+            data_json = json.dumps({'product_origin': origin, 'product_target': target, 'dislike': 0,
+                                    'relation': relation})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+
+        resp = self.app.get('/products/2/expansion')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['product_id'] for item in resp.get_json()], [3, 5, 4, 6])
+        self.assertEqual(resp.get_json()[2]['path'], [2, 3, 4])
+        resp = self.app.get('/products/2/expansion?depth=2&relation=1&relation=3')
+        self.assertEqual([item['product_id'] for item in resp.get_json()], [3, 4])
+        resp = self.app.get('/products/2/expansion?depth=1&limit=1')
+        self.assertEqual([item['product_id'] for item in resp.get_json()], [3])
+        resp = self.app.get('/products/2/expansion?depth=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_list_recommendations(self):
+        """ List the Recommendations of many products at once """
+        for origin, target, relation in [(2, 3, 1), (2, 4, 2), (5, 6, 1)]:
+            data_json = json.dumps({'product_origin': origin, 'product_target': target, 'dislike': 0,
+                                    'relation': relation})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.get('/recommendations?product-id=5')  # cached
+
+        resp = self.app.get('/recommendations/batch?product-id=2&product-id=5&product-id=7&product-id=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(list(data), ['2', '5', '7'])
+        self.assertEqual(data['2'], self.app.get('/recommendations?product-id=2').get_json())
+        self.assertEqual([item['product_target'] for item in data['5']], [6])
+        self.assertEqual(data['7'], [])
+        resp = self.app.get('/recommendations/batch?product-id=2&product-id=5&relation=2')
+        self.assertEqual(resp.get_json(), {'2': [self.app.get('/recommendations/2').get_json()], '5': []})
+
+        # the lists are cached like the single product ones
+        self.app.put('/recommendations/1/dislike')
+        resp = self.app.get('/recommendations/batch?product-id=2')
+        self.assertEqual(resp.get_json()['2'][0]['dislike'], 1)
+
+    def test_batch_list_bad_requests(self):
+        """ Refuse batch lists without products or with too many """
+        resp = self.app.get('/recommendations/batch')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {'BATCH_MAX_PRODUCTS': 2}):
+            resp = self.app.get('/recommendations/batch?product-id=1&product-id=2&product-id=3')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_recommendations_by_target(self):
+        """ List the Recommendations that point at a product """
+        for origin, target, relation in [(2, 3, 1), (4, 3, 2), (4, 5, 1), (6, 3, 1)]:
+            data_json = json.dumps({'product_origin': origin, 'product_target': target, 'dislike': 0,
+                                    'relation': relation})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.delete('/recommendations/4')
+
+        resp = self.app.get('/recommendations?target-id=3')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['product_origin'] for item in resp.get_json()], [2, 4])
+        resp = self.app.get('/recommendations?target-id=3&relation=2')
+        self.assertEqual([item['product_origin'] for item in resp.get_json()], [4])
+        resp = self.app.get('/recommendations?target-id=3&product-id=4')
+        self.assertEqual([item['product_target'] for item in resp.get_json()], [3])
+        resp = self.app.get('/recommendations?target-id=3&limit=1')
+        self.assertIn('target-id=3', resp.headers['Link'])
+
+    def test_retire_product(self):
+        """ Retire a product and every Recommendation from or to it """
+        for origin, target in [(2, 3), (3, 4), (5, 6)]:
+            data_json = json.dumps({'product_origin': origin, 'product_target': target, 'dislike': 0, 'relation': 1})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.assertEqual(len(self.app.get('/recommendations?product-id=2').get_json()), 1)  # cached
+
+        resp = self.app.put('/products/3/retire')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'product_id': 3, 'retired': 2})
+        self.assertEqual(self.app.get('/recommendations?product-id=2').get_json(), [])
+        self.assertEqual(self.app.get('/recommendations?product-id=3').get_json(), [])
+        self.assertEqual(len(self.app.get('/recommendations?product-id=5').get_json()), 1)
+
+    def test_purge_deleted_recommendations(self):
+        """ Purge old tombstones from the scheduler endpoint """
+        resp = self.app.post('/recommendations/purge')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.delete('/recommendations/1')
+        with patch.dict(app.config, {'PURGE_ENDPOINT_ENABLED': True, 'TOMBSTONE_RETENTION_DAYS': 0}):
+            resp = self.app.post('/recommendations/purge')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'purged': 1, 'changes_purged': 0})
+        self.assertIsNone(Recommendations.find_by_id(1))
+
+    def test_purge_deleted_command(self):
+        """ Purge old tombstones from the command line """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        self.app.delete('/recommendations/1')
+        result = app.test_cli_runner().invoke(args=['purge-deleted', '--retention-days', '1'])
+        self.assertIn('Purged 0 deleted Recommendations', result.output)
+        result = app.test_cli_runner().invoke(args=['purge-deleted', '--retention-days', '0'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Purged 1 deleted Recommendations', result.output)
+
+    def test_swagger_spec_is_lazy(self):
+        """ Build the Swagger spec on the first request for it """
+        api._schema = None
+        self.app.get('/recommendations?product-id=2')
+        self.assertIsNone(api._schema)
+        resp = self.app.get('/swagger.json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('/recommendations', resp.get_json()['paths'])
+        self.assertIsNotNone(api._schema)
+
+    def test_list_read_during_a_write_is_not_cached(self):
+        """ Keep a list out of the cache when a write commits while it is read """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        find = Recommendations.find_live_by_attributes
+
+        def read_then_write(*args, **kwargs):
+            rows = find(*args, **kwargs)
+            # the write commits and invalidates after the rows were read, before they are cached
+            Recommendations.add_dislikes(1, 2)
+            return rows
+
+        with patch.object(Recommendations, 'find_live_by_attributes', side_effect=read_then_write):
+            resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(resp.get_json()[0]['dislike'], 0)
+        self.assertIsNone(list_cache.get(2, 1))
+        self.assertEqual(self.app.get('/recommendations?product-id=2&relation=1').get_json()[0]['dislike'], 2)
+
+    def test_list_recommendations_from_cache(self):
+        """ List Recommendations through the cache and drop it on writes """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        hits = list_cache.hits
+
+        resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertEqual(list_cache.hits, hits + 1)
+
+        # create
+        data_json = json.dumps({'product_origin': 2, 'product_target': 4, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(len(resp.get_json()), 2)
+        # dislike
+        self.app.put('/recommendations/2/dislike')
+        resp = self.app.get('/recommendations?product-id=2')
+        self.assertEqual(resp.get_json()[1]['dislike'], 1)
+        # update to another relation
+        data_json = json.dumps({'product_origin': 2, 'product_target': 4, 'dislike': 1, 'relation': 2})
+        self.app.put('/recommendations/2', data=data_json, content_type='application/json')
+        resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(len(resp.get_json()), 1)
+        # delete
+        self.app.delete('/recommendations/1')
+        resp = self.app.get('/recommendations?product-id=2&relation=1')
+        self.assertEqual(resp.get_json(), [])
+        # reset
+        self.app.get('/recommendations?product-id=2')
+        self.app.delete('/recommendations/reset')
+        resp = self.app.get('/recommendations?product-id=2')
+        self.assertEqual(resp.get_json(), [])
+
+    def test_stats(self):
+        """ Read the cache and pool statistics """
+        self.app.get('/recommendations?product-id=2')
+        resp = self.app.get('/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['cache']['backend'], 'LRUCache')
+        self.assertGreaterEqual(resp.get_json()['cache']['misses'], 1)
+        self.assertGreaterEqual(resp.get_json()['pool']['checkout'], 1)
+
+    def test_metrics(self):
+        """ Read the request, query and pool metrics """
+        self.app.get('/recommendations?product-id=2')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",route="/recommendations",status="200"}', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="/recommendations",le="+Inf"}', text)
+        self.assertIn('db_queries_per_request_count{route="/recommendations"}', text)
+        self.assertIn('response_serialization_seconds_count{route="/recommendations"}', text)
+        self.assertIn('db_pool_checkout_total ', text)
+
+    def test_request_log(self):
+        """ Log one record per sampled request """
+        with patch.dict(app.config, {'LOG_SAMPLE_RATE': 1}):
+            with self.assertLogs(app.logger, level='INFO') as logs:
+                self.app.get('/recommendations?product-id=2')
+        record = logs.records[-1]
+        self.assertEqual(record.request['route'], '/recommendations')
+        self.assertEqual(record.request['status'], 200)
+        self.assertEqual(record.request['queries'], 1)
+        self.assertIn('GET /recommendations 200', record.getMessage())
+
+    def test_retrieve_with_etag(self):
+        """ Read a Recommendation again only when it changed """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        resp = self.app.get('/recommendations/1')
+        etag = resp.headers['ETag']
+        self.assertEqual(resp.get_json()['version'], 1)
+
+        resp = self.app.get('/recommendations/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b'')
+
+        self.app.put('/recommendations/1/dislike')
+        resp = self.app.get('/recommendations/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.get_json()['dislike'], 1)
+
+    def test_list_with_etag(self):
+        """ List Recommendations again only when one changed """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        for url in ('/recommendations?product-id=2', '/recommendations?product-id=2&limit=5'):
+            resp = self.app.get(url)
+            etag = resp.headers['ETag']
+            resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.data, b'')
+
+        self.app.put('/recommendations/1/dislike')
+        resp = self.app.get('/recommendations?product-id=2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]['dislike'], 1)
+
+    def test_update_and_delete_with_if_match(self):
+        """ Update and delete a Recommendation only when the ETag matches """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        etag = self.app.get('/recommendations/1').headers['ETag']
+
+        new_data = json.dumps({'product_origin': 2, 'product_target': 4, 'dislike': 0, 'relation': 1})
+        resp = self.app.put('/recommendations/1', data=new_data, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # the old ETag is now stale
+        resp = self.app.put('/recommendations/1', data=data_json, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete('/recommendations/1', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get('/recommendations/1').get_json()['product_target'], 4)
+
+        resp = self.app.delete('/recommendations/1', headers={'If-Match': '*'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get('/recommendations/1').get_json()['is_deleted'], 1)
+
+    def test_update_and_delete_during_a_dislike(self):
+        """ Retry the writes without If-Match when a dislike lands between the read and the write """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        etag = self.app.get('/recommendations/1').headers['ETag']
+
+        def dislike_once(recommendation):
+            if not disliked:
+                disliked.append(recommendation.id)
+                db.engine.execute("UPDATE recommendations SET dislike = dislike + 1, version = version + 1")
+
+        new_data = json.dumps({'product_origin': 2, 'product_target': 4, 'dislike': 0, 'relation': 1})
+        disliked = []
+        with patch('service.routes.check_if_match', side_effect=dislike_once):
+            resp = self.app.put('/recommendations/1', data=new_data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # a PUT replaces the whole Recommendation, its dislike count included
+        self.assertEqual((resp.get_json()['product_target'], resp.get_json()['dislike']), (4, 0))
+        disliked = []
+        with patch('service.routes.check_if_match', side_effect=dislike_once):
+            resp = self.app.delete('/recommendations/1')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        stored = self.app.get('/recommendations/1').get_json()
+        self.assertEqual((stored['dislike'], stored['is_deleted']), (1, 1))
+
+        # the client that sent If-Match is told instead
+        disliked = []
+        with patch('service.routes.check_if_match', side_effect=dislike_once):
+            resp = self.app.put('/recommendations/1', data=new_data, content_type='application/json',
+                                headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     def test_not_find_a_reconmmendation(self):
         """ Not found a Recommendation """
         # not found
@@ -266,6 +756,17 @@ class TestYourResourceServer(TestCase):
         resp = self.app.put('/recommendations/2', data=data_json, content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_a_recommendation_to_a_duplicate(self):
+        """ Update a Recommendation into one that already exists """
+        for target in (3, 4):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': 1})
+            resp = self.app.post("/recommendations", data=data_json, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        resp = self.app.put('/recommendations/2', data=data_json, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
     def test_dislike_recommendations(self):
         """ Dislike the Recommendations"""
         recommendation_rawdata = {'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1}
@@ -289,6 +790,48 @@ class TestYourResourceServer(TestCase):
         resp = self.app.put('/recommendations/2/dislike', data=data_json, content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_dislike_recommendations_coalesced(self):
+        """ Dislike the Recommendations with write coalescing """
+        data_json = json.dumps({'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1})
+        self.app.post("/recommendations", data=data_json, content_type='application/json')
+        dislike_buffer.enabled = True
+        try:
+            for expected in (1, 2):
+                resp = self.app.put('/recommendations/1/dislike')
+                self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(resp.get_json()['dislike'], expected)
+            resp = self.app.put('/recommendations/2/dislike')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            dislike_buffer.enabled = False
+            dislike_buffer.stop()
+        resp = self.app.get('/recommendations/1')
+        self.assertEqual(resp.get_json()['dislike'], 2)
+
+    def test_list_from_graph(self):
+        """ List the Recommendations of a product from the in-memory graph """
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+        for target, relation in ((3, 1), (4, 2), (5, 1)):
+            data_json = json.dumps({'product_origin': 2, 'product_target': target, 'dislike': 0, 'relation': relation})
+            self.app.post("/recommendations", data=data_json, content_type='application/json')
+        expected = self.app.get('/recommendations?product-id=2&relation=1')
+        graph_engine.init_app(app)
+        graph_engine.enabled = True
+        graph_engine.reload()
+        list_cache.clear()
+        try:
+            with patch.object(graph_engine, '_ensure_started'), \
+                    patch.object(Recommendations, 'find_live_by_attributes', side_effect=AssertionError):
+                resp = self.app.get('/recommendations?product-id=2&relation=1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json(), expected.get_json())
+            self.assertEqual(resp.headers['ETag'], expected.headers['ETag'])
+            self.assertEqual(self.app.get('/stats').get_json()['graph']['edges'], 3)
+        finally:
+            graph_engine.enabled = False
+            graph_engine.graph = None
+
     def test_reset_recommendations(self):
         """ Reset the Recommendations"""
         recommendation_rawdata = {'product_origin': 2, 'product_target': 3, 'dislike': 0, 'relation': 1}
@@ -301,6 +844,10 @@ class TestYourResourceServer(TestCase):
         resp = self.app.delete('/recommendations/reset')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(len(resp.data), 0)
+        self.assertIn('X-Removed-Count', resp.headers)
+        if db.engine.dialect.name != 'postgresql':
+            # PostgreSQL reports the planner's estimate
+            self.assertEqual(resp.headers['X-Removed-Count'], '1')
 
         resp = self.app.get('/recommendations')
         resp_data = json.loads(resp.data)